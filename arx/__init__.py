@@ -7,6 +7,8 @@ from .bundle import Bundle, Code, Data
 from .inner.schematics import interpreter_injector
 from .sources import interpreter
 from .sources.core import DiskLocal
+from .sources.inline import inline
+from .util.tmp import tmpdir
 
 
 __version__ = v2.from_pkg().from_git().from_default().version
@@ -97,8 +99,15 @@ class Arx(namedtuple('Arx', 'interpreter')):
         assert isinstance(cached, DiskLocal)
         return self.Source(cached.externalize())
 
-    def inline(self, source):
-        raise NotImplementedError()
+    def inline(self, source, under=None):
+        """The data of the source, placed under ``under`` (or a temporary
+           directory), as an inline source (see
+           :func:`~arx.sources.inline.inline`).
+        """
+        if under is not None:
+            return inline(source, under)
+        with tmpdir() as tmp:
+            return inline(source, tmp)
 
 
 arx = Arx(interpreter.default)
@@ -8,27 +8,225 @@ import ptpython.repl
 import six
 import yaml
 
+from . import arx, proxy
+from .cache import parse_size, store_injector
+from .sources.tar import sidecar_suffix
 from .task import Task
+from .util.tarindex import Index, Unindexable
+from .util.tmp import tmpdir
 
 
 def main():
     log.configure()
     maybe_console()
+    maybe_command()
     interpret()
 
 
 @click.command()
 @click.argument('input', type=click.File('rb'))
 @click.option('--debug/--no-debug', default=False)
-def interpret(input, debug=False):
+@click.option('--jobs', '-j', default=4, show_default=True,
+              help='Number of sources to fetch at once.')
+@click.option('--lockfile', '-l', type=click.File('rb'), default=None,
+              help='Run with the sources resolved by `arx lock`.')
+def interpret(input, debug=False, jobs=4, lockfile=None):
     """Downloads data and runs commands as per the Arx file."""
     if debug:
         log.configure(level='debug')
-    data = yaml.load(input.read())
-    task = Task(data)
+    bundle = arx.Bundle(yaml.load(input.read()))
+    if lockfile is not None:
+        bundle = bundle.locked(yaml.safe_load(lockfile.read()))
+    task = Task(bundle, jobs=jobs)
     task.run()
 
 
+@click.group()
+def commands():
+    """Commands other than running a manifest, as in ``arx cache stats``."""
+
+
+def maybe_command():
+    if sys.argv[1:2] and sys.argv[1] in commands.commands:
+        commands()
+
+
+@commands.group('cache')
+def cache_commands():
+    """Inspects and prunes the persistent download cache."""
+
+
+@cache_commands.command()
+def stats():
+    """Shows the location, size and number of entries in the cache."""
+    store = store_injector.store
+    if store is None:
+        raise click.ClickException('The cache is disabled (ARX_CACHE=off).')
+    click.echo(yaml.safe_dump(store.stats(), default_flow_style=False))
+
+
+@cache_commands.command()
+@click.option('--limit', default=None,
+              help='Size to shrink the cache to, like 500M or 20G.')
+def gc(limit=None):
+    """Evicts least recently used data and drops stale entries."""
+    store = store_injector.store
+    if store is None:
+        raise click.ClickException('The cache is disabled (ARX_CACHE=off).')
+    limit = parse_size(limit) if limit is not None else store.limit
+    freed = store.gc(limit)
+    click.echo('Freed %d bytes.' % freed)
+
+
+@cache_commands.command()
+@click.option('--host', default='127.0.0.1', show_default=True,
+              help='Address to listen on. The proxy fetches URLs for anyone '
+                   'who can reach it: only listen beyond localhost on a '
+                   'trusted network.')
+@click.option('--port', default=8080, show_default=True,
+              help='Port to listen on (0 for any free port).')
+@click.option('--fresh', default=60, show_default=True,
+              help='Seconds for which fetched data is served without '
+                   'revalidating it with its origin.')
+@click.option('--allow', multiple=True,
+              help='URL prefix that may be fetched, like '
+                   'https://data.example.com/ (repeatable). By default, any '
+                   'URL but those of private, reserved, loopback and '
+                   'link-local addresses.')
+def serve(host='127.0.0.1', port=8080, fresh=60, allow=()):
+    """Serves the cache over HTTP, as a read-through proxy that other hosts
+       fetch HTTP/S and S3 data through, when they set ARX_PROXY to its URL.
+    """
+    store = store_injector.store
+    if store is None:
+        raise click.ClickException('The cache is disabled (ARX_CACHE=off).')
+    if os.environ.pop('ARX_PROXY', None):
+        log.warning('Not using ARX_PROXY: the proxy fetches from the origin.')
+
+    def ready(server):
+        click.echo('Serving %s on: %s' % (store.root, server.url))
+        sys.stdout.flush()
+
+    try:
+        proxy.serve(store, host, port, fresh, ready, allow)
+    except KeyboardInterrupt:
+        pass
+
+
+@commands.command()
+@click.argument('input', type=click.File('rb'))
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the signed manifest (default: stdout).')
+@click.option('--ttl', default=3600, show_default=True,
+              help='Seconds for which signed URLs are usable.')
+@click.option('--jobs', '-j', default=16, show_default=True,
+              help='Number of sources to sign at once.')
+def sign(input, output, ttl=3600, jobs=16):
+    """Rewrites S3 sources as signed HTTPS URLs, so that the manifest can be
+       run without AWS credentials.
+    """
+    bundle = arx.Bundle(yaml.load(input.read()))
+    signed = bundle.sign(ttl, jobs=jobs)
+    output.write(yaml.safe_dump(signed.to_primitive(),
+                                default_flow_style=False))
+
+
+@commands.command()
+@click.argument('input', type=click.File('rb'))
+@click.option('--jobs', '-j', default=8, show_default=True,
+              help='Number of sources to fetch at once.')
+@click.option('--lockfile', '-l', type=click.File('rb'), default=None,
+              help='Fetch the sources resolved by `arx lock`.')
+def fetch(input, jobs=8, lockfile=None):
+    """Downloads every source in the manifest into the cache, without running
+       anything, so that a later run finds its data on disk.
+    """
+    if store_injector.store is None:
+        raise click.ClickException('The cache is disabled (ARX_CACHE=off).')
+    bundle = arx.Bundle(yaml.load(input.read()))
+    if lockfile is not None:
+        bundle = bundle.locked(yaml.safe_load(lockfile.read()))
+    with tmpdir() as tmp:
+        bundle.prefetch(tmp, jobs=jobs)
+
+
+@commands.command()
+@click.argument('input', type=click.File('rb'))
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the lockfile (default: stdout).')
+@click.option('--jobs', '-j', default=16, show_default=True,
+              help='Number of sources to resolve at once.')
+def lock(input, output, jobs=16):
+    """Resolves every source in the manifest -- Git refs to commits and files
+       to their digests and sizes -- writing a lockfile.
+
+    Running the manifest with ``--lockfile`` uses the resolved sources and
+    trusts the digests, so data already in the cache is used without any
+    requests to its origin.
+    """
+    bundle = arx.Bundle(yaml.load(input.read()))
+    with tmpdir() as tmp:
+        found = bundle.lock(tmp, jobs=jobs)
+    output.write(yaml.safe_dump(found, default_flow_style=False))
+
+
+@commands.command()
+@click.argument('input', type=click.File('rb'))
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the packed manifest (default: stdout).')
+@click.option('--url', default=None,
+              help='Where the packed manifest finds the pack, like '
+                   'pack+file:///@/./bundle.pack (default: its absolute '
+                   'path).')
+@click.option('--jobs', '-j', default=4, show_default=True,
+              help='Number of sources to fetch at once.')
+@click.option('--lockfile', '-l', type=click.File('rb'), default=None,
+              help='Pack the sources resolved by `arx lock`.')
+def pack(input, path, output, url=None, jobs=4, lockfile=None):
+    """Writes the data of every source in the manifest into one pack, at
+       PATH, and a manifest that places everything from the pack.
+
+    Ship the pack with the packed manifest to run it without access to any
+    of the original sources.
+    """
+    bundle = arx.Bundle(yaml.load(input.read()))
+    if lockfile is not None:
+        bundle = bundle.locked(yaml.safe_load(lockfile.read()))
+    with tmpdir() as tmp:
+        packed = bundle.pack(tmp, path, url, jobs=jobs)
+    output.write(yaml.safe_dump(packed.to_primitive(),
+                                default_flow_style=False))
+
+
+@commands.command()
+@click.argument('archive', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', default=None,
+              help='Where to write the index (default: next to the archive, '
+                   'with .index.json appended).')
+@click.option('--spacing', default='1M', show_default=True,
+              help='Distance between checkpoints in gzipped archives of '
+                   'many members, like those written by bgzip.')
+def index(archive, output=None, spacing='1M'):
+    """Indexes the files in a tar archive, so that a single file can be
+       fetched from it without downloading the whole archive.
+
+    Publish the index next to the archive -- as ``<archive>.index.json`` --
+    over HTTP/S or S3. Uncompressed archives, and archives gzipped as many
+    members, can be read in part; for other gzipped archives, the index only
+    spares parsing the archive.
+    """
+    try:
+        found = Index.build(archive, parse_size(spacing))
+    except Unindexable as e:
+        raise click.ClickException(str(e))
+    if found.compression is not None and len(found.checkpoints) < 2:
+        log.warning('There is only one gzip member in %s; the whole archive '
+                    'will be downloaded for every file.', archive)
+    with open(output or archive + sidecar_suffix, 'w') as h:
+        h.write(found.dumps())
+
+
 def maybe_console():
     if ['//console'] == sys.argv[1:2]:
         if ['-d'] == sys.argv[2:3]:
@@ -1,8 +1,29 @@
+from contextlib import contextmanager
+import copy
+import os
+
+from magiclog import log
+import py.path
 from schematics.exceptions import ValidationError
 from schematics.types import StringType
 from schematics.types.compound import DictType, ListType, ModelType
 
+from .cache import pinning
+from .err import Err
 from .inner.schematics import Model, SourceType
+from .sources.core import SignableURL, SourceURL
+from .sources.git import Git
+from .sources.inline import InlineJar
+from .sources.jar import Jar
+from .sources.pack import Pack
+from .sources.tar import Tar
+from .sources.zip import Zip
+from .util import linking
+from .util.packfile import Packer
+from .util.pool import concurrently
+
+
+digest_pattern = r'^(sha256:)?[0-9a-fA-F]{64}$'
 
 
 class Ctx(Model):
@@ -12,9 +33,17 @@ class Ctx(Model):
 
 
 class Code(Ctx):
+    """Code to run, from a source or a command.
+
+    Like data, code from a source can be pinned to a ``digest``.
+    """
     source = SourceType()
     cmd = StringType()
     args = ListType(StringType, default=[])
+    digest = StringType(regex=digest_pattern)
+
+    def validate_digest(self, data, value):
+        return pinnable(data.get('source'), value)
 
     def validate_cmd_and_source(self):
         if bool(self.source) == bool(self.cmd):
@@ -23,8 +52,45 @@ class Code(Ctx):
 
 
 class Data(Ctx):
+    """Data to place before running code.
+
+    How files are placed can be chosen with ``link`` -- one of ``reflink``,
+    ``hardlink``, ``symlink`` or ``copy``, as described in
+    :mod:`arx.util.linking`; by default, each source places files in the way
+    that suits it.
+
+    The data can be pinned to the SHA-256 ``digest`` of the file fetched (as
+    ``sha256:<hex>``, or just the hex), so that it is checked as it is fetched
+    and -- when it is already in the store -- used without consulting the
+    source at all (see :func:`arx.cache.pinned`). Sources with no single file
+    of data -- directories, Git checkouts and entries of packs -- can not be
+    pinned.
+    """
     source = SourceType(required=True)
     target = StringType()
+    link = StringType(choices=sorted(linking.strategies))
+    digest = StringType(regex=digest_pattern)
+
+    def validate_digest(self, data, value):
+        return pinnable(data.get('source'), value)
+
+    def path(self, cwd):
+        """Where the data is placed, relative to the working directory.
+
+        Without a target, sources with directory nature are placed in the
+        working directory itself and those with file nature are placed in it
+        under the last component of their path.
+        """
+        cwd = self.cwd or str(cwd)
+        if self.target is not None:
+            target = os.path.expanduser(self.target)
+            return py.path.local(os.path.join(cwd, target))
+        name = default_name(self.source)
+        return py.path.local(cwd).join(name) if name else py.path.local(cwd)
+
+    def place(self, cache, cwd):
+        with linking.using(self.link), pinned_to(self):
+            self.source.place(cache, self.path(cwd))
 
 
 class Bundle(Ctx):
@@ -45,3 +111,201 @@ class Bundle(Ctx):
                     del col[idx]
                 return self
         raise TypeError('Bundles can only remove Code or Data instances.')
+
+    def place(self, cache, cwd, jobs=4):
+        """Places all the data of the bundle, fetching up to ``jobs`` sources
+           at once.
+
+        Each source is cached in its own directory under ``cache``. When
+        placement fails for any of the data, the others are still placed and
+        then :class:`~arx.util.pool.Failures` is raised, listing every failed
+        entry.
+        """
+        cache = py.path.local(cache)
+
+        def place(entry):
+            i, data = entry
+            data.place(cache.join('data', str(i)).ensure(dir=True), cwd)
+
+        def label(entry):
+            return 'data[%d] (%s)' % (entry[0], entry[1].source)
+
+        concurrently(place, enumerate(self.data or []), jobs=jobs, label=label)
+
+    def prefetch(self, cache, jobs=4):
+        """Fetches the sources of all the code and data of the bundle into the
+           persistent store, up to ``jobs`` at once, without placing or
+           running anything (see :meth:`~arx.sources.core.Source.prefetch`).
+
+        Sources that appear more than once are fetched once. Failures are
+        raised together, as with :meth:`place`.
+        """
+        cache = py.path.local(cache)
+        items = dict(((item.source.externalize(), item.digest), item)
+                     for item in (self.code or []) + (self.data or [])
+                     if item.source is not None)
+        keys = sorted(items, key=repr)
+
+        def prefetch(i):
+            item = items[keys[i]]
+            with pinned_to(item):
+                item.source.prefetch(cache.join('prefetch', str(i))
+                                     .ensure(dir=True))
+
+        concurrently(prefetch, range(len(keys)), jobs=jobs,
+                     label=lambda i: str(items[keys[i]].source))
+
+    def sign(self, seconds=3600, jobs=16):
+        """A copy of the bundle in which every signable source is replaced by
+           its signed equivalent, usable for ``seconds``.
+
+        This allows S3 data to be fetched over plain HTTP/S by workers that
+        have no credentials. Sources are signed concurrently; those that can
+        not be signed, like directory-like S3 URLs, are left as they are.
+        """
+        signed = copy.deepcopy(self)
+        items = [item for item in (signed.code or []) + (signed.data or [])
+                 if isinstance(item.source, SignableURL)]
+
+        def sign(item):
+            try:
+                item.source = item.source.sign(seconds)
+            except Err as e:
+                log.warning('Not signing %s: %s', item.source, e)
+
+        concurrently(sign, items, jobs=jobs,
+                     label=lambda item: str(item.source))
+        return signed
+
+    def lock(self, cache, jobs=16):
+        """Resolves every source of the bundle, as for a lockfile, fetching up
+           to ``jobs`` of them at once.
+
+        The lock maps the URL of each source to its resolved URL and -- for
+        data that is a file -- the digest and size of the data (see
+        :meth:`~arx.sources.core.Source.pin`). Files are fetched to digest
+        them, and so are in the store, if there is one, once the lock is
+        made. Inline sources need no lock and are left out.
+        """
+        cache = py.path.local(cache)
+        sources = dict((item.source.externalize(), item.source)
+                       for item in (self.code or []) + (self.data or [])
+                       if isinstance(item.source, SourceURL))
+        urls = sorted(sources)
+
+        def pin(i):
+            return sources[urls[i]].pin(cache.join('lock', str(i)))
+
+        pins = concurrently(pin, range(len(urls)), jobs=jobs,
+                            label=lambda i: urls[i])
+        return dict(sources=dict(zip(urls, pins)))
+
+    def locked(self, lock):
+        """A copy of the bundle in which every source is replaced by the
+           resolved source recorded in the lock, pinned to the digest of its
+           data, if there is one.
+
+        This way, the bundle is run without consulting the origin of any data
+        that is already in the store, and refs are not resolved again. A
+        source that is not in the lock raises :class:`Unlocked`.
+        """
+        pins = lock.get('sources') or {}
+        locked = copy.deepcopy(self)
+        for item in (locked.code or []) + (locked.data or []):
+            if not isinstance(item.source, SourceURL):
+                continue
+            pin = pins.get(item.source.externalize())
+            if pin is None:
+                raise Unlocked('Not in the lockfile (run `arx lock` again): '
+                               '%s' % item.source)
+            item.source = type(item.source)(pin['url'])
+            if item.digest is None:
+                item.digest = pin.get('digest')
+        return locked
+
+    def pack(self, cache, path, url=None, jobs=4):
+        """Writes the data of every source of the bundle into one pack at
+           ``path`` (see :mod:`arx.util.packfile`), placing up to ``jobs``
+           sources at once, and returns a copy of the bundle in which each
+           source is replaced by its entry in the pack, found at ``url`` --
+           by default, the absolute path of the pack.
+
+        Sources are placed under ``cache``, which must be kept until the pack
+        is written. Pinned data is checked as it is placed, so the digests are
+        not carried over; and data placed under the name of its source is
+        given that name as its target.
+        """
+        cache = py.path.local(cache)
+        url = url or 'pack+file://' + os.path.abspath(str(path))
+        packed, packer = copy.deepcopy(self), Packer(path)
+        items = [('%s/%d' % (kind, i), item)
+                 for kind, col in [('code', packed.code or []),
+                                   ('data', packed.data or [])]
+                 for i, item in enumerate(col)
+                 if item.source is not None]
+
+        def add(entry):
+            name, item = entry
+            under = cache.join('pack', name).ensure(dir=True)
+            with pinned_to(item):
+                item.source.place(under.join('cache').ensure(dir=True),
+                                  under.join('placed'))
+            jar = isinstance(item.source, (Jar, InlineJar))
+            packer.add(name, under.join('placed'), 'jar' if jar else None)
+
+        concurrently(add, items, jobs=jobs,
+                     label=lambda entry: '%s (%s)' % (entry[0],
+                                                      entry[1].source))
+        packer.close()
+        for name, item in items:
+            if isinstance(item, Data) and item.target is None:
+                item.target = default_name(item.source)
+            item.source = Pack('%s#%s' % (url, name))
+            item.digest = None
+        return packed
+
+
+@contextmanager
+def pinned_to(item):
+    """Pins the source of the code or data to its digest, if it has one, for
+       the duration of the block (see :func:`arx.cache.pinning`).
+    """
+    try:
+        pinnable(item.source, item.digest)
+    except ValidationError as e:
+        raise Unpinnable(str(e.messages[0]))
+    with pinning(item.digest):
+        yield
+
+
+def pinnable(source, digest):
+    if digest is not None and source is not None and not source.pinnable:
+        raise ValidationError('The data of %s can not be pinned to a digest.'
+                              % source)
+    return digest
+
+
+def default_name(source):
+    """File name for data placed without a target; or ``None``, for sources
+       with directory nature.
+    """
+    url = getattr(source, 'url', None)
+    if url is None or isinstance(source, (Git, Pack)):
+        return None
+    if isinstance(source, (Tar, Zip)):
+        path = url.fragment
+        if path is None or path.endswith('/'):
+            return None
+    elif getattr(source, 'dirlike', False):
+        return None
+    else:
+        path = url.path
+    return path.rstrip('/').split('/')[-1] or None
+
+
+class Unlocked(Err):
+    pass
+
+
+class Unpinnable(Err):
+    pass
@@ -0,0 +1,688 @@
+"""Persistent, content-addressed storage for source data.
+
+Sources write into a temporary directory that is removed at the end of a run
+(see :func:`arx.util.tmp.tmpdir`). To spare repeated runs of a manifest from
+downloading everything again, sources can consult a :class:`Store`, which
+keeps data under a cache directory -- ``~/.cache/arx`` by default -- between
+runs.
+"""
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:                                       # Not on Windows.
+    fcntl = None
+
+from magiclog import log
+import py.path
+import uritools
+
+from .err import Err
+from .util.transfer import Hashing
+
+
+class Store(object):
+    """A persistent cache of source data, shared between runs of Arx.
+
+    Data is stored under ``objects/``, named by its SHA-256 digest, so
+    identical data fetched from different URLs is only stored once. Entries
+    under ``urls/`` map a normalized source URL to the digest of its data,
+    along with any metadata the source wants to keep. Sources with directory
+    nature that are updated in place, rather than stored whole, keep a
+    directory under ``trees/``, as do unpacked archives; indexes of stored
+    archives are kept under ``indexes/`` and records of the files placed from
+    directories, so they can be updated incrementally, under ``placements/``.
+
+    A store can be shared by many processes at once. Everything is written
+    under ``tmp/`` and renamed into place, so readers never see partial data;
+    and sources hold a lock, under ``locks/``, while they fetch data for a
+    URL, so that only one process downloads it while the others wait for it
+    to be stored.
+
+    Sources can be pinned to the digest of their data (see :func:`pinning`),
+    in which case data with that digest is used whatever URL it was stored
+    under, without consulting the origin.
+
+    Hits refresh the modification time of the entry and its object (or of the
+    tree); ``gc`` uses this to evict the least recently used data first,
+    whenever the store grows beyond its ``limit`` (in bytes). The size of the
+    store is measured once per process and then estimated as data is added,
+    so that it is not measured again until it is over the limit.
+    """
+
+    partial_ttl = 7 * 24 * 3600
+
+    def __init__(self, root, limit=None):
+        self.root = py.path.local(root)
+        self.limit = limit
+        self.estimate = None
+        self.sizing = threading.Lock()
+
+    @property
+    def objects(self):
+        return self.root.join('objects')
+
+    @property
+    def urls(self):
+        return self.root.join('urls')
+
+    @property
+    def tmp(self):
+        return self.root.join('tmp')
+
+    @property
+    def partial(self):
+        return self.root.join('partial')
+
+    @property
+    def trees(self):
+        return self.root.join('trees')
+
+    @property
+    def indexes(self):
+        return self.root.join('indexes')
+
+    @property
+    def placements(self):
+        return self.root.join('placements')
+
+    @property
+    def locks(self):
+        return self.root.join('locks')
+
+    def obj(self, digest):
+        """Path to the object with the given digest."""
+        return self.objects.join(digest[:2], digest)
+
+    def entryname(self, url):
+        key = sha256(normalize(url).encode('utf-8'))
+        return self.urls.join(key[:2], key + '.json')
+
+    def partname(self, url):
+        """Where data for the URL is kept while it is downloading, so that
+           an interrupted download can be resumed by a later run.
+        """
+        key = sha256(normalize(url).encode('utf-8'))
+        return self.partial.ensure(dir=True).join(key + '.part')
+
+    @contextmanager
+    def lock(self, url):
+        """Holds an exclusive lock for the URL, shared by threads and
+           processes, for the duration of the block; yields ``True`` if
+           another holder had to be waited for.
+        """
+        key = sha256(normalize(url).encode('utf-8'))
+        path = self.locks.join(key[:2], key + '.lock')
+        path.dirpath().ensure(dir=True)
+        with acquire(path) as waited:
+            if waited:
+                log.debug('Waited for another fetch of: %s', normalize(url))
+            yield waited
+
+    def placement(self, dest, source):
+        """Where the manifest of the files placed at ``dest`` from the source
+           is kept.
+        """
+        text = '%s\0%s' % (os.path.realpath(str(dest)), source)
+        key = sha256(text.encode('utf-8'))
+        return self.placements.join(key[:2], key + '.json')
+
+    def index(self, key):
+        """Where an index of stored data, named by ``key``, is kept."""
+        return self.indexes.join(key[:2], key + '.json')
+
+    def tree(self, url):
+        """A directory kept for the URL, for sources that update their data
+           in place.
+        """
+        key = sha256(normalize(url).encode('utf-8'))
+        tree = self.trees.join(key).ensure(dir=True)
+        touch(tree)
+        return tree
+
+    def lookup(self, digest):
+        """The stored object with the given digest, or ``None``."""
+        if digest is None:
+            return None
+        obj = self.obj(digest)
+        if not obj.check(file=True):
+            return None
+        touch(obj)
+        log.debug('Store hit for digest: %s', digest)
+        return obj
+
+    def entry(self, url):
+        """Metadata stored for a URL, or ``None`` if there is no entry or the
+           data it references has been evicted.
+        """
+        path = self.entryname(url)
+        try:
+            with open(str(path)) as h:
+                entry = json.load(h)
+        except (IOError, OSError, ValueError):
+            return None
+        if not self.obj(entry['digest']).check(file=True):
+            return None
+        return entry
+
+    def get(self, url, dest):
+        """Places the data stored for the URL at ``dest``, returning the
+           entry metadata; or ``None`` if there is nothing in the store.
+        """
+        dest = py.path.local(dest)
+        entry = self.entry(url)
+        if entry is None:
+            return None
+        materialize(self.hit(url, entry), dest)
+        return entry
+
+    def path(self, url):
+        """The stored object for the URL, to be read in place; or ``None`` if
+           there is nothing in the store.
+        """
+        entry = self.entry(url)
+        return self.hit(url, entry) if entry is not None else None
+
+    def hit(self, url, entry):
+        obj = self.obj(entry['digest'])
+        touch(self.entryname(url), obj)
+        log.debug('Store hit for %s: %s', normalize(url), entry['digest'])
+        return obj
+
+    def digest(self, path):
+        """The digest of the file at ``path``, from its name if it is an object
+           in the store, or else by reading it.
+        """
+        return self.objectdigest(path) or filedigest(path)
+
+    def objectdigest(self, path):
+        """The digest of the file at ``path``, from its name, if it is an
+           object in the store; or ``None``.
+        """
+        path = py.path.local(os.path.realpath(str(path)))
+        if path.dirpath().dirpath() == self.objects:
+            return path.basename
+        return None
+
+    def unpacked(self, digest, fragment=None):
+        """Where the archive with the given digest is kept unpacked, as
+           selected by the fragment.
+        """
+        key = sha256(('%s#%s' % (digest, fragment or '')).encode('utf-8'))
+        return self.trees.join(key)
+
+    def put(self, url, path, digest=None, **meta):
+        """Adds the data at ``path`` to the store, under the given URL.
+
+        The ``digest`` of the data can be passed, when it is known, to spare
+        reading the data again. Additional keyword arguments are saved with
+        the entry and are returned by :meth:`entry` and :meth:`get`.
+        """
+        path = py.path.local(path)
+        digest = self.ingest(path, digest)
+        entry = dict(meta, url=normalize(url), digest=digest,
+                     size=path.size(), stored=time.time())
+        self.write(self.entryname(url), json.dumps(entry, sort_keys=True))
+        log.debug('Stored %s as: %s', entry['url'], digest)
+        if self.limit is not None and self.grown(entry['size']) > self.limit:
+            self.gc(self.limit)
+        return entry
+
+    def grown(self, n):
+        """The size of the store, as measured when it was last collected (or
+           first used) by this process, plus the ``n`` bytes just added and
+           those added before.
+        """
+        with self.sizing:
+            if self.estimate is None:
+                self.estimate = sum(size(p) for p in self.contents())
+            else:
+                self.estimate += n
+            return self.estimate
+
+    @contextmanager
+    def writing(self, url, expected=None, **meta):
+        """Yields a file to write the data for the URL to, which is added to
+           the store (as with :meth:`put`) if the block completes -- and if
+           the data has the ``expected`` digest, when one is given.
+        """
+        tmp = self.scratch()
+        try:
+            with open(str(tmp), 'wb') as h:
+                sink = Hashing(h)
+                try:
+                    yield sink
+                finally:
+                    sink.close()
+            digest = check(sink.hexdigest(), expected, normalize(url))
+            self.put(url, tmp, digest, **meta)
+        finally:
+            if tmp.check():
+                tmp.remove()
+
+    def ingest(self, path, digest=None):
+        """Copies the file at ``path`` into ``objects/``, returning its
+           digest.
+        """
+        digest = digest or filedigest(path)
+        obj = self.obj(digest)
+        if obj.check(file=True):
+            touch(obj)
+            return digest
+        tmp = self.scratch()
+        materialize(path, tmp)
+        os.chmod(str(tmp), 0o444)             # Links to objects are shared.
+        obj.dirpath().ensure(dir=True)
+        os.rename(str(tmp), str(obj))
+        return digest
+
+    def write(self, path, text):
+        tmp = self.scratch()
+        with open(str(tmp), 'w') as h:
+            h.write(text)
+        path.dirpath().ensure(dir=True)
+        os.rename(str(tmp), str(path))
+
+    def scratch(self):
+        """A fresh name under ``tmp/``, for writing data before it is moved
+           into place.
+        """
+        self.tmp.ensure(dir=True)
+        return self.tmp.join(uuid.uuid4().hex)
+
+    def stats(self):
+        entries = list(files(self.urls))
+        objects = list(files(self.objects))
+        trees = list(dirs(self.trees))
+        return dict(root=str(self.root),
+                    limit=self.limit,
+                    entries=len(entries),
+                    objects=len(objects),
+                    trees=len(trees),
+                    size=sum(size(p) for p in objects + trees))
+
+    def gc(self, limit=None):
+        """Evicts least recently used objects and trees until the store holds
+           no more than ``limit`` bytes, and removes entries for evicted
+           objects as well as abandoned partial downloads.
+
+        Returns the number of bytes freed.
+        """
+        items = [(p.mtime(), size(p), p) for p in self.contents()]
+        total = sum(n for _, n, _ in items)
+        freed = 0
+        for _, n, item in sorted(items):
+            if limit is None or total - freed <= limit:
+                break
+            if not item.check():           # The index of an evicted object.
+                continue
+            freed += n
+            log.debug('Evicting from store: %s', item.basename)
+            item.remove(rec=1)
+            index = self.index(item.basename)
+            if item.dirpath().dirpath() == self.objects and index.check():
+                freed += size(index)
+                index.remove()
+        with self.sizing:
+            self.estimate = total - freed
+        self.expire()
+        for path in files(self.urls):
+            try:
+                with open(str(path)) as h:
+                    digest = json.load(h)['digest']
+            except (IOError, OSError, ValueError, KeyError):
+                digest = None
+            if digest is None or not self.obj(digest).check(file=True):
+                path.remove()
+        return freed
+
+    def contents(self):
+        """The objects, trees and indexes, which make up the size of the
+           store.
+        """
+        return (list(files(self.objects)) + list(dirs(self.trees)) +
+                list(files(self.indexes)))
+
+    def expire(self):
+        """Removes partial downloads, placement manifests and locks that have
+           not been used for ``partial_ttl`` seconds.
+        """
+        cutoff = time.time() - self.partial_ttl
+        for path in list(files(self.partial)) + list(files(self.placements)):
+            if path.mtime() < cutoff:
+                path.remove()
+        for path in files(self.locks):
+            if path.mtime() < cutoff:
+                discard_lock(path)
+
+
+def normalize(url):
+    """Normalizes a URL for use as a store key.
+
+    The scheme and host are lowercased, default ports are dropped and the
+    fragment -- which selects from the data rather than identifying it -- is
+    discarded.
+    """
+    if not isinstance(url, uritools.SplitResult):
+        url = uritools.urisplit(str(url))
+    scheme = (url.scheme or '').lower()
+    host = url.gethost() or ''
+    host = (host if isinstance(host, str) else str(host)).lower()
+    port = url.getport()
+    if port is not None and default_ports.get(scheme) == port:
+        port = None
+    authority = host + ('' if port is None else ':%d' % port)
+    if url.userinfo is not None:
+        authority = url.userinfo + '@' + authority
+    return uritools.uriunsplit((scheme, authority, url.path or '/',
+                                url.query, None))
+
+
+default_ports = {'http': 80, 'https': 443}
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def filedigest(path, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def parse_digest(text):
+    """Parses a SHA-256 digest, given in hex and optionally prefixed with
+       ``sha256:``.
+    """
+    digest = text.strip().lower()
+    if digest.startswith('sha256:'):
+        digest = digest[len('sha256:'):]
+    if not re.match(r'^[0-9a-f]{64}$', digest):
+        raise BadDigest('Not a SHA-256 digest: %s' % text)
+    return digest
+
+
+def check(digest, expected, label):
+    """Returns the digest, if it is the one expected (or nothing is); and
+       otherwise raises :class:`Mismatch`.
+    """
+    if expected is not None and digest != expected:
+        raise Mismatch('Expected data with digest %s for %s but found: %s' %
+                       (expected, label, digest))
+    return digest
+
+
+def verify(path, expected, label):
+    """Checks the digest of the file at ``path``, returning it; or returns
+       ``None`` if nothing is expected.
+    """
+    if expected is None:
+        return None
+    return check(filedigest(path), expected, label)
+
+
+def materialize(src, dest):
+    """Puts the file at ``src`` at ``dest``, hardlinking where possible."""
+    src, dest = str(src), str(dest)
+    dest_dir = os.path.dirname(dest)
+    if dest_dir:
+        py.path.local(dest_dir).ensure(dir=True)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+@contextmanager
+def acquire(path):
+    """Holds an exclusive lock on the file at ``path`` (created if need be),
+       yielding ``True`` if it was held by another.
+
+    The file may be removed by :func:`discard_lock` while it is waited for;
+    then the lock is taken again, on the new file.
+    """
+    if fcntl is None:
+        with _thread_lock(str(path)) as waited:
+            yield waited
+        return
+    waited = False
+    while True:
+        h = open(str(path), 'a')
+        try:
+            fcntl.flock(h.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            waited = True
+            fcntl.flock(h.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(h.fileno()).st_ino == os.stat(str(path)).st_ino:
+                break
+        except OSError:
+            pass
+        h.close()
+    try:
+        os.utime(str(path), None)
+        yield waited
+    finally:
+        h.close()
+
+
+def discard_lock(path):
+    """Removes a lock file, unless it is held."""
+    if fcntl is None:
+        return
+    with open(str(path), 'a') as h:
+        try:
+            fcntl.flock(h.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return
+        os.remove(str(path))
+
+
+@contextmanager
+def _thread_lock(key):
+    with _locks_lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    waited = not lock.acquire(False)
+    if waited:
+        lock.acquire()
+    try:
+        yield waited
+    finally:
+        lock.release()
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def touch(*paths):
+    now = time.time()
+    for path in paths:
+        try:
+            os.utime(str(path), (now, now))
+        except OSError:
+            pass
+
+
+def files(under):
+    if not under.check(dir=True):
+        return
+    for path in under.visit(lambda p: p.check(file=True)):
+        yield path
+
+
+def dirs(under):
+    if not under.check(dir=True):
+        return
+    for path in under.listdir(lambda p: p.check(dir=True)):
+        yield path
+
+
+def size(path):
+    """Size of a file, or of all the files under a directory."""
+    if path.check(dir=True):
+        return sum(p.size() for p in files(path))
+    return path.size()
+
+
+def parse_size(text):
+    """Parses sizes like ``512M`` or ``10G`` into a number of bytes."""
+    text = str(text).strip().upper().rstrip('B')
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30, T=1 << 40)
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise BadSize('Not able to interpret as a size: %s' % text)
+
+
+def default_root():
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.environ.get('ARX_CACHE') or os.path.join(base, 'arx')
+
+
+def default_store():
+    """The store described by the environment.
+
+    ``ARX_CACHE`` overrides the location of the store (``off`` disables it)
+    and ``ARX_CACHE_LIMIT`` sets a size limit, like ``20G``.
+    """
+    root = default_root()
+    if root == 'off':
+        return None
+    limit = os.environ.get('ARX_CACHE_LIMIT')
+    return Store(root, parse_size(limit) if limit else None)
+
+
+def placement(dest, source):
+    """The manifest for placing the source at ``dest`` (see
+       :meth:`Store.placement`), or ``None`` if there is no store.
+    """
+    store = store_injector.store
+    return store.placement(dest, source) if store is not None else None
+
+
+@contextmanager
+def pinning(digest):
+    """Sets the digest the data of sources fetched in this thread must have,
+       for the duration of the block (see :func:`pinned`).
+    """
+    old = getattr(_pinned, 'digest', None)
+    _pinned.digest = parse_digest(digest) if digest is not None else None
+    try:
+        yield
+    finally:
+        _pinned.digest = old
+
+
+def pinned(source):
+    """The digest the data of the source must have: as set by
+       :func:`pinning` or, failing that, by a ``sha256`` query parameter in
+       its URL; or ``None``, if it is not pinned.
+
+    Data with the digest is used straight from the store, if it is there;
+    otherwise, data that is fetched is checked against it, and
+    :class:`Mismatch` is raised if it differs.
+    """
+    digest = getattr(_pinned, 'digest', None)
+    if digest is not None:
+        return digest
+    url = getattr(source, 'url', None)
+    query = url.getquerydict() if url is not None and url.query else {}
+    found = [v for v in query.get('sha256', []) if v]
+    return parse_digest(found[0]) if found else None
+
+
+_pinned = threading.local()
+
+
+@contextmanager
+def locked(store, url):
+    """Like :meth:`Store.lock`, but yields ``False`` when there is no store.
+    """
+    if store is None:
+        yield False
+        return
+    with store.lock(url) as waited:
+        yield waited
+
+
+@contextmanager
+def storing(store, url, expected=None, **meta):
+    """Like :meth:`Store.writing`, but yields a sink that only checks the
+       digest -- or, with nothing to check, ``None`` -- when there is no
+       store.
+    """
+    if store is None and expected is None:
+        yield None
+    elif store is None:
+        sink = Hashing()
+        try:
+            yield sink
+        finally:
+            sink.close()
+        check(sink.hexdigest(), expected, normalize(url))
+    else:
+        with store.writing(url, expected, **meta) as h:
+            yield h
+
+
+class StoreInjector(object):
+    """Provides the store used by sources, which can be swapped with a context
+       manager.
+
+    Unlike the interpreter injector, this does not hold the lock while a store
+    is in use, since sources consult the store from many threads at once.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._store = None
+        self._loaded = False
+
+    @property
+    def store(self):
+        with self.lock:
+            if not self._loaded:
+                self._store, self._loaded = default_store(), True
+            return self._store
+
+    @contextmanager
+    def using(self, store):
+        with self.lock:
+            old, loaded = self._store, self._loaded
+            self._store, self._loaded = store, True
+        try:
+            yield store
+        finally:
+            with self.lock:
+                self._store, self._loaded = old, loaded
+
+
+store_injector = StoreInjector()
+
+
+class BadSize(Err):
+    pass
+
+
+class BadDigest(Err):
+    pass
+
+
+class Mismatch(Err):
+    pass
@@ -15,11 +15,12 @@ def signature(*types, **kwtypes):
     def decorator(fn):
         @wraps(fn)
         def wrapped(self, *args, **kwargs):
-            args = [(arg if isinstance(arg, t) else conv(arg))
-                    for (t, conv), arg in zip(conversions, args)]
+            args = ([(arg if isinstance(arg, t) else conv(arg))
+                     for (t, conv), arg in zip(conversions, args)] +
+                    list(args[len(conversions):]))
             kwargs = {k: (v if isinstance(v, t) else conv(v))
                       for k, (t, conv), v
-                      in ((k, kwconversions[k], v)
+                      in ((k, kwconversions.get(k, (object, None)), v)
                           for k, v in kwargs.items())}
             return fn(self, *args, **kwargs)
 
@@ -0,0 +1,288 @@
+"""A read-through caching proxy, which serves the store to other hosts.
+
+When many hosts run the same manifests, each one fetching the same data from
+its origin multiplies the load on the origin (and the egress). Instead, one
+host can run ``arx cache serve`` and the others set ``ARX_PROXY`` to its
+address (see :func:`arx.util.httpclient.proxied`): HTTP/S and S3 data is then
+requested from the proxy, as ``/fetch?url=<url>``, and the proxy fetches it
+into its store -- once, however many hosts ask for it at the same time, since
+fetches hold the lock for the URL (see :meth:`arx.cache.Store.lock`).
+
+The proxy answers with the data, its digest as the ``ETag`` and -- for
+requests with a single byte range -- just the range asked for, so hosts can
+fetch large files in parallel segments and read members of indexed archives.
+Data that the proxy has fetched or revalidated within the last ``fresh``
+seconds is served without consulting the origin again; and a ``sha256``
+parameter pins the request to a digest (see :func:`arx.cache.pinned`).
+
+The proxy fetches whatever URLs its clients ask for, so it refuses origins on
+addresses that are not public -- its own host, its private network and the
+metadata services of cloud hosts -- and can be limited to URLs with the
+prefixes it is ``allow``-ed, which are fetched whatever their address (see
+:func:`check`).
+"""
+import ipaddress
+import os
+import re
+import socket
+import threading
+import time
+
+from magiclog import log
+import py.path
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlsplit
+import uritools
+
+from .cache import BadDigest, normalize, parse_digest, pinning
+from .cache import store_injector
+from .err import Err
+from .sources.http import HTTP, Invalid
+from .sources.s3 import S3
+from .util.httpclient import HTTPError, pool
+from .util.pool import causes
+from .util.tmp import tmpdir
+
+
+class Proxy(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves data from ``store``, fetching it from its origin as needed."""
+
+    daemon_threads = True
+
+    def __init__(self, address, store, fresh=60, allow=()):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.store = store
+        self.fresh = fresh
+        self.allow = list(allow)
+        self.lock = threading.Lock()
+        self.validated = {}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def resolve(self, url, digest=None):
+        """The stored object for the URL, fetched or revalidated unless that
+           was done within ``fresh`` seconds, and its digest.
+        """
+        self.check(url)
+        source = upstream(url)
+        with pinning(digest):
+            stored = self.store.lookup(digest)
+            if stored is None and not self.recent(source.base):
+                with tmpdir() as tmp:
+                    source.cache(py.path.local(tmp))
+                with self.lock:
+                    self.validated[normalize(source.base)] = time.time()
+        if digest is not None:
+            stored = self.store.lookup(digest)
+            return stored, digest
+        entry = self.store.entry(source.base)
+        if entry is None:
+            raise Evicted('Data for %s left the store while serving it.' % url)
+        return self.store.hit(source.base, entry), entry['digest']
+
+    def check(self, url):
+        check(url, self.allow)
+
+    def recent(self, url):
+        with self.lock:
+            at = self.validated.get(normalize(url))
+        return (at is not None and time.time() - at < self.fresh and
+                self.store.entry(url) is not None)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer(body=True)
+
+    def do_HEAD(self):
+        self.answer(body=False)
+
+    def answer(self, body=True):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path != '/fetch' or not query.get('url'):
+            return self.fail(404, 'Please ask for /fetch?url=<url>.')
+        try:
+            digest = (parse_digest(query['sha256'][0])
+                      if query.get('sha256') else None)
+            path, digest = self.server.resolve(query['url'][0], digest)
+        except Exception as e:
+            return self.fail(status(e), str(e))
+        etag = '"%s"' % digest
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        size = os.path.getsize(str(path))
+        span = None
+        if self.headers.get('If-Range') in (None, etag):
+            span = byterange(self.headers.get('Range'), size)
+        if span == ():
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        start, end = span or (0, size - 1)
+        self.send_response(206 if span else 200)
+        if span:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if body:
+            send(path, self.wfile, start, end - start + 1)
+
+    def fail(self, code, message):
+        log.warning('Answering %s with %d: %s', self.path, code, message)
+        data = (message + '\n').encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        log.debug('%s %s', self.client_address[0], fmt % args)
+
+
+def serve(store, host='127.0.0.1', port=8080, fresh=60, ready=None,
+          allow=()):
+    """Runs a :class:`Proxy` for the store -- which sources use while it
+       runs -- until interrupted, calling ``ready`` with it once it is
+       listening.
+    """
+    server = Proxy((host, port), store, fresh, allow)
+    if ready is not None:
+        ready(server)
+    pool.guard = server.check                    # Redirects are checked too.
+    try:
+        with store_injector.using(store):
+            server.serve_forever()
+    finally:
+        pool.guard = None
+        server.server_close()
+
+
+def check(url, allow=()):
+    """Raises :class:`Refused` unless the proxy may fetch the URL; returns
+       the address to fetch it from, if it was checked.
+
+    URLs that start with one of the ``allow``-ed prefixes, like
+    ``https://data.example.com/``, may be fetched. When no prefixes are
+    given, any URL may be -- except for HTTP/S URLs of hosts with addresses
+    that are not public (see :func:`internal`), which may only be allowed
+    explicitly. The host is resolved once, here, and the address that was
+    checked is the one to connect to; otherwise, the name could resolve to
+    another address by the time it is fetched.
+    """
+    if any(url.startswith(prefix) for prefix in allow):
+        return None
+    if allow:
+        raise Refused('Not allowed to proxy: %s' % url)
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        return None
+    try:
+        found = socket.getaddrinfo(parts.hostname, parts.port or 0, 0,
+                                   socket.SOCK_STREAM)
+    except (socket.error, UnicodeError) as e:
+        raise Refused('Not able to resolve the host of: %s (%s)' % (url, e))
+    addresses = [address[0] for family, _, _, _, address in found
+                 if family in (socket.AF_INET, socket.AF_INET6)]
+    if not addresses or any(internal(a) for a in addresses):
+        raise Refused('Not proxying a private or reserved address: %s' % url)
+    return addresses[0]
+
+
+def internal(address):
+    """True if the IP address is not a public one: loopback, link-local,
+       private, shared, reserved, multicast or unspecified addresses -- and
+       IPv6 addresses that map to such IPv4 addresses -- reach the proxy's
+       host, its network or nothing that should be fetched.
+    """
+    ip = ipaddress.ip_address(six.text_type(address.split('%')[0]))
+    ip = getattr(ip, 'ipv4_mapped', None) or ip
+    return (not ip.is_global or ip.is_private or ip.is_reserved or
+            ip.is_loopback or ip.is_link_local or ip.is_multicast or
+            ip.is_unspecified)
+
+
+def upstream(url):
+    """The source to fetch a proxied URL with: HTTP/S URLs and S3 objects
+       (but not directory-like S3 URLs) can be proxied.
+    """
+    parts = uritools.urisplit(url)
+    if parts.scheme in ('http', 'https'):
+        return HTTP(parts)
+    if parts.scheme == 's3' and not parts.path.endswith('/'):
+        return S3(parts)
+    raise Unproxied('Not able to proxy: %s' % url)
+
+
+def byterange(header, size):
+    """The inclusive span of a ``Range`` header with a single range: ``None``
+       if there is no such header (or it asks for many ranges) and ``()`` if
+       the range can not be satisfied.
+    """
+    found = re.match(r'bytes=(\d*)-(\d*)$', (header or '').strip())
+    if found is None or found.groups() == ('', ''):
+        return None
+    first, last = found.groups()
+    if first:
+        start, end = int(first), min(int(last or size - 1), size - 1)
+    else:                                    # A suffix, like ``bytes=-512``.
+        start, end = max(0, size - int(last)), size - 1
+    return (start, end) if start <= end and size > 0 else ()
+
+
+def send(path, stream, start, n, blocksize=1 << 20):
+    with open(str(path), 'rb') as h:
+        h.seek(start)
+        while n > 0:
+            block = h.read(min(blocksize, n))
+            if not block:
+                break
+            stream.write(block)
+            n -= len(block)
+
+
+def status(e):
+    """The status to answer with, for an error in serving the data: that of
+       the origin's answer, for client errors; 400, for requests that can not
+       be proxied; 403, for URLs that the proxy may not fetch; and otherwise
+       502.
+    """
+    if isinstance(e, (Unproxied, BadDigest, Invalid)):
+        return 400
+    if any(isinstance(cause, Refused) for cause in causes(e)):
+        return 403
+    for cause in causes(e):
+        code = getattr(cause, 'status', None)
+        if isinstance(cause, HTTPError) and code is not None and code < 500:
+            return code
+    return 502
+
+
+class Unproxied(Err):
+    pass
+
+
+class Evicted(Err):
+    pass
+
+
+class Refused(Err):
+    pass
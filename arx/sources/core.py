@@ -1,6 +1,9 @@
+import os
+
 import py.path
 import uritools
 
+from ..cache import filedigest
 from ..decorators import signature
 from ..inner.uritools import uridisplay
 
@@ -31,9 +34,36 @@ class Source(object):
     def place(self, cache, path):
         raise NotImplementedError()
 
+    def prefetch(self, cache):
+        """Fetches the data of the source into the persistent store (see
+           :mod:`arx.cache`), if there is one, so that it can later be placed
+           or run without going to the network.
+
+        By default, the source is cached.
+        """
+        self.cache(cache)
+
     def run(self, cache, args=[]):
         raise NotImplementedError()
 
+    @property
+    def pinnable(self):
+        """True if the data of the source can be pinned to a digest (see
+           :func:`arx.cache.pinning`), which it is checked against -- as it
+           can be for any source with a single file of data.
+        """
+        return True
+
+    def pin(self, cache):
+        """Resolves the source for a lockfile (see
+           :meth:`arx.bundle.Bundle.lock`), returning a dictionary with the
+           ``url`` to fetch the data from and -- for data that is a file --
+           its ``digest`` and ``size``.
+
+        By default, the source is locked as it is.
+        """
+        return dict(url=self.externalize())
+
     def externalize(self):
         """Provide a representation of a source in terms of simple data types:
            strings, lists and dictionaries.
@@ -58,6 +88,10 @@ class SourceURL(Source):
         return '%s(%r)' % (type(self).__name__, str(self))
 
     def __getattr__(self, name):
+        # Guards against recursion when ``url`` is not yet set, as happens
+        # when copying or unpickling.
+        if name == 'url' or name.startswith('__'):
+            raise AttributeError(name)
         return getattr(self.url, name)
 
     def externalize(self):
@@ -68,11 +102,17 @@ class SourceURL(Source):
         return cache.join('data')
 
 
+def pin_file(source, path):
+    """The lock entry for a source whose data is the file at ``path``."""
+    return dict(url=source.externalize(), size=os.path.getsize(str(path)),
+                digest='sha256:' + filedigest(path))
+
+
 class SignableURL(SourceURL):
     """URLs that can be signed to allow privileged access without granting
        credentials. For example, signing S3 URLs to get HTTP URLs."""
-    def sign(self):
-        """Returns a new signed ``Source``."""
+    def sign(self, seconds=3600):
+        """Returns a new signed ``Source``, which is usable for ``seconds``."""
         raise NotImplementedError()
 
 
@@ -2,13 +2,16 @@ import os
 
 from magiclog import log
 import py.path
-from sh import chmod, Command, cp, mkdir
+from sh import chmod, Command
 import uritools
 
+from ..cache import pinned, placement, verify
 from ..decorators import schemes
 from ..err import Err
+from ..util import linking
 from .core import DiskLocal, onepath, oneurl, SourceURL, twopaths
 from .tar import Tar
+from .zip import Zip
 
 
 class File(DiskLocal, SourceURL):
@@ -57,6 +60,10 @@ class File(DiskLocal, SourceURL):
     def dirlike(self):
         return self.url.path.endswith('/')
 
+    @property
+    def pinnable(self):
+        return not self.dirlike
+
     @property
     def home(self):
         """True if this file URL references home directory with ``~``."""
@@ -69,18 +76,24 @@ class File(DiskLocal, SourceURL):
 
     @onepath
     def cache(self, cache):
+        """Returns the source itself, once its data is checked against the
+           digest it is pinned to, if it is pinned.
+        """
+        expected = pinned(self)
+        if expected is not None:
+            if self.resolved.check(dir=True):
+                raise Invalid('Directories can not be pinned to a digest: '
+                              '%s' % self)
+            verify(self.resolved, expected, self)
         return self
 
     @twopaths
     def place(self, cache, path):
-        mkdir('-p', path.dirname)
-        src = str(self.resolved) + '/' if self.dirlike else str(self.resolved)
-        cp('-a', src, str(path))
+        linking.place(self.cache(cache).resolved, path, placement(path, self))
 
     @onepath
     def run(self, cache, args=[]):
-        if not True:
-            raise Invalid('Directories can not be run as commands.')
+        self.cache(cache)
         if not os.access(str(self.resolved), os.X_OK):
             if self.dot:
                 chmod('a+rx', str(self.resolved))
@@ -96,12 +109,25 @@ class FileTar(Tar, File):
     @schemes('tar+file')
     def __init__(self, url):
         self.url = url
+        self.resolved = py.path.local(handle_at_sign(url.path) or url.path)
 
     @classmethod
     def resolve(cls, ref):
         return cls(fileref(ref, pfx='tar+file:///'))
 
 
+class FileZip(Zip, File):
+    @oneurl
+    @schemes('zip+file')
+    def __init__(self, url):
+        self.url = url
+        self.resolved = py.path.local(handle_at_sign(url.path) or url.path)
+
+    @classmethod
+    def resolve(cls, ref):
+        return cls(fileref(ref, pfx='zip+file:///'))
+
+
 class Invalid(Err):
     pass
 
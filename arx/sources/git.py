@@ -1,8 +1,20 @@
-# from sh import Command, chmod, cp, curl, mkdir
-# import uritools
+from contextlib import contextmanager
+import os
+import re
+import tempfile
 
+from magiclog import log
+import py.path
+from sh import Command, ErrorReturnCode
+import uritools
+
+from ..cache import locked, placement, store_injector, touch
 from ..decorators import schemes
+from ..err import Err
+from ..util import linking
 from .core import onepath, oneurl, SourceURL, twopaths
+from .files import handle_at_sign
+from .tar import extract, keep
 
 
 class Git(SourceURL):
@@ -34,21 +46,303 @@ class Git(SourceURL):
     can point to repositories in home or the project directory using ``/@/~``
     or ``/@/.`` or ``/@/..``. To reference the Git repository local to the
     manifest, use: ``git+file:///@/.``.
+
+    Each remote is kept as a bare mirror in the store (see
+    :class:`~arx.cache.Store`), which is brought up to date with ``git
+    fetch`` -- transferring only new objects -- at most once per run, and not
+    at all when the ref is a SHA that is already there. Checkouts hard link
+    the objects of the mirror (with ``git clone --local``), so bundles that
+    use the same repository at different refs share one copy of its history
+    -- without depending on the mirror, which can be evicted from the store;
+    and a checkout placed again, in the same place, is updated in place.
+
+    Sources with a fragment are not mirrored. Instead, a shallow clone of
+    just the ref, without blobs (``--filter=blob:none``), is kept in the
+    store, with a sparse checkout of the fragment -- so only the blobs of the
+    selected files, at that ref, are transferred. (A ref that is an
+    abbreviated SHA can not be fetched by itself, so for those the whole
+    repository is mirrored.)
     """
 
     @oneurl
-    @schemes('git+file', 'git+https', 'git+https', 'git+ssh')
+    @schemes('git+file', 'git+http', 'git+https', 'git+ssh')
     def __init__(self, url):
         self.url = url
 
+    @property
+    def remote(self):
+        """The repository, as passed to ``git``."""
+        if self.url.scheme == 'git+file':
+            return handle_at_sign(self.url.path) or self.url.path
+        scheme = self.url.scheme.split('+')[-1]
+        return uritools.uriunsplit(self.url._replace(scheme=scheme, query=None,
+                                                     fragment=None))
+
+    @property
+    def pinnable(self):
+        """Checkouts are not a single file, so can not be pinned to a digest;
+           pin the ref to a SHA instead.
+        """
+        return False
+
+    @property
+    def ref(self):
+        """The branch, tag or SHA named by the query, or ``HEAD``."""
+        query = self.url.query
+        if not query:
+            return 'HEAD'
+        if '=' in query:
+            return self.url.getquerydict().get('ref', ['HEAD'])[0]
+        return uritools.uridecode(query)
+
+    @property
+    def key(self):
+        """The repository, as a URL under which to keep it in the store."""
+        if self.url.scheme == 'git+file':
+            return 'file://' + self.remote
+        return self.remote
+
     @onepath
     def cache(self, cache):
-        raise NotImplementedError()
+        """Brings the mirror of the repository up to date, returning it."""
+        store = store_injector.store
+        if store is None:
+            mirror = cache.join('mirror.git')
+        else:
+            mirror = store.tree(self.key)
+        with locked(store, self.key) as waited:
+            fresh = waited or str(mirror) in _fetched or self.pinned(mirror)
+            if not mirror.join('HEAD').check(file=True):
+                clone(self.remote, mirror, scratch=cache.join('cloning.git'))
+            elif not fresh:
+                log.debug('Fetching %s into: %s', self.remote, mirror)
+                git('-c', 'gc.auto=0', '--git-dir', str(mirror), 'fetch',
+                    '--quiet', '--prune', '--force', 'origin')
+            _fetched.add(str(mirror))
+        return mirror
+
+    def pinned(self, mirror):
+        """True if the ref is a SHA that is already in the mirror."""
+        if not mirror.join('HEAD').check(file=True):
+            return False
+        if not re.match(r'^[0-9a-f]{4,40}$', self.ref):
+            return False
+        found = commit(mirror, self.ref)
+        return found is not None and found.startswith(self.ref)
+
+    @onepath
+    def pin(self, cache):
+        """Locks the source to the SHA of the commit its ref names."""
+        if re.match(r'^[0-9a-f]{40}$', self.ref):
+            sha = self.ref
+        elif re.match(r'^[0-9a-f]{4,39}$', self.ref):
+            sha = commit(self.cache(cache), self.ref)
+        else:
+            sha = ls_remote(self.key, self.ref)
+        if sha is None:
+            raise NoSuchRef('No ref %s in %s.' % (self.ref, self.remote))
+        return dict(url=uritools.uriunsplit(self.url._replace(query=sha)))
+
+    @property
+    def sparse(self):
+        """True if the fragment is fetched with a sparse clone of the ref --
+           unless it selects the whole tree, as ``#/`` does.
+        """
+        return bool(self.url.fragment and self.url.fragment.strip('/') and
+                    not re.match(r'^[0-9a-f]{4,39}$', self.ref))
+
+    @onepath
+    def prefetch(self, cache):
+        if self.sparse:
+            with self.checkout_sparse(cache):
+                return
+        self.cache(cache)
 
     @twopaths
     def place(self, cache, path):
-        raise NotImplementedError()
+        if self.sparse:
+            with self.checkout_sparse(cache) as selected:
+                linking.place(selected, path, placement(path, self))
+            return
+        mirror = self.cache(cache)
+        sha = commit(mirror, self.ref)
+        if sha is None:
+            raise NoSuchRef('No ref %s in %s.' % (self.ref, self.remote))
+        if self.url.fragment:
+            export(mirror, sha, self.url.fragment, path,
+                   cache.join('fragment.tar'))
+        else:
+            checkout(mirror, sha, path)
+
+    @onepath
+    @contextmanager
+    def checkout_sparse(self, cache):
+        """Yields the fragment, checked out in a sparse, shallow and blobless
+           clone, which is kept as it is for the duration of the block.
+        """
+        name = self.url.fragment.strip('/')
+        key = '%s?sparse=%s' % (self.key,
+                                uritools.uriencode(name).decode('utf-8'))
+        store = store_injector.store
+        tree = cache.join('sparse') if store is None else store.tree(key)
+        with locked(store, key):
+            sparse(self.key, self.ref, name, tree)
+            selected = tree.join(name)
+            if not selected.check() or (self.url.fragment.endswith('/') and
+                                        not selected.check(dir=True)):
+                raise Invalid('No such directory in %s: %s' %
+                              (self.remote, self.url.fragment))
+            yield selected
 
     @onepath
     def run(self, cache, args=[]):
-        raise NotImplementedError()
+        if not self.url.fragment or self.url.fragment.endswith('/'):
+            raise Invalid('Directories can not be run as commands.')
+        cmd = cache.join('cmd')
+        with linking.using('copy'):      # Not a link into the store's tree.
+            self.place(cache, cmd)
+        cmd.chmod(cmd.stat().mode | 0o111)
+        Command(str(cmd))(*args)
+
+
+def git(*args, **kwargs):
+    return Command('git')(*args, **kwargs)
+
+
+def clone(remote, mirror, scratch):
+    """Creates a bare mirror of ``remote`` at ``mirror``.
+
+    Commits that are no longer reachable -- as when fetching drops the refs
+    that reached them -- can still be checked out by SHA (as lockfiles do),
+    so the mirror is never garbage collected.
+    """
+    log.debug('Mirroring %s in: %s', remote, mirror)
+    if scratch.check():
+        scratch.remove(rec=1)
+    git('clone', '--quiet', '--mirror', remote, str(scratch))
+    for k, v in [('gc.auto', '0'), ('gc.pruneExpire', 'never')]:
+        git('--git-dir', str(scratch), 'config', k, v)
+    if mirror.check(dir=True) and not mirror.listdir():
+        mirror.remove()
+    keep(scratch, mirror)
+
+
+def sparse(remote, ref, name, tree):
+    """Checks out the file or directory ``name``, at ``ref``, in a sparse,
+       shallow and blobless clone at ``tree``, fetching only the objects that
+       are not already there.
+    """
+    if not tree.join('.git', 'HEAD').check(file=True):
+        log.debug('Cloning %s sparsely in: %s', remote, tree)
+        git('init', '--quiet', str(tree))
+        for k, v in [('remote.origin.url', remote),
+                     ('remote.origin.promisor', 'true'),
+                     ('remote.origin.partialclonefilter', 'blob:none'),
+                     ('core.sparseCheckout', 'true')]:
+            git('-C', str(tree), 'config', k, v)
+    patterns = tree.join('.git', 'info', 'sparse-checkout')
+    patterns.write('/%s\n' % name, ensure=True)
+    sha = commit(tree, ref) if re.match(r'^[0-9a-f]{40}$', ref) else None
+    if sha is None:
+        git('-C', str(tree), 'fetch', '--quiet', '--depth', '1',
+            '--filter=blob:none', 'origin', ref)
+        sha = commit(tree, 'FETCH_HEAD')
+    git('-C', str(tree), 'checkout', '--quiet', '--force', '--detach', sha)
+
+
+def ls_remote(remote, ref):
+    """The SHA of the commit named by ``ref`` in the remote repository, found
+       without fetching anything; or ``None``.
+
+    Names are resolved as by ``git rev-parse``, with tags taking precedence
+    over branches.
+    """
+    found = {}
+    for line in str(git('ls-remote', remote, ref)).splitlines():
+        sha, _, name = line.partition('\t')
+        found[name.strip()] = sha.strip()
+    for name in [ref, 'refs/' + ref, 'refs/tags/%s^{}' % ref,
+                 'refs/tags/' + ref, 'refs/heads/' + ref]:
+        if name in found:
+            return found[name]
+    return None
+
+
+def commit(repository, ref):
+    """The SHA of the commit named by ``ref`` in the repository, or ``None``.
+    """
+    try:
+        found = git('-C', str(repository), 'rev-parse', '--quiet', '--verify',
+                    ref + '^{commit}')
+    except ErrorReturnCode:
+        return None
+    return str(found).strip() or None
+
+
+def export(mirror, sha, fragment, path, archive):
+    """Writes the files selected by the fragment at ``path``, without a
+       checkout, by way of an archive of the commit.
+
+    Fragments are interpreted as for :class:`~arx.sources.tar.Tar`, except
+    that a fragment naming a directory selects it, with or without a trailing
+    ``/``.
+    """
+    name = fragment.strip('/')
+    if name and not fragment.endswith('/'):
+        kind = git('--git-dir', str(mirror), 'cat-file', '-t',
+                   '%s:%s' % (sha, name), _ok_code=[0, 128])
+        if str(kind).strip() == 'tree':            # Like ``#nginx``.
+            fragment += '/'
+    archive.dirpath().ensure(dir=True)
+    git('--git-dir', str(mirror), 'archive', '--format=tar', '--prefix=x/',
+        '-o', str(archive), sha, '--', name or '.')
+    with open(str(archive), 'rb') as h:
+        extract(h, path, 'x/' + fragment.lstrip('/'))
+
+
+def checkout(mirror, sha, path):
+    """Checks out the commit at ``path``, in a clone of the mirror that hard
+       links its objects (or copies them, across filesystems), so that the
+       checkout does not depend on the mirror.
+
+    A checkout already at ``path`` that was cloned from the same mirror is
+    brought up to date from it and moved to the commit, like any other
+    working copy; so local changes that conflict with the commit cause the
+    checkout to fail. Otherwise, ``path`` need not be empty -- as when other
+    sources are placed in the same directory -- and files in it are
+    overwritten by those of the commit.
+    """
+    path, origin = py.path.local(path), os.path.realpath(str(mirror))
+    ours = path.join('.git').check(dir=True) and str(git(
+        '-C', str(path), 'config', 'arx.mirror', _ok_code=[0, 1]
+    )).strip() == origin
+    if ours and commit(path, sha) is None:
+        git('-C', str(path), 'fetch', '--quiet', origin, '+refs/*:refs/arx/*')
+    cloned = not ours or commit(path, sha) is None
+    if cloned:
+        path.ensure(dir=True)
+        scratch = py.path.local(tempfile.mkdtemp(prefix='.arx-clone-',
+                                                 dir=str(path)))
+        try:
+            git('clone', '--quiet', '--local', '--no-checkout', origin,
+                str(scratch))
+            git('-C', str(scratch), 'config', 'arx.mirror', origin)
+            if path.join('.git').check():
+                path.join('.git').remove(rec=1)
+            scratch.join('.git').move(path.join('.git'))
+        finally:
+            scratch.remove(rec=1)
+    git('-C', str(path), 'checkout', '--quiet', '--detach',
+        *(['--force', sha] if cloned else [sha]))
+    touch(mirror)
+
+
+_fetched = set()
+
+
+class Invalid(Err):
+    pass
+
+
+class NoSuchRef(Err):
+    pass
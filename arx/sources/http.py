@@ -1,12 +1,23 @@
-from sh import Command, chmod, curl, mkdir
+from contextlib import contextmanager
+import re
+
+from magiclog import log
+from sh import Command, chmod
 import uritools
 
+from ..cache import locked, materialize, pinned, placement, store_injector
+from ..cache import storing, verify
 from ..decorators import schemes
 from ..err import Err
-from .files import File, FileTar
+from ..util import linking, ranged
+from ..util.httpclient import HTTPError, pool, proxied
+from ..util.tarindex import Index, Unindexable
+from ..util.transfer import Tee, validator
+from .files import File, FileTar, FileZip
 from .jar import Jar
-from .core import onepath, oneurl, SourceURL, twopaths
-from .tar import Tar
+from .core import onepath, oneurl, pin_file, SourceURL, twopaths
+from .tar import byterange, matches, sidecar_suffix, Tar, write_member
+from .zip import Zip
 
 
 class HTTP(SourceURL):
@@ -14,6 +25,9 @@ class HTTP(SourceURL):
 
     The URL can contain query parameters (``?...``) but not a fragment
     (``#...``). All HTTP URLs are treated as having file nature.
+
+    When ``ARX_PROXY`` is set, data is requested from that caching proxy
+    rather than from the origin (see :mod:`arx.proxy`).
     """
 
     @oneurl
@@ -29,30 +43,76 @@ class HTTP(SourceURL):
         # Allows subclasses to inherit this implementation by throwing away the
         # prefix.
         scheme = self.url.scheme.split('+')[-1]
-        return self.url._replace(scheme=scheme, fragment=None)
+        return self.url._replace(scheme=scheme, query=unpinned(self.url.query),
+                                 fragment=None)
 
     @twopaths
-    def retrieve(self, headers, path):
-        # TODO: If `curl` is not present, use urllib.
-        curl('-sSfL', uritools.uriunsplit(self.base),
-             '-D', str(headers), '-o', str(path))
+    def retrieve(self, headers, path, conditions={}):
+        """Downloads the body to ``path`` and the response headers to
+           ``headers``, returning the HTTP status.
+
+        The ``conditions`` are sent as request headers, to allow for
+        conditional requests. When the server answers ``304 Not Modified``,
+        nothing is written to ``path``.
+        """
+        url = proxied(uritools.uriunsplit(self.base), pinned(self))
+        store = store_injector.store
+        part = store.partname(self.base) if store is not None else None
+        status, found = pool.download(url, path, headers=conditions, part=part)
+        with open(str(headers), 'w') as h:
+            h.write('HTTP/1.1 %d\r\n' % status)
+            for k, v in sorted(found.items()):
+                h.write('%s: %s\r\n' % (k, v))
+        return status
 
     @onepath
     def cache(self, cache):
         headers, body = cache.join('headers'), self.dataname(cache)
-        self.retrieve(headers, body)
+        store, expected = store_injector.store, pinned(self)
+        with locked(store, self.base) as waited:
+            if store is not None and store.lookup(expected) is not None:
+                materialize(store.obj(expected), body)
+                return File('file:///' + str(body))
+            # Stored data for a pinned source is not what was expected, so it
+            # is not used.
+            entry = (store.entry(self.base)
+                     if store is not None and expected is None else None)
+            # If another process has just fetched it, the stored data is
+            # trusted; otherwise it is revalidated -- or, with nothing to
+            # revalidate with, fetched again. Stored data can be evicted
+            # (by another process) meanwhile, and is then fetched again.
+            if entry is not None and waited and \
+                    store.get(self.base, body) is not None:
+                return File('file:///' + str(body))
+            status = self.retrieve(headers, body, conditions(entry or {}))
+            if status == 304 and store.get(self.base, body) is not None:
+                log.debug('Not modified, using stored data for: %s', self)
+                return File('file:///' + str(body))
+            if status == 304:
+                log.debug('Stored data was evicted, fetching again: %s', self)
+                self.retrieve(headers, body, {})
+            digest = verify(body, expected, self)
+            if store is not None:
+                store.put(self.base, body, digest,
+                          **validators(read_headers(headers)))
         return File('file:///' + str(body))
 
+    @onepath
+    def pin(self, cache):
+        return pin_file(self, self.cache(cache).resolved)
+
     @twopaths
     def place(self, cache, path):
-        mkdir('-p', path.dirname)
-        self.retrieve('/dev/null', path)
+        linking.place(self.cache(cache).resolved, path, placement(path, self))
 
     @onepath
     def run(self, cache, args=[]):
-        body = self.dataname(cache)
-        chmod('a+rx', str(body))
-        cmd = Command(str(body))
+        # The body may be a link to an object in the store, which must not be
+        # changed; so a copy is made executable.
+        body, program = self.cache(cache).resolved, cache.join('program')
+        linking.copy(str(body), str(program))
+        chmod('a+rx', str(program))
+        cmd = Command(str(program))
         cmd(*args)
 
 
@@ -74,6 +134,133 @@ class HTTPTar(Tar, HTTP):
         as_file = super(HTTPTar, self).cache(cache)
         return FileTar.resolve(as_file.resolved)
 
+    @onepath
+    def fetch_member(self, path):
+        store = store_injector.store
+        if self.member is None or pinned(self) is not None or (
+                store is not None and store.entry(self.base) is not None):
+            return False
+        index = self.sidecar()
+        extent = index.extent(self.member) if index is not None else None
+        if extent is None:
+            return False
+        url = proxied(uritools.uriunsplit(self.base))
+        with pool.request('GET', url, {'Range': byterange(extent)}) as reply:
+            found = reply.getheader('content-range')
+            if reply.status != 206 or not matches(index, extent, found):
+                log.warning('Not able to use the index for %s; fetching the '
+                            'whole archive.', self)
+                return False
+            write_member(index.read(reply, self.member), path)
+            reply.read()
+        log.debug('Fetched %s with the index.', self)
+        return True
+
+    def sidecar(self):
+        """The index published next to the archive, or ``None``."""
+        base = self.base
+        url = proxied(uritools.uriunsplit(base._replace(path=base.path +
+                                                        sidecar_suffix)))
+        try:
+            with pool.request('GET', url) as response:
+                return Index.parse(response.read().decode('utf-8'))
+        except (HTTPError, Unindexable) as e:
+            log.debug('No index for %s: %s', self, e)
+            return None
+
+    @onepath
+    @contextmanager
+    def stream(self, cache):
+        # The body is unpacked as it arrives, and copied into the store on the
+        # way, unless the stored data can be used.
+        store, expected = store_injector.store, pinned(self)
+        with locked(store, self.base) as waited:
+            stored = store.lookup(expected) if store is not None else None
+            entry = (store.entry(self.base)
+                     if store is not None and expected is None else None)
+            if stored is None and entry is not None and waited:
+                stored = store.path(self.base)
+            url = proxied(uritools.uriunsplit(self.base), expected)
+            # Data that is not modified, but was evicted meanwhile (by another
+            # process), is fetched again.
+            for headers in ([conditions(entry or {}), {}] if stored is None
+                            else []):
+                with pool.request('GET', url, headers) as response:
+                    if response.status != 304:
+                        found = dict((k.lower(), v)
+                                     for k, v in response.getheaders())
+                        length = int(found.get('content-length') or -1)
+                        with storing(store, self.base, expected,
+                                     **validators(found)) as sink:
+                            tee = Tee(response, sink, length)
+                            yield tee
+                            tee.drain()
+                        return
+                    response.read()
+                stored = store.path(self.base)
+                if stored is not None:
+                    break
+        log.debug('Using stored data for: %s', self)
+        with open(str(stored), 'rb') as h:
+            yield h
+
+
+class HTTPZip(Zip, HTTP):
+    """Links to zip archives available over HTTP/S.
+
+    These URLs have directory nature unless a fragment is passed, as described
+    under :class:`~arx.sources.zip.Zip`.
+    """
+
+    @oneurl
+    @schemes('zip+http', 'zip+https')
+    def __init__(self, url):
+        self.url = url
+
+    @onepath
+    def cache(self, cache):
+        as_file = super(HTTPZip, self).cache(cache)
+        return FileZip.resolve(as_file.resolved)
+
+    @onepath
+    @contextmanager
+    def archive(self, cache):
+        store = store_injector.store
+        stored = store is not None and store.entry(self.base) is not None
+        remote = None
+        # Data read piecemeal can not be checked against a pinned digest.
+        if self.url.fragment is not None and not stored and \
+                pinned(self) is None:
+            remote = self.ranged()
+        if remote is None:
+            with super(HTTPZip, self).archive(cache) as h:
+                yield h
+            return
+        with remote:
+            yield remote
+
+    def ranged(self, tail=64 << 10):
+        """The archive as a file that is read with range requests, or
+           ``None`` if the server does not honor them.
+
+        The last ``tail`` bytes, which hold the directory of a zip archive
+        (unless it is very large), are fetched at once.
+        """
+        url = proxied(uritools.uriunsplit(self.base))
+        with pool.request('GET', url, {'Range': 'bytes=-%d' % tail}) as reply:
+            found = re.match(r'bytes \d+-\d+/(\d+)$',
+                             reply.getheader('content-range') or '')
+            if reply.status != 206 or found is None:
+                log.debug('No range requests for: %s', self)
+                return None
+            data = reply.read()
+        tag = validator(dict((k.lower(), v) for k, v in reply.getheaders()))
+
+        def fetch(start, end):
+            return pool.read_range(reply.url, start, end, tag)
+
+        return ranged.opened(fetch, int(found.group(1)), data)
+
 
 class HTTPJar(Jar, HTTP):
     @oneurl
@@ -86,3 +273,50 @@ class HTTPJar(Jar, HTTP):
 
 class Invalid(Err):
     pass
+
+
+def unpinned(query):
+    """The query, without the ``sha256`` parameter that pins the data (see
+       :func:`arx.cache.pinned`), which is not passed on to the server.
+    """
+    if not query:
+        return query
+    kept = [p for p in query.split('&') if p.split('=')[0] != 'sha256']
+    return '&'.join(kept) if kept else None
+
+
+def read_headers(path):
+    """Reads a header dump, as written by ``retrieve``, returning the headers
+       of the final response (following redirects) with lowercased names.
+    """
+    try:
+        with open(str(path)) as h:
+            text = h.read()
+    except (IOError, OSError):
+        return {}
+    headers = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('HTTP/'):                  # A new response begins.
+            headers = {}
+            continue
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def validators(headers):
+    """Picks out the headers that allow a response to be revalidated, for
+       storage with a cache entry.
+    """
+    found = dict(etag=headers.get('etag'),
+                 last_modified=headers.get('last-modified'))
+    return dict((k, v) for k, v in found.items() if v)
+
+
+def conditions(entry):
+    """Request headers for revalidating a stored entry."""
+    found = {'If-None-Match': entry.get('etag'),
+             'If-Modified-Since': entry.get('last_modified')}
+    return dict((k, v) for k, v in found.items() if v)
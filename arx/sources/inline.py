@@ -1,22 +1,33 @@
 from base64 import b64decode, b64encode
 from collections import Container, Mapping, OrderedDict, Sequence
+import io
 import math
+import os
+import tarfile
 
-from sh import chmod, Command, mkdir, tar
+from sh import chmod, Command, mkdir
 import six
 
+from ..cache import check, pinned, sha256
 from ..decorators import signature
 from ..err import Err
 from .core import onepath, Source, twopaths
+from .jar import Jar
+from .tar import extract
 
 
 class Inline(Source):
     @onepath
     def cache(self, cache):
+        self.verify()
         body = cache.join('data')
-        with open(body, 'w') as h:
+        with open(str(body), 'wb') as h:
             h.write(self.data)
 
+    def verify(self):
+        """Checks the data against the digest it is pinned to, if any."""
+        check(sha256(self.data), pinned(self), repr(self))
+
 
 class InlineText(Inline):
     @signature(str)
@@ -27,8 +38,9 @@ class InlineText(Inline):
 
     @twopaths
     def place(self, cache, path):
+        self.verify()
         mkdir('-p', path.dirname)
-        with open(str(path), 'w') as h:
+        with open(str(path), 'wb') as h:
             h.write(self.data)
 
     @onepath
@@ -61,8 +73,9 @@ class InlineBinary(Inline):
 
     @twopaths
     def place(self, cache, path):
+        self.verify()
         mkdir('-p', path.dirname)
-        with open(str(path), 'w') as h:
+        with open(str(path), 'wb') as h:
             h.write(self.data)
 
     @onepath
@@ -90,10 +103,8 @@ class InlineTarGZ(InlineBinary):
 
     @twopaths
     def place(self, cache, path):
-        mkdir('-p', path)
-        tar('-xz', '-C', str(path), _in=self.data)
-        with open(str(path), 'w') as h:
-            h.write(self.data)
+        self.verify()
+        extract(io.BytesIO(self.data), path)
 
     def externalize(self):
         para = super(InlineTarGZ, self).externalize()['base64']
@@ -118,6 +129,10 @@ class InlineCollection(Inline):
     def __init__(self, collection):
         self.collection = collection
 
+    @property
+    def pinnable(self):
+        return False
+
     @twopaths
     def place(self, _cache, path):
         InlineCollection.unpack_collection(path, self.collection)
@@ -157,6 +172,33 @@ class InlineCollection(Inline):
         InlineCollection.unpack_pairs(under, pairs)
 
 
+@onepath
+def inline(source, cache):
+    """The data of ``source`` as an inline source, placed under ``cache`` to
+       read it: a gzipped tarball, for data with directory nature; a jar, for
+       Jars; and binary data otherwise.
+    """
+    if isinstance(source, Inline):
+        return source
+    path = cache.join('inline')
+    source.place(cache.join('placing').ensure(dir=True), path)
+    if path.check(dir=True):
+        return InlineTarGZ(tgz(path))
+    cls = InlineJar if isinstance(source, (Jar, InlineJar)) else InlineBinary
+    return cls(path.read_binary())
+
+
+def tgz(path):
+    """The directory at ``path`` as a gzipped tarball, without the directory
+       itself.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as archive:
+        for name in sorted(os.listdir(str(path))):
+            archive.add(os.path.join(str(path), name), arcname=name)
+    return data.getvalue()
+
+
 class UnhandledCollection(Err):
     pass
 
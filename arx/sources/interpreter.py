@@ -8,9 +8,12 @@ import uritools
 from ..err import Err
 from ..inner.uritools import uridisplay
 from .core import Source
-from .http import HTTP, HTTPJar, HTTPTar
+from .files import File, FileTar, FileZip
+from .git import Git
+from .http import HTTP, HTTPJar, HTTPTar, HTTPZip
 from .inline import InlineBinary, InlineJar, InlineTarGZ, InlineText
-from .s3 import S3, S3Jar, S3Tar
+from .pack import Pack
+from .s3 import S3, S3Jar, S3Tar, S3Zip
 
 
 class Interpreter(object):
@@ -56,12 +59,19 @@ class Interpreter(object):
 
 default = Interpreter(
     uri_handlers=[
+        ('file', File),
+        ('tar+file', FileTar),
+        ('zip+file', FileZip),
         (re.compile('https?'), HTTP),
         (re.compile('jar[+]https?'), HTTPJar),
         (re.compile('tar[+]https?'), HTTPTar),
+        (re.compile('zip[+]https?'), HTTPZip),
         (re.compile('s3'), S3),
         (re.compile('jar[+]s3'), S3Jar),
-        (re.compile('tar[+]s3'), S3Tar)
+        (re.compile('tar[+]s3'), S3Tar),
+        (re.compile('zip[+]s3'), S3Zip),
+        (re.compile('git[+](file|https?|ssh)'), Git),
+        ('pack+file', Pack)
     ],
     data_handlers=[
         ('text', InlineText),
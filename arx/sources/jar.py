@@ -11,8 +11,9 @@ class Jar(object):
     """
     @onepath
     def run(self, cache, args=[]):
+        jar = self.cache(cache).resolved
         cmd = Command('java')
-        cmd('-jar', str(self.dataname(cache)), *args)
+        cmd('-jar', str(jar), *args)
 
     @onepath
     def dataname(self, cache):
@@ -0,0 +1,72 @@
+import os
+
+import py.path
+from sh import Command
+
+from ..decorators import schemes
+from ..err import Err
+from ..util import packfile
+from .core import DiskLocal, onepath, oneurl, SourceURL, twopaths
+from .files import handle_at_sign
+
+
+class Pack(DiskLocal, SourceURL):
+    """Entries of packs (see :mod:`arx.util.packfile`) as Arx sources.
+
+    The fragment names the entry, which is a file -- that can be run, with
+    ``java -jar`` if it was packed from a Jar -- or a directory:
+
+    .. code::
+
+        pack+file:///@/./bundle.pack#data/0
+
+    As for :class:`~arx.sources.files.File`, the path can start with ``/@/.``
+    or ``/@/~``. Files are written straight from a memory map of the pack,
+    which is opened once however many entries are placed from it.
+
+    Packs are written by :meth:`arx.bundle.Bundle.pack` (and ``arx pack``),
+    which places every source of a bundle and replaces it with a ``Pack``.
+    """
+
+    @oneurl
+    @schemes('pack+file')
+    def __init__(self, url):
+        if url.authority != '':
+            raise Invalid('Arx can not work with non-local pack URLs.')
+        if not url.fragment:
+            raise Invalid('Please name an entry of the pack in the fragment.')
+        self.url = url
+        self.resolved = py.path.local(handle_at_sign(url.path) or url.path)
+
+    @property
+    def pinnable(self):
+        return False
+
+    @property
+    def entry(self):
+        return packfile.load(self.resolved).entry(self.url.fragment)
+
+    @onepath
+    def cache(self, cache):
+        return self
+
+    @twopaths
+    def place(self, cache, path):
+        packfile.load(self.resolved).place(self.url.fragment, path)
+
+    @onepath
+    def run(self, cache, args=[]):
+        kind = self.entry['kind']
+        if kind == 'tree':
+            raise Invalid('Directories can not be run as commands.')
+        cmd = cache.join('data.jar' if kind == 'jar' else 'cmd')
+        self.place(cache, cmd)
+        if kind == 'jar':
+            Command('java')('-jar', str(cmd), *args)
+            return
+        os.chmod(str(cmd), cmd.stat().mode | 0o111)
+        Command(str(cmd))(*args)
+
+
+class Invalid(Err):
+    pass
@@ -1,14 +1,32 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
 import boto3
-from sh import Command, chmod, cp, mkdir, rsync, ErrorReturnCode
+from botocore.exceptions import BotoCoreError, ClientError
+from magiclog import log
+import py.path
+from sh import Command, chmod
 import uritools
 
+from ..cache import locked, materialize, pinned, placement, sha256
+from ..cache import store_injector, storing, verify
 from ..decorators import schemes
 from ..err import Err
-from .files import File, FileTar
-from .http import HTTP, HTTPTar, HTTPJar
+from ..util import linking, ranged
+from ..util.httpclient import pool, proxied, proxy
+from ..util.pool import causes, concurrently
+from ..util.tarindex import Index, Unindexable
+from ..util.transfer import chunks, retrying, Tee, transient, Transfer
+from .files import File, FileTar, FileZip
+from .http import HTTP, HTTPJar, HTTPTar, HTTPZip
 from .jar import Jar
-from .core import onepath, oneurl, SignableURL, twopaths
-from .tar import Tar
+from .core import onepath, oneurl, pin_file, SignableURL, twopaths
+from .tar import byterange, inside, matches, sidecar_suffix, Tar
+from .tar import write_member
+from .zip import Zip
 
 
 class S3(SignableURL):
@@ -16,6 +34,17 @@ class S3(SignableURL):
 
     The URL can end with a ``/`` to give it directory nature; otherwise it has
     file nature. With directory nature, the directory is unpacked recursively.
+
+    The region and the profile used to access S3 can be set with query
+    parameters, as in ``s3://bucket/key?region=eu-west-1&profile=ci``; by
+    default, they are drawn from the environment.
+
+    Objects kept in the store are revalidated, with a ``HEAD`` request, and
+    fetched again only if their ETag has changed.
+
+    When ``ARX_PROXY`` is set, objects (but not directory-like URLs) are
+    fetched whole through that caching proxy, with its credentials (see
+    :mod:`arx.proxy`).
     """
 
     @oneurl
@@ -30,6 +59,10 @@ class S3(SignableURL):
     def dirlike(self):
         return self.url.path.endswith('/')
 
+    @property
+    def pinnable(self):
+        return not self.dirlike
+
     @property
     def base(self):
         # Allows subclasses to inherit this implementation by throwing away the
@@ -40,38 +73,160 @@ class S3(SignableURL):
     def signed_get(self, seconds=3600):
         if self.dirlike:
             raise Invalid('Not able to sign directory-like S3 URLs.')
-        data = dict(Bucket=self.url.host, Key=self.url.path)
-        s3 = boto3.client('s3')
-        link = s3.generate_presigned_url('get_object', data, ExpiresIn=seconds)
-        return link
+        return presign(self.url.host, self.key, seconds, **self.options)
 
-    def sign(self):
-        return HTTP(self.signed_get())
+    def sign(self, seconds=3600):
+        return HTTP(self.signed_get(seconds))
+
+    @property
+    def key(self):
+        return self.url.path[1:]
+
+    @property
+    def options(self):
+        """The region and profile to use, from the query string."""
+        query = self.url.getquerydict()
+        return dict((k, query[k][-1]) for k in ['region', 'profile']
+                    if query.get(k))
+
+    @property
+    def client(self):
+        return client(**self.options)
 
     @onepath
     def cache(self, cache):
         data = self.dataname(cache)
-        cmd = Command('aws')
-        sub = 'sync' if self.dirlike else 'cp'
-        cmd('s3', sub, uritools.uriunsplit(self.base), str(data))
+        if self.dirlike:
+            store = store_injector.store
+            if store is not None:
+                # Kept in the store, and updated from one run to the next.
+                tree = store.tree(self.base)
+                data = tree.join('data')
+                with store.lock(self.base):
+                    self.sync(data, tree.join('manifest.json'))
+            else:
+                self.sync(data)
+            return File('file:///' + str(data) + '/')
+        store, expected = store_injector.store, pinned(self)
+        with locked(store, self.base) as waited:
+            if store is not None and store.lookup(expected) is not None:
+                materialize(store.obj(expected), data)
+                return File('file:///' + str(data))
+            stored, etag, size = self.current(store, expected, waited)
+            if stored is not None:
+                materialize(stored, data)
+                return File('file:///' + str(data))
+            part = store.partname(self.base) if store is not None else None
+            if proxy() is not None:
+                pool.download(proxied(uritools.uriunsplit(self.base),
+                                      expected), data, part=part)
+            else:
+                download(self.url.host, self.key, data, part, etag=etag,
+                         length=size, s3=self.client)
+            digest = verify(data, expected, self)
+            if store is not None:
+                store.put(self.base, data, digest, etag=etag)
         return File('file:///' + str(data))
 
+    def current(self, store, expected=None, waited=False):
+        """The stored object for the URL, if it is still current, and the ETag
+           and size of the object -- which are only asked for when there is a
+           store to revalidate with or to record them in.
+
+        The stored object is current if another process has just fetched it
+        (as when it was ``waited`` for), or if its ETag is unchanged. Sources
+        pinned to a digest use the store only by digest.
+        """
+        if store is None or expected is not None:
+            return None, None, None
+        entry = store.entry(self.base)
+        if entry is not None and waited:
+            return store.hit(self.base, entry), entry.get('etag'), None
+        etag, size = self.head()
+        if entry is not None and entry.get('etag') == etag:
+            log.debug('Not modified, using stored data for: %s', self)
+            return store.hit(self.base, entry), etag, size
+        return None, etag, size
+
+    def head(self):
+        """The ETag and size of the object -- as the caching proxy has it, if
+           there is one.
+        """
+        if proxy() is None:
+            found = self.client.head_object(Bucket=self.url.host,
+                                            Key=self.key)
+            return found['ETag'], found['ContentLength']
+        url = proxied(uritools.uriunsplit(self.base))
+        with pool.request('HEAD', url) as response:
+            return (response.getheader('etag'),
+                    int(response.getheader('content-length')))
+
+    def sync(self, path, manifest=None, jobs=16):
+        """Brings ``path`` up to date with the objects under a directory-like
+           URL's prefix.
+
+        When a ``manifest`` file is given, it records the ETag and size of
+        every object that has been downloaded. Only objects that are new or
+        have changed since are downloaded, and files for objects that are no
+        longer present are deleted.
+        """
+        path = py.path.local(path).ensure(dir=True)
+        old = load_manifest(manifest)
+        new = dict((name, meta) for name, meta in
+                   listing(self.url.host, self.key, jobs=jobs,
+                           s3=self.client).items() if within(path, name))
+        for name in [name for name in old if name not in new]:
+            prune(path, name)
+        wanted = [name for name, meta in sorted(new.items())
+                  if old.get(name) != meta or
+                  not path.join(name).check(file=True)]
+        done = dict((name, meta) for name, meta in old.items()
+                    if name in new and name not in wanted)
+        log.debug('Syncing %d of %d objects from: %s',
+                  len(wanted), len(new), self)
+        lock = threading.Lock()
+
+        def fetch(name):
+            dest = path.join(name)
+            part = None
+            if manifest is not None:
+                part = py.path.local(manifest).dirpath().join(
+                    'partial', sha256(name.encode('utf-8')) + '.part'
+                )
+                part.dirpath().ensure(dir=True)
+            download(self.url.host, self.key + name, dest, part,
+                     etag=new[name]['etag'], length=new[name]['size'],
+                     s3=self.client)
+            with lock:
+                done[name] = new[name]
+
+        try:
+            concurrently(fetch, wanted, jobs=jobs)
+        finally:
+            if manifest is not None:
+                save_manifest(manifest, done)
+
+    @onepath
+    def pin(self, cache):
+        if self.dirlike:
+            return super(S3, self).pin(cache)
+        return pin_file(self, self.cache(cache).resolved)
+
     @twopaths
     def place(self, cache, path):
-        mkdir('-p', path.dirname)
-        if self.dirlike:
-            rsync('-ai', str(self.data(cache)) + '/', str(path))
-        else:
-            cp(str(self.data(cache)), str(path))
+        linking.place(self.cache(cache).resolved, path, placement(path, self))
 
     @onepath
     def run(self, cache, args=[]):
         if self.dirlike:
             raise Invalid('Arx can not run directory-like (ending with `/`) '
                           'S3 paths.')
-        item = self.data(cache)
-        chmod('a+rx', str(item))
-        cmd = Command(str(item))
+        # The object may be a link to an object in the store, which must not
+        # be changed; so a copy is made executable.
+        item, program = self.cache(cache).resolved, cache.join('program')
+        linking.copy(str(item), str(program))
+        chmod('a+rx', str(program))
+        cmd = Command(str(program))
         cmd(*args)
 
 
@@ -97,8 +252,135 @@ class S3Tar(Tar, S3):
         as_file = super(S3Tar, self).cache(cache)
         return FileTar.resolve(as_file.resolved)
 
-    def sign(self):
-        return HTTPTar('tar+' + self.signed_get())
+    @onepath
+    def fetch_member(self, path):
+        store = store_injector.store
+        if self.member is None or pinned(self) is not None or (
+                store is not None and store.entry(self.base) is not None) or \
+                proxy() is not None:
+            return False
+        index = self.sidecar()
+        extent = index.extent(self.member) if index is not None else None
+        if extent is None:
+            return False
+        obj = self.client.get_object(Bucket=self.url.host, Key=self.key,
+                                     Range=byterange(extent))
+        if not matches(index, extent, obj.get('ContentRange')):
+            log.warning('Not able to use the index for %s; fetching the '
+                        'whole archive.', self)
+            obj['Body'].close()
+            return False
+        write_member(index.read(obj['Body'], self.member), path)
+        log.debug('Fetched %s with the index.', self)
+        return True
+
+    def sidecar(self):
+        """The index published next to the archive, or ``None``."""
+        try:
+            obj = self.client.get_object(Bucket=self.url.host,
+                                         Key=self.key + sidecar_suffix)
+            return Index.parse(obj['Body'].read().decode('utf-8'))
+        except (ClientError, Unindexable) as e:
+            log.debug('No index for %s: %s', self, e)
+            return None
+
+    @onepath
+    @contextmanager
+    def stream(self, cache):
+        # The object is unpacked as it arrives, and copied into the store on
+        # the way, unless it has been stored already.
+        store, expected = store_injector.store, pinned(self)
+        with locked(store, self.base) as waited:
+            stored = store.lookup(expected) if store is not None else None
+            etag = None
+            if stored is None:
+                stored, etag, _ = self.current(store, expected, waited)
+            if stored is None:
+                with self.body(expected) as (body, length):
+                    with storing(store, self.base, expected,
+                                 etag=etag) as sink:
+                        tee = Tee(body, sink, length)
+                        yield tee
+                        tee.drain()
+                return
+        with open(str(stored), 'rb') as h:
+            yield h
+
+    @contextmanager
+    def body(self, expected=None):
+        """Yields the object, as a stream, and its length -- from the caching
+           proxy, if there is one.
+        """
+        if proxy() is None:
+            obj = self.client.get_object(Bucket=self.url.host, Key=self.key)
+            yield obj['Body'], obj['ContentLength']
+            return
+        url = proxied(uritools.uriunsplit(self.base), expected)
+        with pool.request('GET', url) as response:
+            yield response, int(response.getheader('content-length') or -1)
+
+    def sign(self, seconds=3600):
+        fragment = self.url.fragment
+        suffix = '#' + fragment if fragment is not None else ''
+        return HTTPTar('tar+' + self.signed_get(seconds) + suffix)
+
+
+class S3Zip(Zip, S3):
+    """Links to zip archives available over S3.
+
+    Note that these URLs may not end with a slash.
+
+    These URLs have directory nature unless a fragment is passed, as described
+    under :class:`~arx.sources.zip.Zip`.
+    """
+
+    @oneurl
+    @schemes('zip+s3')
+    def __init__(self, url):
+        self.url = url
+        if self.dirlike:
+            raise Invalid('Arx can not treat directory-like (ending with `/`) '
+                          'S3 paths like zip archives.')
+
+    @onepath
+    def cache(self, cache):
+        as_file = super(S3Zip, self).cache(cache)
+        return FileZip.resolve(as_file.resolved)
+
+    @onepath
+    @contextmanager
+    def archive(self, cache):
+        store = store_injector.store
+        stored = store is not None and store.entry(self.base) is not None
+        # Data read piecemeal can not be checked against a pinned digest.
+        if self.url.fragment is None or stored or pinned(self) is not None \
+                or proxy() is not None:
+            with super(S3Zip, self).archive(cache) as h:
+                yield h
+            return
+        with self.ranged() as remote:
+            yield remote
+
+    def ranged(self, tail=64 << 10):
+        """The archive as a file that is read with ranged requests, with the
+           last ``tail`` bytes fetched at once.
+        """
+        s3, bucket, key = self.client, self.url.host, self.key
+        obj = s3.get_object(Bucket=bucket, Key=key, Range='bytes=-%d' % tail)
+        data, etag = obj['Body'].read(), obj['ETag']
+        size = int(obj['ContentRange'].split('/')[-1])
+
+        def fetch(start, end):
+            found = s3.get_object(Bucket=bucket, Key=key, IfMatch=etag,
+                                  Range='bytes=%d-%d' % (start, end))
+            return found['Body'].read()
+
+        return ranged.opened(fetch, size, data)
+
+    def sign(self, seconds=3600):
+        fragment = self.url.fragment
+        suffix = '#' + fragment if fragment is not None else ''
+        return HTTPZip('zip+' + self.signed_get(seconds) + suffix)
 
 
 class S3Jar(Jar, S3):
@@ -112,18 +394,186 @@ class S3Jar(Jar, S3):
             raise Invalid('Arx can not treat directory-like (ending with `/`) '
                           'S3 paths like Jars.')
 
-    def sign(self):
-        return HTTPJar('jar+' + self.signed_get())
+    def sign(self, seconds=3600):
+        return HTTPJar('jar+' + self.signed_get(seconds))
 
 
 class Invalid(Err):
     pass
 
 
-def no_credentials():
-    aws = Command('aws')
+def client(region=None, profile=None):
+    """The S3 client for a region and profile -- ``None`` meaning the
+       environment's defaults -- which is shared by all sources.
+
+    Creating a client resolves credentials and endpoints, which is slow.
+    Clients are safe to share between threads; sessions are not, so they are
+    only used with the lock held.
+    """
+    with _lock:
+        if (profile, region) not in _clients:
+            if profile not in _sessions:
+                _sessions[profile] = boto3.session.Session(
+                    profile_name=profile
+                )
+            session = _sessions[profile]
+            _clients[profile, region] = session.client('s3',
+                                                       region_name=region)
+        return _clients[profile, region]
+
+
+_clients, _sessions, _lock = {}, {}, threading.Lock()
+
+
+def presign(bucket, key, seconds=3600, region=None, profile=None):
+    """A presigned URL to ``GET`` the object, valid for ``seconds``.
+
+    Signed URLs are memoized: a URL signed earlier is reused as long as it
+    remains valid for at least 90% of the time asked for.
+    """
+    now, memo = time.time(), (profile, region, bucket, key)
+    with _signed_lock:
+        link, expires = _signed.get(memo, (None, 0))
+    if expires - now >= 0.9 * seconds:
+        return link
+    link = client(region, profile).generate_presigned_url(
+        'get_object', dict(Bucket=bucket, Key=key), ExpiresIn=seconds
+    )
+    with _signed_lock:
+        if len(_signed) >= 4096:
+            for k in [k for k, (_, t) in _signed.items() if t <= now]:
+                del _signed[k]
+        if _signed.get(memo, (None, 0))[1] < now + seconds:
+            _signed[memo] = (link, now + seconds)
+    return link
+
+
+_signed, _signed_lock = {}, threading.Lock()
+
+
+def download(bucket, key, path, part=None, etag=None, length=None,
+             chunksize=8 << 20, jobs=8, retries=4, s3=None):
+    """Downloads an object to ``path`` by way of ``part``.
+
+    The object is fetched in ranged requests of ``chunksize`` bytes, up to
+    ``jobs`` at once. Progress is recorded as it goes, so that a failed
+    download is resumed -- by a retry or a later run -- from the data already
+    written, as long as the object's ETag is unchanged.
+
+    When the ETag and length are known already, as from a listing, the
+    object's metadata is not requested again.
+    """
+    s3, url = s3 or client(), 's3://%s/%s' % (bucket, key)
+    transfer = Transfer(part or str(path) + '.part')
+
+    def attempt():
+        tag, size = etag, length
+        if tag is None or size is None:
+            head = s3.head_object(Bucket=bucket, Key=key)
+            tag, size = head['ETag'], head['ContentLength']
+        if transfer.resumable(url) and transfer.validator == tag:
+            log.debug('Resuming %s at: %s', url, transfer.missing())
+        else:
+            transfer.reset(url, dict(etag=tag), size)
+        spans = list(chunks(transfer.missing(), chunksize))
+
+        def fetch(span):
+            start, end = span
+            body = s3.get_object(Bucket=bucket, Key=key, IfMatch=tag,
+                                 Range='bytes=%d-%d' % span)['Body']
+            transfer.write(body, start, end - start + 1)
+
+        concurrently(fetch, spans, jobs=jobs,
+                     label=lambda span: 'bytes %d-%d of %s' % (span + (url,)))
+
+    retrying(attempt, retries, retriable=retriable, label=url)
+    transfer.finish(path)
+
+
+def listing(bucket, prefix, jobs=16, s3=None):
+    """Lists the objects under a prefix, as a dictionary of names relative to
+       the prefix to ETags and sizes.
+
+    Listing is paginated and so sequential; to speed it up, the first level of
+    "subdirectories" under the prefix are listed concurrently.
+    """
+    paginator = (s3 or client()).get_paginator('list_objects_v2')
+
+    def objects(pages):
+        return dict((obj['Key'][len(prefix):],
+                     dict(etag=obj['ETag'], size=obj['Size']))
+                    for page in pages for obj in page.get('Contents', [])
+                    if not obj['Key'].endswith('/'))
+
+    pages = list(paginator.paginate(Bucket=bucket, Prefix=prefix,
+                                    Delimiter='/'))
+    found = objects(pages)
+    subdirs = [p['Prefix'] for page in pages
+               for p in page.get('CommonPrefixes', [])]
+
+    def subdir(sub):
+        return objects(paginator.paginate(Bucket=bucket, Prefix=sub))
+
+    for objs in concurrently(subdir, subdirs, jobs=jobs):
+        found.update(objs)
+    return found
+
+
+def load_manifest(path):
+    if path is None:
+        return {}
     try:
-        aws('sts', 'get-caller-identity')
-        return False
-    except ErrorReturnCode:
+        with open(str(path)) as h:
+            return json.load(h)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w') as h:
+        json.dump(manifest, h, sort_keys=True)
+    os.rename(tmp, str(path))
+
+
+def within(under, name):
+    """True if the object ``name`` is written inside of ``under``; otherwise,
+       warns that it is skipped.
+    """
+    if inside(os.path.realpath(str(under)), str(under.join(name))):
         return True
+    log.warning('Skipping %s, which is outside of: %s', name, under)
+    return False
+
+
+def prune(under, name):
+    """Removes a file and any directories it leaves empty."""
+    path = under.join(name)
+    if not within(under, name):
+        return
+    if os.path.lexists(str(path)):
+        path.remove()
+    path = path.dirpath()
+    while path != under and path.check(dir=True) and not path.listdir():
+        path.remove()
+        path = path.dirpath()
+
+
+def retriable(e):
+    """Network failures, truncated transfers and server errors are retried;
+       but not, for example, missing objects or denied requests.
+    """
+    for cause in causes(e):
+        if isinstance(cause, ClientError):
+            status = cause.response.get('ResponseMetadata', {}).get(
+                'HTTPStatusCode', 500
+            )
+            if status < 500:
+                return False
+        elif not isinstance(cause, BotoCoreError) and not transient(cause):
+            return False
+    return True
+
+
+def no_credentials():
+    return boto3.session.Session().get_credentials() is None
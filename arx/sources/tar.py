@@ -1,6 +1,20 @@
-from sh import chmod, Command, mkdir, tar
+from contextlib import contextmanager
+import os
+import re
+import shutil
+import tarfile
+import tempfile
 
+from magiclog import log
+import py.path
+from sh import chmod, Command
+import six
+
+from ..cache import pinned, store_injector, touch
 from ..err import Err
+from ..util import linking, tarindex
+from ..util.tarindex import components
+from ..util.transfer import Incomplete, retrying, transient
 from .core import twopaths, onepath
 
 
@@ -23,25 +37,161 @@ class Tar(object):
 
     @twopaths
     def place(self, cache, path):
-        data = self.cache(cache)
-        opts = []
-
-        if self.url.fragment is not None:
-            slashes = self.url.fragment.count('/')
-            # If the fragment is `a/b/d/`, then we get three slashes and pass
-            # three to `--strip-components`. The effect is similar to using
-            # `rsync` or `cp -a` with trailing slashes.
-            if slashes > 0:
-                opts += ['--strip-components', str(slashes)]
-            # Append fragment to arguments list, so only this file/dir is
-            # extracted.
-            opts += ['--', self.url.fragment]
-
-        mkdir('-p', path.dirname)
-        if self.url.fragment is None or self.url.fragment.endswith('/'):
-            tar('-xf', str(data), '-C', str(path), *opts)
-        else:
-            tar('-xf', str(data), '--to-stdout', *opts, _out=str(path))
+        # Network failures part way through are retried from the start, with
+        # files already unpacked simply overwritten.
+        def attempt():
+            if self.fetch_member(path):
+                return
+            if self.member is None and store_injector.store is not None:
+                self.place_unpacked(cache, path)
+                return
+            with self.staged(path) as target:
+                with self.stream(cache) as stream:
+                    if not extract_indexed(stream, target, self.url.fragment):
+                        extract(stream, target, self.url.fragment)
+
+        retrying(attempt, retriable=transient, label=str(self))
+
+    @contextmanager
+    def staged(self, path):
+        """Yields where to unpack the archive to: ``path`` itself; or -- if
+           the source is pinned to a digest, which streamed archives are only
+           checked against once they have been read -- a scratch directory
+           next to it, from which the files are moved into place only if the
+           block completes.
+        """
+        if pinned(self) is None:
+            yield path
+            return
+        path = py.path.local(path)
+        path.dirpath().ensure(dir=True)
+        scratch = py.path.local(tempfile.mkdtemp(prefix='.arx-',
+                                                 dir=str(path.dirpath())))
+        try:
+            target = scratch.join('x')
+            yield target
+            if target.check(dir=True, link=False):
+                linking.mirror(target, path, place=shutil.move)
+            else:
+                os.rename(str(target), str(path))
+        finally:
+            scratch.remove(rec=1)
+
+    @twopaths
+    def place_unpacked(self, cache, path):
+        """Places the archive from a tree in the store, where it is kept
+           unpacked -- as selected by the fragment -- for as long as the
+           archive is unchanged.
+
+        Unless another way is chosen (see :mod:`arx.util.linking`), the tree
+        is placed by reflinking or hard linking its files, so its files are
+        made read-only.
+        """
+        store = store_injector.store
+        with self.unpacked(cache) as (tree, kept):
+            if not kept:
+                linking.mirror(tree, path, place=shutil.move)
+                return
+            log.debug('Linking unpacked %s from: %s', self, tree)
+            linking.sync(tree, path, linking.strategy(linking.clone),
+                         store.placement(path, self))
+
+    @onepath
+    @contextmanager
+    def unpacked(self, cache):
+        """Yields the archive unpacked, as selected by the fragment, from a
+           tree in the store, along with ``True``; or -- if the archive could
+           not be stored -- from a scratch directory, along with ``False``.
+        """
+        store = store_injector.store
+        scratch, tree = store.scratch(), None
+        try:
+            with self.stream(cache) as stream:
+                name = getattr(stream, 'name', None)
+                if isinstance(name, six.string_types):
+                    tree = store.unpacked(store.digest(name),
+                                          self.url.fragment)
+                if tree is None or not tree.check(dir=True):
+                    extract(stream, scratch, self.url.fragment)
+            if tree is None:
+                # The archive was unpacked as it was downloaded, and stored.
+                entry = store.entry(self.base)
+                if entry is None:
+                    yield scratch, False
+                    return
+                tree = store.unpacked(entry['digest'], self.url.fragment)
+            if not tree.check(dir=True):
+                linking.freeze(scratch)
+                keep(scratch, tree)
+            touch(tree)
+            yield tree, True
+        finally:
+            if scratch.check():
+                scratch.remove(rec=1)
+
+    @onepath
+    def prefetch(self, cache):
+        """Brings the archive into the store, where it is kept unpacked -- or,
+           when a single file is wanted from it, indexed.
+        """
+        store = store_injector.store
+        if self.member is None and store is not None:
+            with self.unpacked(cache):
+                return
+        archive = self.cache(cache).resolved
+        if self.member is not None:
+            tarindex.load(self.stored(archive), store)
+
+    @onepath
+    def fetch_member(self, path):
+        """Writes the file named by the fragment to ``path``, fetching only
+           the part of the archive that holds it, and returns ``True``; or
+           returns ``False`` if that is not possible.
+
+        Remote sources can do this with the help of an index published next
+        to the archive, with ``.index.json`` appended to its name (see ``arx
+        index``). By default, it is not possible.
+        """
+        return False
+
+    @property
+    def member(self):
+        """The file named by the fragment, or ``None`` if the fragment names
+           a directory or there is no fragment.
+        """
+        fragment = self.url.fragment
+        if fragment is None or fragment.endswith('/'):
+            return None
+        return fragment
+
+    @onepath
+    @contextmanager
+    def stream(self, cache):
+        """Yields the archive as a readable stream.
+
+        By default, the archive is cached and read from disk; sources that can
+        read the archive as it arrives override this, so that it is unpacked
+        while it downloads.
+        """
+        with open(str(self.stored(self.cache(cache).resolved)), 'rb') as h:
+            yield h
+
+    def stored(self, path):
+        """The object in the store that the archive at ``path`` is a link to,
+           if it is one -- so that the archive is indexed by its digest (see
+           :func:`arx.util.tarindex.load`) -- or else ``path``.
+        """
+        store = store_injector.store
+        if store is None:
+            return path
+        base = getattr(self, 'base', None)
+        entry = store.entry(base) if base is not None else None
+        for digest in [pinned(self), entry and entry['digest']]:
+            obj = store.obj(digest) if digest else None
+            if obj is not None and obj.check(file=True) and \
+                    os.path.samefile(str(obj), str(path)):
+                return obj
+        return path
 
     @onepath
     def run(self, cache, args=[]):
@@ -59,5 +209,161 @@ class Tar(object):
         return cache.join('data.tar')
 
 
+sidecar_suffix = '.index.json'
+
+
+def extract(stream, path, fragment=None):
+    """Unpacks a tar archive, reading it from ``stream`` in a single pass.
+
+    With no fragment, or a fragment ending in ``/``, the archive is unpacked
+    into the directory ``path``; otherwise, the fragment names a file in the
+    archive, which is written to ``path``. Fragments are interpreted as
+    described under :class:`Tar`. Compression is detected from the data.
+    """
+    path = py.path.local(path)
+    whole = fragment is None or fragment.endswith('/')
+    path.ensure(dir=True) if whole else path.dirpath().ensure(dir=True)
+    try:
+        with tarfile.open(fileobj=stream, mode='r|*') as archive:
+            if whole:
+                unpack(archive, path, fragment or '')
+            else:
+                unpack_file(archive, path, fragment)
+    except tarfile.TarError as e:
+        raise Invalid('Not able to unpack archive: %s' % e, cause=e)
+
+
+def keep(scratch, tree):
+    """Moves a freshly unpacked tree into place, unless another one has been
+       put there in the meantime.
+    """
+    tree.dirpath().ensure(dir=True)
+    try:
+        os.rename(str(scratch), str(tree))
+    except OSError:
+        if not tree.check(dir=True):
+            raise
+
+
+def extract_indexed(handle, path, fragment):
+    """Writes the file named by the fragment to ``path``, seeking to it with
+       the archive's index, if the archive is a file on disk that can be
+       indexed (see :mod:`arx.util.tarindex`).
+
+    Returns ``False`` when the index can not be used.
+    """
+    if fragment is None or fragment.endswith('/'):
+        return False
+    name = getattr(handle, 'name', None)
+    if not isinstance(name, six.string_types) or not os.path.isfile(name):
+        return False
+    index = tarindex.load(name, store_injector.store)
+    member = index.open(handle, fragment) if index is not None else None
+    if member is None:
+        return False
+    write_member(member, path)
+    return True
+
+
+def write_member(member, path):
+    """Writes a stream from :meth:`arx.util.tarindex.Index.read` to ``path``.
+    """
+    py.path.local(path).dirpath().ensure(dir=True)
+    with open(str(path), 'wb') as h:
+        shutil.copyfileobj(member, h)
+    if member.left > 0:
+        raise Incomplete('Archive ended %d bytes early.' % member.left)
+
+
+def byterange(extent):
+    """A ``Range`` header for an extent from an index."""
+    start, end = extent
+    return 'bytes=%d-%s' % (start, '' if end is None else end)
+
+
+def matches(index, extent, content_range):
+    """True if a ``Content-Range`` is for the extent, of an archive of the
+       size recorded in the index -- so that an index that does not match the
+       archive is not used.
+    """
+    found = re.match(r'bytes (\d+)-\d+/(\d+)$', content_range or '')
+    return (found is not None and int(found.group(1)) == extent[0] and
+            (index.size is None or int(found.group(2)) == index.size))
+
+
+def unpack(archive, path, fragment):
+    root = os.path.realpath(str(path))
+    strip = fragment.count('/')
+    prefix = components(fragment)
+    directories = []
+    for member in archive:
+        name = select(member.name, prefix, strip)
+        if name is None:
+            continue
+        dest = os.path.join(root, name)
+        if not inside(root, dest):
+            log.warning('Skipping archive member outside of %s: %s',
+                        root, member.name)
+            continue
+        if member.isdir():
+            py.path.local(dest).ensure(dir=True)
+            directories += [(dest, member)]
+            continue
+        if member.islnk():
+            link = select(member.linkname, prefix, strip)
+            if link is None:
+                log.warning('Skipping hard link to unselected member: %s',
+                            member.name)
+                continue
+            target = os.path.realpath(os.path.join(root, link))
+            if not inside(root, target):
+                log.warning('Skipping hard link to a file outside of %s: %s',
+                            root, member.name)
+                continue
+            member.linkname = link
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.remove(dest)
+        member.name = name
+        archive.extract(member, root)
+    # Permissions are set last, in case directories are not writable.
+    for dest, member in reversed(directories):
+        os.chmod(dest, member.mode)
+        os.utime(dest, (member.mtime, member.mtime))
+
+
+def unpack_file(archive, path, fragment):
+    wanted = components(fragment)
+    for member in archive:
+        if components(member.name) != wanted:
+            continue
+        if not member.isfile():
+            raise Invalid('Not a regular file in the archive: %s' % fragment)
+        with open(str(path), 'wb') as h:
+            shutil.copyfileobj(archive.extractfile(member), h)
+        return
+    raise Invalid('Not found in the archive: %s' % fragment)
+
+
+def inside(root, dest):
+    """True if ``dest`` would be created inside of ``root``, even following
+       the symlinks unpacked so far.
+    """
+    parent = os.path.realpath(os.path.dirname(dest))
+    return parent == root or parent.startswith(root + os.sep)
+
+
+def select(name, prefix, strip):
+    """The name to unpack a member to, or ``None`` if it is not selected.
+
+    Members outside of the ``prefix`` are not selected; nor are members that
+    lose all their components to ``strip`` (as with ``--strip-components``)
+    or that would be unpacked outside of the destination.
+    """
+    parts = components(name)
+    if parts[:len(prefix)] != prefix or len(parts) <= strip or '..' in parts:
+        return None
+    return os.path.join(*parts[strip:])
+
+
 class Invalid(Err):
     pass
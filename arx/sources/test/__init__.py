@@ -0,0 +1,107 @@
+from contextlib import contextmanager
+import io
+import re
+import tarfile
+import threading
+import zipfile
+
+from six.moves import BaseHTTPServer, socketserver
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ``server.files`` (a dict of paths to bytes) with ETags, and
+       records the headers of every request in ``server.requests`` and the
+       address of every client in ``server.clients``.
+
+    When ``server.cuts`` has an entry for a path, the next response for it is
+    cut off after that many bytes of the body.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers.items())))
+        self.server.clients.add(self.client_address)
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag = '"%x"' % hash(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match:
+            if match.group(1):
+                start = int(match.group(1))
+                end = int(match.group(2) or len(body) - 1)
+            else:                            # A suffix, like `bytes=-512`.
+                start = max(0, len(body) - int(match.group(2)))
+                end = len(body) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, end, len(body)))
+            body = body[start:end + 1]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        cut = self.server.cuts.pop(self.path, None)
+        if cut is not None:
+            self.wfile.write(body[:cut])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@contextmanager
+def serving(files):
+    """Runs an HTTP server on localhost, yielding it; its base URL is
+       ``server.url``.
+    """
+    server = Server(('127.0.0.1', 0), Handler)
+    server.files, server.requests, server.clients = files, [], set()
+    server.cuts = {}
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def tarball(files, mode='w:gz'):
+    """A tar archive, as bytes, holding ``files`` (a dict of names to bytes).
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode=mode) as archive:
+        for name, body in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size, info.mode = len(body), 0o644
+            archive.addfile(info, io.BytesIO(body))
+    return data.getvalue()
+
+
+def zipball(files):
+    """A zip archive, as bytes, holding ``files`` (a dict of names to bytes).
+    """
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, body in sorted(files.items()):
+            archive.writestr(name, body)
+    return data.getvalue()
@@ -0,0 +1,131 @@
+import pytest
+from sh import Command
+
+from ...cache import Store, store_injector
+from .. import git
+from ..git import Git, NoSuchRef
+
+
+def repository(path):
+    """A repository with two commits, tagged ``v1`` and ``v2``."""
+    run = Command('git').bake('-C', str(path), '-c', 'user.name=Arx',
+                              '-c', 'user.email=arx@example.com')
+    path.ensure(dir=True)
+    run('init', '--quiet')
+    run('config', 'uploadpack.allowFilter', 'true')
+    for version in ['v1', 'v2']:
+        path.join('VERSION').write(version)
+        path.join('src', 'main.py').write('# ' + version, ensure=True)
+        run('add', '.')
+        run('commit', '--quiet', '-m', version)
+        run('tag', version)
+    return run
+
+
+def test_refs():
+    assert Git('git+ssh://example.com/a.git').ref == 'HEAD'
+    assert Git('git+ssh://example.com/a.git?beta').ref == 'beta'
+    assert Git('git+ssh://example.com/a.git?ref=0abc3df').ref == '0abc3df'
+    src = Git('git+https://example.com/a.git?beta#src/')
+    assert src.remote == 'https://example.com/a.git'
+
+
+def test_place(tmpdir):
+    repository(tmpdir.join('repo'))
+    store = Store(tmpdir.join('store'))
+    with store_injector.using(store):
+        src = Git('git+file://%s?v1' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('v1'))
+        assert tmpdir.join('v1', 'VERSION').read() == 'v1'
+
+        src = Git('git+file://%s?v2#src/' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('src'))
+        assert tmpdir.join('src', 'main.py').read() == '# v2'
+        assert not tmpdir.join('src', '.git').check()
+        src = Git('git+file://%s#src' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('nginx'))
+        assert tmpdir.join('nginx', 'main.py').read() == '# v2'
+
+        mirror = store.tree('file://%s' % tmpdir.join('repo'))
+        config = Command('git').bake('--git-dir', str(mirror), 'config')
+        assert str(config('gc.auto')).strip() == '0'
+        assert str(config('gc.pruneExpire')).strip() == 'never'
+
+        trees = len(store.trees.listdir())
+        src = Git('git+file://%s?v2' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('v1'))
+        assert tmpdir.join('v1', 'VERSION').read() == 'v2'   # Updated.
+        assert len(store.trees.listdir()) == trees  # The mirror is shared.
+
+        with pytest.raises(NoSuchRef):
+            src = Git('git+file://%s?v3' % tmpdir.join('repo'))
+            src.place(tmpdir.join('cache'), tmpdir.join('v3'))
+
+
+def test_place_beside(tmpdir):
+    repository(tmpdir.join('repo'))
+    tmpdir.join('cwd', 'data.csv').write('a,b', ensure=True)
+    tmpdir.join('cwd', 'VERSION').write('v0')
+    with store_injector.using(Store(tmpdir.join('store'))):
+        src = Git('git+file://%s?v1' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('cwd'))
+    assert tmpdir.join('cwd', 'VERSION').read() == 'v1'
+    assert tmpdir.join('cwd', 'data.csv').read() == 'a,b'
+    assert sorted(p.basename for p in tmpdir.join('cwd').listdir()) == \
+        ['.git', 'VERSION', 'data.csv', 'src']
+
+
+def test_place_evicted(tmpdir):
+    repository(tmpdir.join('repo'))
+    store = Store(tmpdir.join('store'))
+    with store_injector.using(store):
+        src = Git('git+file://%s?v1' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('co'))
+        store.gc(0)                                # Evicts the mirror.
+        assert not store.trees.check() or not store.trees.listdir()
+        Command('git')('-C', str(tmpdir.join('co')), 'fsck')
+        src = Git('git+file://%s?v2' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('co'))
+    assert tmpdir.join('co', 'VERSION').read() == 'v2'
+
+
+def test_fetch(tmpdir):
+    run = repository(tmpdir.join('repo'))
+    git._fetched.clear()
+    with store_injector.using(Store(tmpdir.join('store'))):
+        Git('git+file://%s' % tmpdir.join('repo')).cache(tmpdir.join('a'))
+        tmpdir.join('repo', 'VERSION').write('v3')
+        run('commit', '--quiet', '-am', 'v3')
+        run('tag', 'v3')
+        git._fetched.clear()                                 # A new run.
+        src = Git('git+file://%s?v3#VERSION' % tmpdir.join('repo'))
+        src.place(tmpdir.join('b'), tmpdir.join('VERSION'))
+        assert tmpdir.join('VERSION').read() == 'v3'
+
+
+def test_sparse(tmpdir):
+    repository(tmpdir.join('repo'))
+    store = Store(tmpdir.join('store'))
+    with store_injector.using(store):
+        src = Git('git+file://%s?v1#src/' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('src'))
+        assert tmpdir.join('src', 'main.py').read() == '# v1'
+        tree, = store.trees.listdir()
+        assert not tree.join('VERSION').check()
+        missing = Command('git')('-C', str(tree), 'rev-list', '--objects',
+                                 '--missing=print', 'HEAD')
+        assert len([line for line in str(missing).split()
+                    if line.startswith('?')]) == 1
+        shallow = Command('git')('-C', str(tree), 'rev-list', '--count',
+                                 'HEAD')
+        assert str(shallow).strip() == '1'
+
+        src = Git('git+file://%s?v2#src/' % tmpdir.join('repo'))
+        src.place(tmpdir.join('cache'), tmpdir.join('src'))
+        assert tmpdir.join('src', 'main.py').read() == '# v2'
+
+        src = Git('git+file://%s?v2#/' % tmpdir.join('repo'))
+        assert not src.sparse
+        src.place(tmpdir.join('cache'), tmpdir.join('all'))
+        assert tmpdir.join('all', 'VERSION').read() == 'v2'
+        assert not tmpdir.join('all', '.git').check()
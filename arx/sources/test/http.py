@@ -1,7 +1,18 @@
+import os
+import threading
+import time
+
 import pytest
+import six
 
+from ...cache import Mismatch, pinning, sha256, Store, store_injector
 from ...decorators import InvalidScheme
-from ..http import HTTP, HTTPJar, HTTPTar, Invalid
+from ..http import conditions, HTTP, HTTPJar, HTTPTar, HTTPZip, Invalid
+from ..http import read_headers
+from ..http import validators
+from ...util.pool import concurrently
+from ...util.tarindex import Index
+from . import serving, tarball, zipball
 
 
 def test_http():
@@ -58,3 +69,224 @@ def test_jar():
 
     with pytest.raises(InvalidScheme):
         src = HTTPJar('https://aol.com/aol.tgz')
+
+
+def test_read_headers(tmpdir):
+    dump = tmpdir.join('headers')
+    dump.write('HTTP/1.1 302 Found\r\nLocation: /b\r\nETag: "a"\r\n\r\n'
+               'HTTP/1.1 200 OK\r\nETag: "b"\r\n'
+               'Last-Modified: Tue, 01 Mar 2016 00:00:00 GMT\r\n\r\n')
+    headers = read_headers(dump)
+    assert 'location' not in headers
+    found = validators(headers)
+    assert found == dict(etag='"b"',
+                         last_modified='Tue, 01 Mar 2016 00:00:00 GMT')
+    assert conditions(found) == {
+        'If-None-Match': '"b"',
+        'If-Modified-Since': 'Tue, 01 Mar 2016 00:00:00 GMT'
+    }
+    assert read_headers(tmpdir.join('missing')) == {}
+
+
+def test_revalidation(tmpdir):
+    with serving({'/a.txt': six.b('aaa')}) as server:
+        with store_injector.using(Store(tmpdir.join('store'))):
+            src = HTTP(server.url + '/a.txt')
+            first = src.cache(tmpdir.join('first').ensure(dir=True))
+            second = src.cache(tmpdir.join('second').ensure(dir=True))
+    assert first.resolved.read() == second.resolved.read() == 'aaa'
+    assert len(server.requests) == 2
+    assert 'If-None-Match' not in server.requests[0][1]
+    assert 'If-None-Match' in server.requests[1][1]
+
+
+def test_no_validators(tmpdir):
+    store = Store(tmpdir.join('store'))
+    files = {'/a.txt': six.b('new'), '/a.tgz': tarball({'a': six.b('new')})}
+    with serving(files) as server, store_injector.using(store):
+        for path in ['/a.txt', '/a.tgz']:
+            tmpdir.join('old').write('old')
+            store.put(server.url + path, tmpdir.join('old'))  # No validators.
+        src = HTTP(server.url + '/a.txt')
+        assert src.cache(tmpdir.join('1')).resolved.read() == 'new'
+        src = HTTPTar('tar+' + server.url + '/a.tgz#a')
+        src.place(tmpdir.join('2').ensure(dir=True), tmpdir.join('a'))
+        assert tmpdir.join('a').read() == 'new'
+    assert [path for path, _ in server.requests] == ['/a.txt', '/a.tgz']
+
+
+def test_evicted(tmpdir, monkeypatch):
+    store = Store(tmpdir.join('store'))
+    files = {'/a.txt': six.b('a'), '/a.tgz': tarball({'a': six.b('a')})}
+    with serving(files) as server, store_injector.using(store):
+        sources = [HTTP(server.url + '/a.txt'),
+                   HTTPTar('tar+' + server.url + '/a.tgz')]
+        for i, src in enumerate(sources):
+            src.place(tmpdir.join('cache', str(i)).ensure(dir=True),
+                      tmpdir.join('first', str(i)))
+            stale = [store.entry(src.base)]
+            store.obj(stale[0]['digest']).remove()   # Evicted, once it has
+            original = store.entry                   # been looked up.
+            monkeypatch.setattr(store, 'entry', lambda url: stale.pop() if
+                                stale else original(url))
+            src.place(tmpdir.join('again', str(i)).ensure(dir=True),
+                      tmpdir.join('out', str(i)))
+            monkeypatch.undo()
+        assert tmpdir.join('out', '0').read() == 'a'
+        assert tmpdir.join('out', '1', 'a').read() == 'a'
+    assert [h.get('If-None-Match') is None for _, h in server.requests] == \
+        [True, False, True] * 2
+
+
+def test_single_flight(tmpdir):
+    store = Store(tmpdir.join('store'))
+    with serving({'/a.txt': six.b('a' * 100000)}) as server:
+        with store_injector.using(store):
+            src = HTTP(server.url + '/a.txt')
+            release = threading.Event()
+
+            def hold():
+                with store.lock(src.base):
+                    release.wait()
+
+            holder = threading.Thread(target=hold)
+            holder.start()
+            time.sleep(0.1)
+            fetches = [tmpdir.join(str(i)).ensure(dir=True) for i in range(8)]
+            waiting = threading.Timer(0.5, release.set)
+            waiting.start()
+            found = concurrently(src.cache, fetches, jobs=8)
+            holder.join()
+    assert all(f.resolved.read() == 'a' * 100000 for f in found)
+    assert len(server.requests) == 1                 # Once, for everyone.
+
+
+def test_pinned(tmpdir):
+    data = six.b('a' * 100000)
+    digest = sha256(data)
+    files = {'/a.txt': data, '/b.txt': data, '/a.tgz': tarball({'a': data})}
+    with serving(files) as server:
+        with store_injector.using(Store(tmpdir.join('store'))):
+            src = HTTP(server.url + '/a.txt?sha256=' + digest)
+            assert src.cache(tmpdir.join('1')).resolved.read_binary() == data
+            assert [path for path, _ in server.requests] == ['/a.txt']
+            with pinning('sha256:' + digest):               # No requests.
+                found = HTTP(server.url + '/b.txt').cache(tmpdir.join('2'))
+            assert found.resolved.read_binary() == data
+            assert len(server.requests) == 1
+            with pytest.raises(Mismatch), pinning('0' * 64):
+                HTTP(server.url + '/b.txt').cache(tmpdir.join('3'))
+            with pytest.raises(Mismatch), pinning('0' * 64):
+                HTTPTar('tar+' + server.url + '/a.tgz').place(
+                    tmpdir.join('4'), tmpdir.join('out'))
+
+
+def test_pinned_tar(tmpdir):
+    files = {'/x.tgz': tarball({'evil.sh': six.b('rm -rf /')})}
+    cases = [(None, ''), (None, '#evil.sh'),
+             (Store(tmpdir.join('store')), '#evil.sh')]
+    with serving(files) as server:
+        for i, (store, fragment) in enumerate(cases):
+            src = HTTPTar('tar+%s/x.tgz?sha256=%s%s' %
+                          (server.url, '0' * 64, fragment))
+            out = tmpdir.join(str(i), 'out')
+            with store_injector.using(store), pytest.raises(Mismatch):
+                src.place(tmpdir.join('cache', str(i)).ensure(dir=True), out)
+            assert tmpdir.join(str(i)).listdir() == []
+        digest = sha256(files['/x.tgz'])
+        src = HTTPTar('tar+%s/x.tgz?sha256=%s' % (server.url, digest))
+        with store_injector.using(None):
+            src.place(tmpdir.join('cache', 'ok').ensure(dir=True),
+                      tmpdir.join('ok'))
+    assert tmpdir.join('ok', 'evil.sh').read() == 'rm -rf /'
+
+
+def test_run_stored(tmpdir):
+    script = six.b('#!/bin/sh\necho "$@" > %s\n' % tmpdir.join('out.txt'))
+    store = Store(tmpdir.join('store'))
+    with serving({'/run.sh': script}) as server, store_injector.using(store):
+        HTTP(server.url + '/run.sh').run(tmpdir.join('cache'), ['ran'])
+    assert tmpdir.join('out.txt').read() == 'ran\n'
+    obj = store.obj(sha256(script))
+    assert obj.stat().mode & 0o777 == 0o444
+
+
+def test_keepalive(tmpdir):
+    files = dict(('/%d' % i, six.b(str(i))) for i in range(5))
+    with serving(files) as server, store_injector.using(None):
+        for path in sorted(files):
+            src = HTTP(server.url + path)
+            src.place(tmpdir.join(path[1:]).ensure(dir=True),
+                      tmpdir.join('out', path[1:]))
+    assert len(server.requests) == 5
+    assert len(server.clients) == 1
+    assert tmpdir.join('out', '4').read() == '4'
+
+
+def test_tar_streaming(tmpdir):
+    files = {'/a.tgz': tarball({'a-1.0/bin/a': six.b('a')})}
+    store = Store(tmpdir.join('store'))
+    with serving(files) as server, store_injector.using(store):
+        src = HTTPTar('tar+' + server.url + '/a.tgz#/')
+        src.place(tmpdir.join('first').ensure(dir=True), tmpdir.join('x'))
+        assert not tmpdir.join('first', 'data.tar').check()
+        assert store.entry(src.base) is not None
+        src.place(tmpdir.join('second').ensure(dir=True), tmpdir.join('y'))
+    assert tmpdir.join('x', 'bin', 'a').read() == 'a'
+    assert tmpdir.join('y', 'bin', 'a').read() == 'a'
+    assert 'If-None-Match' in server.requests[1][1]
+
+
+def test_tar_indexed(tmpdir):
+    body = tarball({'a/b': six.b('b'), 'a/c': six.b('c')}, mode='w')
+    store = Store(tmpdir.join('store'))
+    with serving({'/a.tar': body}) as server, store_injector.using(store):
+        src = HTTPTar('tar+' + server.url + '/a.tar#a/c')
+        src.prefetch(tmpdir.join('cache').ensure(dir=True))
+        assert store.index(sha256(body)).check(file=True)
+        src.place(tmpdir.join('again').ensure(dir=True), tmpdir.join('c'))
+    assert tmpdir.join('c').read() == 'c'
+
+
+def test_tar_streaming_retries(tmpdir):
+    files = {'/a.tar': tarball({'a': six.b('a' * 4096)}, mode='w')}
+    with serving(files) as server, store_injector.using(None):
+        server.cuts['/a.tar'] = 1024
+        src = HTTPTar('tar+' + server.url + '/a.tar')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('x'))
+    assert tmpdir.join('x', 'a').read() == 'a' * 4096
+    assert len(server.requests) == 2
+
+
+def test_tar_member(tmpdir):
+    body = tarball(dict(('d/%d' % i, six.b('%d' % i) * 4096)
+                        for i in range(10)), mode='w')
+    archive = tmpdir.join('a.tar')
+    archive.write_binary(body)
+    sidecar = six.b(Index.build(archive).dumps())
+    files = {'/a.tar': body, '/a.tar.index.json': sidecar,
+             '/b.tar': body, '/b.tar.index.json': sidecar[:-20]}
+    with serving(files) as server, store_injector.using(None):
+        src = HTTPTar('tar+' + server.url + '/a.tar#d/7')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('7'))
+        assert tmpdir.join('7').read() == '7' * 4096
+        ranged = [headers for path, headers in server.requests
+                  if path == '/a.tar']
+        assert len(ranged) == 1 and 'Range' in ranged[0]
+
+        # An index that can not be read is passed over.
+        src = HTTPTar('tar+' + server.url + '/b.tar#d/3')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('3'))
+        assert tmpdir.join('3').read() == '3' * 4096
+
+
+def test_zip_member(tmpdir):
+    members = dict(('blob/%d' % i, os.urandom(1 << 16)) for i in range(32))
+    members['conf/app.ini'] = six.b('[app]')
+    body = zipball(members)
+    with serving({'/a.zip': body}) as server, store_injector.using(None):
+        src = HTTPZip('zip+' + server.url + '/a.zip#conf/app.ini')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('ini'))
+    assert tmpdir.join('ini').read() == '[app]'
+    assert all('Range' in headers for _, headers in server.requests)
+    assert len(server.requests) <= 3
@@ -2,7 +2,8 @@ import base64
 
 import six
 
-from ..inline import InlineBinary, InlineTarGZ, stringsafe
+from ..files import File
+from ..inline import inline, InlineBinary, InlineTarGZ, stringsafe
 
 
 def test_stringsafe():
@@ -19,9 +20,22 @@ def test_b64():
     assert six.b(text) == source.data
 
 
-def test_b64_targz():
+def test_b64_targz(tmpdir):
     source = InlineTarGZ.base64(small_tgz)
     assert isinstance(source, InlineTarGZ)
+    source.place(tmpdir, tmpdir.join('out'))
+    assert tmpdir.join('out', 'x', 'x').read().strip() == 'x'
+
+
+def test_inline(tmpdir):
+    tmpdir.join('tree', 'a', 'b.txt').write('b', ensure=True)
+    source = inline(File('file://%s/' % tmpdir.join('tree')), tmpdir)
+    assert isinstance(source, InlineTarGZ)
+    source.place(tmpdir, tmpdir.join('out'))
+    assert tmpdir.join('out', 'a', 'b.txt').read() == 'b'
+    source = inline(File('file://%s' % tmpdir.join('tree', 'a', 'b.txt')),
+                    tmpdir.join('again'))
+    assert type(source) is InlineBinary and source.data == six.b('b')
 
 
 # Contains one file `x/x` with contents `x`.
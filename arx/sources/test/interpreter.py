@@ -2,10 +2,11 @@ import base64
 
 import six
 
-from ..http import HTTP, HTTPJar, HTTPTar
+from ..files import FileZip
+from ..http import HTTP, HTTPJar, HTTPTar, HTTPZip
 from ..inline import InlineBinary, InlineTarGZ, InlineText
 from ..interpreter import default
-from ..s3 import S3, S3Jar, S3Tar
+from ..s3 import S3, S3Jar, S3Tar, S3Zip
 from .inline import small_tgz
 
 
@@ -13,10 +14,13 @@ def test_url_dispatch():
     assert isinstance(default('http://pokemon.x.y/'), HTTP)
     assert isinstance(default('jar+https://pokemon.x.y/pika.jar'), HTTPJar)
     assert isinstance(default('tar+http://pokemon.x.y/rocket.tgz'), HTTPTar)
+    assert isinstance(default('zip+https://pokemon.x.y/team.zip'), HTTPZip)
+    assert isinstance(default('zip+file:///team.zip#a/'), FileZip)
 
     assert isinstance(default('s3://pokemon/x.y'), S3)
     assert isinstance(default('jar+s3://pokemon.x.y/pika.jar'), S3Jar)
     assert isinstance(default('tar+s3://pokemon.x.y/rocket.tgz'), S3Tar)
+    assert isinstance(default('zip+s3://pokemon.x.y/team.zip'), S3Zip)
 
 
 def test_inline_dispatch():
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from ...util.packfile import Invalid, Packer, PackFile
+from ..pack import Pack
+from .. import pack
+
+
+def test_packfile(tmpdir):
+    tree = tmpdir.join('tree')
+    tree.join('a', 'x.txt').write('xxx', ensure=True)
+    tree.join('b', 'y.txt').write('xxx', ensure=True)
+    tree.join('run.sh').write('#!/bin/sh\necho ok\n')
+    tree.join('run.sh').chmod(0o755)
+    tree.join('empty').ensure(dir=True)
+    os.symlink('a/x.txt', str(tree.join('link')))
+    tmpdir.join('one.txt').write('xxx')
+    packer = Packer(tmpdir.join('test.pack'))
+    packer.add('tree', tree)
+    packer.add('file', tmpdir.join('one.txt'))
+    packer.close()
+
+    found = PackFile(tmpdir.join('test.pack'))
+    assert len(found.objects) == 2                      # The x's are shared.
+    found.place('tree', tmpdir.join('out'))
+    out = tmpdir.join('out')
+    assert out.join('b', 'y.txt').read() == 'xxx'
+    assert out.join('run.sh').stat().mode & 0o777 == 0o755
+    assert out.join('empty').check(dir=True)
+    assert os.readlink(str(out.join('link'))) == 'a/x.txt'
+    found.place('file', tmpdir.join('deep', 'one.txt'))
+    assert tmpdir.join('deep', 'one.txt').read() == 'xxx'
+    with pytest.raises(Invalid):
+        found.place('missing', tmpdir.join('missing'))
+
+
+def test_source(tmpdir):
+    tmpdir.join('cmd.sh').write('#!/bin/sh\necho "$1" > "$2"\n')
+    packer = Packer(tmpdir.join('test.pack'))
+    packer.add('cmd', tmpdir.join('cmd.sh'))
+    packer.close()
+    source = Pack('pack+file://%s#cmd' % tmpdir.join('test.pack'))
+    source.run(tmpdir.join('cache').ensure(dir=True),
+               ['hi', str(tmpdir.join('hi.txt'))])
+    assert tmpdir.join('hi.txt').read().strip() == 'hi'
+    with pytest.raises(pack.Invalid):
+        Pack('pack+file://%s' % tmpdir.join('test.pack'))
+    with pytest.raises(Invalid):
+        PackFile(tmpdir.join('cmd.sh'))
@@ -1,8 +1,14 @@
 import pytest
+import six
 
+from ... import arx
+from ...cache import Store, store_injector
 from ...decorators import InvalidScheme
-from ..http import HTTP, HTTPJar, HTTPTar
-from ..s3 import no_credentials, S3, S3Jar, S3Tar, Invalid
+from .. import s3
+from ..http import HTTP, HTTPJar, HTTPTar, HTTPZip
+from ..s3 import no_credentials, S3, S3Jar, S3Tar, S3Zip, Invalid
+from ...util.tarindex import Index
+from . import tarball, zipball
 
 
 skip = pytest.mark.skipif(no_credentials, reason='No AWS tokens can be found.')
@@ -58,3 +64,171 @@ def test_jar():
 
     with pytest.raises(InvalidScheme):
         src = S3Jar('https://aol.com/web.jar')
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    """A mock S3 bucket, ``arx``, provided by ``moto``."""
+    moto = pytest.importorskip('moto')
+    for var in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_s3():
+        reset()
+        s3.client().create_bucket(Bucket='arx')
+        yield s3.client()
+    reset()
+
+
+def reset():
+    for memo in [s3._clients, s3._sessions, s3._signed]:
+        memo.clear()
+
+
+def test_download(bucket, tmpdir):
+    body = six.b('0123456789' * 100)
+    bucket.put_object(Bucket='arx', Key='data', Body=body)
+    s3.download('arx', 'data', tmpdir.join('data'), chunksize=64)
+    assert tmpdir.join('data').read_binary() == body
+    assert not tmpdir.join('data.part').check()
+
+
+def test_cache(bucket, tmpdir):
+    bucket.put_object(Bucket='arx', Key='dir/a', Body=six.b('a'))
+    bucket.put_object(Bucket='arx', Key='dir/sub/b', Body=six.b('b'))
+    with store_injector.using(Store(tmpdir.join('store'))):
+        cached = S3('s3://arx/dir/sub/b').cache(tmpdir.join('file'))
+        assert cached.resolved.read() == 'b'
+        bucket.put_object(Bucket='arx', Key='dir/sub/b', Body=six.b('c'))
+        cached = S3('s3://arx/dir/sub/b').cache(tmpdir.join('changed'))
+        assert cached.resolved.read() == 'c'
+        synced = S3('s3://arx/dir/').cache(tmpdir.join('dir'))
+    assert synced.resolved.join('a').read() == 'a'
+    assert synced.resolved.join('sub', 'b').read() == 'c'
+
+
+def test_tar_streaming(bucket, tmpdir, monkeypatch):
+    body = tarball({'a/b': six.b('b')})
+    bucket.put_object(Bucket='arx', Key='a.tgz', Body=body)
+    store = Store(tmpdir.join('store'))
+    with store_injector.using(store):
+        src = S3Tar('tar+s3://arx/a.tgz#a/b')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('b'))
+        assert tmpdir.join('b').read() == 'b'
+        with monkeypatch.context() as m:
+            m.setattr(S3Tar, 'body', None)        # Unchanged, so not fetched.
+            src.place(tmpdir.join('again').ensure(dir=True),
+                      tmpdir.join('c'))
+        assert tmpdir.join('c').read() == 'b'
+        bucket.put_object(Bucket='arx', Key='a.tgz',
+                          Body=tarball({'a/b': six.b('changed')}))
+        src.place(tmpdir.join('changed').ensure(dir=True), tmpdir.join('d'))
+        assert tmpdir.join('d').read() == 'changed'
+
+
+def test_tar_member(bucket, tmpdir, monkeypatch):
+    archive = tmpdir.join('a.tar')
+    archive.write_binary(tarball({'a/b': six.b('b'), 'a/c': six.b('c')},
+                                 mode='w'))
+    index = Index.build(archive)
+    bucket.put_object(Bucket='arx', Key='a.tar', Body=archive.read_binary())
+    bucket.put_object(Bucket='arx', Key='a.tar.index.json',
+                      Body=six.b(index.dumps()))
+    monkeypatch.setattr(S3Tar, 'stream', None)      # Must not be needed.
+    with store_injector.using(None):
+        src = S3Tar('tar+s3://arx/a.tar#a/c')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('c'))
+    assert tmpdir.join('c').read() == 'c'
+
+    # When the archive has changed, the index is not used.
+    index.size += 512
+    bucket.put_object(Bucket='arx', Key='a.tar.index.json',
+                      Body=six.b(index.dumps()))
+    monkeypatch.undo()
+    with store_injector.using(None):
+        src.place(tmpdir.join('again').ensure(dir=True), tmpdir.join('d'))
+    assert tmpdir.join('d').read() == 'c'
+
+
+def test_zip_member(bucket, tmpdir, monkeypatch):
+    body = zipball({'a/b': six.b('b'), 'a/c': six.b('c')})
+    bucket.put_object(Bucket='arx', Key='a.zip', Body=body)
+    monkeypatch.setattr(S3Zip, 'cache', None)       # Must not be needed.
+    with store_injector.using(None):
+        src = S3Zip('zip+s3://arx/a.zip#a/')
+        src.place(tmpdir.join('cache').ensure(dir=True), tmpdir.join('a'))
+    assert tmpdir.join('a', 'c').read() == 'c'
+    assert isinstance(src.sign(), HTTPZip)
+
+
+def test_sync(bucket, tmpdir, monkeypatch):
+    for key in ['p/a', 'p/b', 'p/sub/c', 'p/sub/deeper/d']:
+        bucket.put_object(Bucket='arx', Key=key, Body=six.b(key))
+    src, manifest = S3('s3://arx/p/'), tmpdir.join('manifest.json')
+    src.sync(tmpdir.join('data'), manifest)
+    assert tmpdir.join('data', 'sub', 'deeper', 'd').read() == 'p/sub/deeper/d'
+
+    bucket.put_object(Bucket='arx', Key='p/a', Body=six.b('changed'))
+    bucket.delete_object(Bucket='arx', Key='p/sub/deeper/d')
+    fetched = []
+    original = s3.download
+
+    def download(bucket, key, *args, **kwargs):
+        fetched.append(key)
+        return original(bucket, key, *args, **kwargs)
+
+    monkeypatch.setattr(s3, 'download', download)
+    src.sync(tmpdir.join('data'), manifest)
+    assert fetched == ['p/a']
+    assert tmpdir.join('data', 'a').read() == 'changed'
+    assert not tmpdir.join('data', 'sub', 'deeper').check()
+    assert sorted(s3.load_manifest(manifest)) == ['a', 'b', 'sub/c']
+
+
+def test_sync_outside(bucket, tmpdir):
+    tmpdir.join('victim').write('victim')
+    for key in ['p/a', 'p/../victim', 'p/sub/../../victim']:
+        bucket.put_object(Bucket='arx', Key=key, Body=six.b('evil'))
+    src, manifest = S3('s3://arx/p/'), tmpdir.join('manifest.json')
+    src.sync(tmpdir.join('data'), manifest)
+    assert tmpdir.join('data', 'a').read() == 'evil'
+    assert tmpdir.join('victim').read() == 'victim'
+    assert sorted(s3.load_manifest(manifest)) == ['a']
+    s3.prune(tmpdir.join('data'), '../victim')
+    assert tmpdir.join('victim').check()
+
+
+def test_shared_clients(bucket):
+    assert s3.client() is bucket
+    assert s3.client(region='eu-west-1') is not bucket
+    assert s3.client(region='eu-west-1') is s3.client(region='eu-west-1')
+    src = S3('s3://arx/key?region=eu-west-1')
+    assert src.key == 'key'
+    assert src.client is s3.client(region='eu-west-1')
+
+
+def test_presign(bucket):
+    src = S3('s3://arx/key')
+    link = src.signed_get(3600)
+    assert 'X-Amz-Signature' in link or 'Signature' in link
+    assert S3('s3://arx/key').signed_get(3600) is link
+    assert S3('s3://arx/key').signed_get(1800) is link
+    assert S3('s3://arx/key').signed_get(7200) is not link
+    assert isinstance(S3Tar('tar+s3://arx/key').sign(), HTTPTar)
+
+
+def test_bundle_sign(bucket):
+    bundle = arx.Bundle(code=[dict(source='s3://arx/run.sh')],
+                        data=[dict(source='tar+s3://arx/x.tgz#bin/',
+                                   target='bin'),
+                              dict(source='s3://arx/dir/'),
+                              dict(source='https://example.com/x')])
+    signed = bundle.sign(600)
+    assert isinstance(signed.code[0].source, HTTP)
+    assert isinstance(signed.data[0].source, HTTPTar)
+    assert signed.data[0].source.fragment == 'bin/'
+    assert signed.data[0].target == 'bin'
+    assert isinstance(signed.data[1].source, S3)
+    assert isinstance(bundle.code[0].source, S3)
+    primitive = signed.to_primitive()
+    assert primitive['code'][0]['source'].startswith('https://')
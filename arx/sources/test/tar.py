@@ -0,0 +1,122 @@
+import io
+import tarfile
+
+import pytest
+import six
+
+from ...cache import Store, store_injector
+from ...util import tarindex
+from ..files import FileTar
+from .. import tar
+from ..tar import extract, Invalid, select
+from . import tarball
+
+
+files = {'proj-1.0/README': six.b('readme'),
+         'proj-1.0/src/main.py': six.b('main'),
+         'proj-1.0/src/lib/util.py': six.b('util')}
+
+
+def unpack(tmpdir, fragment=None, data=None):
+    out = tmpdir.join('out')
+    extract(io.BytesIO(data or tarball(files)), out, fragment)
+    return out
+
+
+def test_select():
+    assert select('./a/b/c', [], 0) == 'a/b/c'
+    assert select('a/b/c', [], 1) == 'b/c'
+    assert select('a/b/c', ['a', 'b'], 2) == 'c'
+    assert select('a/x/c', ['a', 'b'], 2) is None
+    assert select('a', [], 1) is None
+    assert select('a/../../etc', [], 0) is None
+
+
+def test_extract(tmpdir):
+    out = unpack(tmpdir.join('whole'))
+    assert out.join('proj-1.0', 'src', 'main.py').read() == 'main'
+
+    out = unpack(tmpdir.join('strip'), '/')
+    assert out.join('README').read() == 'readme'
+    assert out.join('src', 'lib', 'util.py').read() == 'util'
+
+    out = unpack(tmpdir.join('subdir'), 'proj-1.0/src/')
+    assert sorted(p.basename for p in out.listdir()) == ['lib', 'main.py']
+
+    out = unpack(tmpdir.join('file'), 'proj-1.0/src/main.py')
+    assert out.read() == 'main'
+
+    with pytest.raises(Invalid):
+        unpack(tmpdir.join('missing'), 'proj-1.0/missing')
+
+    with pytest.raises(Invalid):
+        unpack(tmpdir.join('garbage'), data=six.b('not a tarball' * 100))
+
+
+def test_extract_uncompressed(tmpdir):
+    out = unpack(tmpdir, '/', tarball(files, mode='w'))
+    assert out.join('src', 'main.py').read() == 'main'
+
+
+def test_extract_links(tmpdir):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as archive:
+        link = tarfile.TarInfo('top/escape')
+        link.type, link.linkname = tarfile.SYMTYPE, '/'
+        archive.addfile(link)
+        body = tarfile.TarInfo('top/escape/tmp/arx-escaped')
+        archive.addfile(body, io.BytesIO())
+        inside = tarfile.TarInfo('top/a')
+        inside.size = 1
+        archive.addfile(inside, io.BytesIO(six.b('a')))
+        hard = tarfile.TarInfo('top/b')
+        hard.type, hard.linkname = tarfile.LNKTYPE, 'top/a'
+        archive.addfile(hard)
+    out = unpack(tmpdir, '/', data.getvalue())
+    assert out.join('escape').islink()
+    assert not out.join('escape', 'tmp', 'arx-escaped').check()
+    assert out.join('b').read() == 'a'
+
+
+def test_extract_hard_links(tmpdir):
+    victim = tmpdir.join('outside', 'victim').ensure()
+    victim.chmod(0o600)
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as archive:
+        link = tarfile.TarInfo('top/escape')
+        link.type, link.linkname = tarfile.SYMTYPE, str(victim.dirpath())
+        archive.addfile(link)
+        hard = tarfile.TarInfo('top/grab')
+        hard.type, hard.linkname = tarfile.LNKTYPE, 'top/escape/victim'
+        hard.mode = 0o777
+        archive.addfile(hard)
+    out = unpack(tmpdir.join('in'), '/', data.getvalue())
+    assert not out.join('grab').check()
+    assert victim.stat().mode & 0o777 == 0o600
+    assert victim.stat().nlink == 1
+
+
+def test_place_indexed(tmpdir):
+    archive = tmpdir.join('a.tar')
+    archive.write_binary(tarball(files, mode='w'))
+    store = Store(tmpdir.join('store'))
+    with store_injector.using(store):
+        src = FileTar('tar+file://' + str(archive) + '#proj-1.0/src/main.py')
+        src.place(tmpdir.join('cache'), tmpdir.join('main.py'))
+    assert tmpdir.join('main.py').read() == 'main'
+    assert store.index(tarindex.identity(archive)).check(file=True)
+
+
+def test_place_unpacked(tmpdir, monkeypatch):
+    archive = tmpdir.join('a.tgz')
+    archive.write_binary(tarball(files))
+    store = Store(tmpdir.join('store'))
+    src = FileTar('tar+file://' + str(archive) + '#/')
+    with store_injector.using(store):
+        src.place(tmpdir.join('cache'), tmpdir.join('first'))
+        monkeypatch.setattr(tar, 'extract', None)     # Must not be needed.
+        src.place(tmpdir.join('cache'), tmpdir.join('second'))
+    assert tmpdir.join('second', 'src', 'main.py').read() == 'main'
+    assert store.stats()['trees'] == 1
+    tmpdir.join('second', 'src', 'new.py').write('new')
+    assert not tmpdir.join('first', 'src', 'new.py').check()
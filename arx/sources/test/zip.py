@@ -0,0 +1,73 @@
+import io
+import os
+import zipfile
+
+import pytest
+import six
+
+from ...util.ranged import opened
+from ..files import FileZip
+from ..zip import extract, Invalid
+from . import zipball
+
+
+files = {'proj-1.0/README': six.b('readme'),
+         'proj-1.0/src/main.py': six.b('main'),
+         'proj-1.0/src/lib/util.py': six.b('util')}
+
+
+def unpack(tmpdir, fragment=None, data=None):
+    out = tmpdir.join('out')
+    extract(io.BytesIO(data or zipball(files)), out, fragment)
+    return out
+
+
+def test_extract(tmpdir):
+    out = unpack(tmpdir.join('whole'))
+    assert out.join('proj-1.0', 'src', 'main.py').read() == 'main'
+
+    out = unpack(tmpdir.join('strip'), '/')
+    assert out.join('src', 'lib', 'util.py').read() == 'util'
+
+    out = unpack(tmpdir.join('subdir'), 'proj-1.0/src/')
+    assert sorted(p.basename for p in out.listdir()) == ['lib', 'main.py']
+
+    out = unpack(tmpdir.join('file'), 'proj-1.0/README')
+    assert out.read() == 'readme'
+
+    with pytest.raises(Invalid):
+        unpack(tmpdir.join('missing'), 'proj-1.0/missing')
+
+    with pytest.raises(Invalid):
+        unpack(tmpdir.join('garbage'), data=six.b('not a zip'))
+
+
+def test_extract_modes(tmpdir):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        info = zipfile.ZipInfo('bin/tool')
+        info.external_attr = 0o100755 << 16
+        archive.writestr(info, six.b('#!/bin/sh\n'))
+        info = zipfile.ZipInfo('../escape')
+        archive.writestr(info, six.b('x'))
+    out = unpack(tmpdir, data=data.getvalue())
+    assert os.access(str(out.join('bin', 'tool')), os.X_OK)
+    assert not tmpdir.join('escape').check()
+
+
+def test_place(tmpdir):
+    archive = tmpdir.join('a.zip')
+    archive.write_binary(zipball(files))
+    src = FileZip('zip+file://' + str(archive) + '#//')
+    src.place(tmpdir.join('cache'), tmpdir.join('out'))
+    assert tmpdir.join('out', 'main.py').read() == 'main'
+
+
+def test_ranged():
+    members = dict(('%d' % i, os.urandom(20000)) for i in range(50))
+    data = zipball(members)
+    data_file = opened(lambda start, end: data[start:end + 1], len(data),
+                       data[-4096:], buffer_size=4096)
+    with zipfile.ZipFile(data_file) as archive:
+        assert archive.read('7') == members['7']
+    assert data_file.raw.fetches < 10
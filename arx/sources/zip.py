@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+import os
+import shutil
+import stat
+import zipfile
+
+from magiclog import log
+import py.path
+from sh import chmod, Command
+
+from ..err import Err
+from ..util.tarindex import components
+from ..util.transfer import retrying, transient
+from .core import onepath, twopaths
+from .tar import inside, select
+
+
+class Zip(object):
+    """Mixin for zip archives.
+
+    Fragments are treated as they are for :class:`~arx.sources.tar.Tar`: by
+    default, the archive has directory nature; a fragment that ends with
+    ``/`` selects a directory, with a leading directory stripped for each
+    slash; and any other fragment selects a file, which can be run.
+
+    A zip archive ends with a directory of its members and where they are, so
+    remote sources that can fetch byte ranges read the directory and then only
+    the members the fragment selects. Without a fragment, the whole archive is
+    downloaded.
+    """
+
+    @twopaths
+    def place(self, cache, path):
+        def attempt():
+            with self.archive(cache) as handle:
+                extract(handle, path, self.url.fragment)
+
+        retrying(attempt, retriable=transient, label=str(self))
+
+    @onepath
+    @contextmanager
+    def archive(self, cache):
+        """Yields the archive as a seekable file.
+
+        By default, the archive is cached and read from disk; remote sources
+        override this to read only the parts that are needed.
+        """
+        with open(str(self.cache(cache).resolved), 'rb') as h:
+            yield h
+
+    @onepath
+    def run(self, cache, args=[]):
+        if self.url.fragment is None:
+            raise Invalid('Arx can not execute zip URLs that have no '
+                          'fragment.')
+        program = cache.join('program', self.url.fragment.split('/')[-1])
+        self.place(cache, program)
+        chmod('a+rx', str(program))
+        cmd = Command(str(program))
+        cmd(*args)
+
+    @onepath
+    def dataname(self, cache):
+        return cache.join('data.zip')
+
+
+def extract(handle, path, fragment=None):
+    """Unpacks the zip archive open as ``handle``, as selected by the
+       fragment, to ``path``.
+    """
+    path = py.path.local(path)
+    try:
+        with zipfile.ZipFile(handle) as archive:
+            if fragment is None or fragment.endswith('/'):
+                unpack(archive, path.ensure(dir=True), fragment or '')
+                return
+            path.dirpath().ensure(dir=True)
+            wanted = components(fragment)
+            for info in archive.infolist():
+                if (components(info.filename) == wanted and
+                        not info.filename.endswith('/')):
+                    write(archive, info, str(path))
+                    return
+            raise Invalid('Not found in the archive: %s' % fragment)
+    except zipfile.BadZipfile as e:
+        raise Invalid('Not able to unpack archive: %s' % e, cause=e)
+
+
+def unpack(archive, path, fragment):
+    root = os.path.realpath(str(path))
+    strip = fragment.count('/')
+    prefix = components(fragment)
+    for info in archive.infolist():
+        name = select(info.filename, prefix, strip)
+        if name is None:
+            continue
+        dest = os.path.join(root, name)
+        if not inside(root, dest):
+            log.warning('Skipping archive member outside of %s: %s',
+                        root, info.filename)
+            continue
+        if info.filename.endswith('/'):
+            py.path.local(dest).ensure(dir=True)
+            continue
+        py.path.local(dest).dirpath().ensure(dir=True)
+        write(archive, info, dest)
+
+
+def write(archive, info, dest):
+    """Writes a member to ``dest``, with its permissions and, for members
+       that are symlinks, as a symlink.
+    """
+    mode = info.external_attr >> 16
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if stat.S_ISLNK(mode):
+        os.symlink(archive.read(info).decode('utf-8'), dest)
+        return
+    with archive.open(info) as member, open(dest, 'wb') as h:
+        shutil.copyfileobj(member, h)
+    if mode & 0o7777:
+        os.chmod(dest, mode & 0o7777)
+
+
+class Invalid(Err):
+    pass
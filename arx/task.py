@@ -0,0 +1,58 @@
+import sys
+
+from magiclog import log
+import py.path
+from sh import Command
+
+from . import arx
+from .bundle import Bundle, pinned_to
+from .util import runnable
+from .util.tmp import tmpdir
+
+
+class Task(object):
+    """Runs a bundle: places all of its data and then runs its code.
+
+    Everything happens in the bundle's ``cwd`` or, if it has none, in a
+    temporary directory. Up to ``jobs`` sources are fetched at once.
+    """
+
+    def __init__(self, bundle, jobs=4):
+        if not isinstance(bundle, Bundle):
+            bundle = arx.Bundle(bundle)
+        self.bundle = bundle
+        self.jobs = jobs
+
+    def run(self):
+        with tmpdir() as tmp:
+            tmp = py.path.local(tmp)
+            cwd = py.path.local(self.bundle.cwd or tmp.join('cwd'))
+            cwd.ensure(dir=True)
+            log.debug('Placing data in: %s', cwd)
+            self.bundle.place(tmp, cwd, jobs=self.jobs)
+            for i, code in enumerate(self.bundle.code or []):
+                cache = tmp.join('code', str(i)).ensure(dir=True)
+                env = dict(self.bundle.env or {}, **(code.env or {}))
+                step = Step(code, cache, cwd=code.cwd or str(cwd), env=env)
+                runnable.run(step)
+
+
+class Step(runnable.Runnable):
+    """Runs one :class:`~arx.bundle.Code`, in a subprocess."""
+
+    def __init__(self, code, cache, cwd=None, env={}):
+        super(Step, self).__init__(cwd=cwd, env=env)
+        self.code = code
+        self.cache = cache
+
+    def run(self):
+        args = self.code.args or []
+        if self.code.source is not None:
+            with pinned_to(self.code):
+                self.code.source.run(self.cache, args)
+        else:
+            cmd = Command(self.code.cmd)
+            cmd(*args, _out=sys.stdout, _err=sys.stderr)
+
+    def __repr__(self):
+        return 'Step(%r)' % self.code
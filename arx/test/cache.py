@@ -0,0 +1,111 @@
+import os
+import threading
+
+import pytest
+
+from ..cache import BadDigest, BadSize, normalize, parse_digest, parse_size
+from ..cache import sha256, Store
+from ..util.transfer import Hashing
+
+
+def test_normalize():
+    assert (normalize('HTTPS://Example.COM:443/a.tgz#x') ==
+            'https://example.com/a.tgz')
+    assert (normalize('http://example.com:8080/a?b=c') ==
+            'http://example.com:8080/a?b=c')
+    assert normalize('s3://bucket/key') == 's3://bucket/key'
+
+
+def test_parse_size():
+    assert parse_size('512') == 512
+    assert parse_size('2k') == 2048
+    assert parse_size('1.5G') == 3 << 29
+    with pytest.raises(BadSize):
+        parse_size('lots')
+
+
+def test_digests():
+    digest = sha256(b'abc')
+    assert parse_digest('SHA256:' + digest.upper()) == digest
+    with pytest.raises(BadDigest):
+        parse_digest('md5:900150983cd24fb0d6963f7d28e17f72')
+    sink = Hashing()
+    for block in [b'a', b'b', b'c']:
+        sink.write(block)
+    assert sink.hexdigest() == digest
+
+
+def test_put_get(tmpdir):
+    store = Store(tmpdir.join('store'))
+    data = tmpdir.join('data')
+    data.write('abc')
+    assert store.get('https://example.com/data', tmpdir.join('x')) is None
+
+    entry = store.put('https://example.com/data', data, etag='"v1"')
+    assert entry['size'] == 3
+    assert entry['etag'] == '"v1"'
+
+    out = tmpdir.join('out', 'data')
+    got = store.get('HTTPS://example.com:443/data', out)
+    assert got['digest'] == entry['digest']
+    assert out.read() == 'abc'
+
+    # Identical data from another URL shares one object.
+    store.put('https://mirror.example.com/data', data)
+    assert store.stats()['entries'] == 2
+    assert store.stats()['objects'] == 1
+
+
+def test_gc(tmpdir):
+    store = Store(tmpdir.join('store'))
+    for i, name in enumerate(['old', 'new']):
+        data = tmpdir.join(name)
+        data.write(name * 100)
+        entry = store.put('https://example.com/' + name, data)
+        os.utime(str(store.obj(entry['digest'])), (i, i))
+    assert store.stats()['size'] == 600
+
+    assert store.gc(400) == 300
+    assert store.entry('https://example.com/old') is None
+    assert store.entry('https://example.com/new') is not None
+    assert store.stats()['entries'] == 1
+
+
+def test_gc_over_limit(tmpdir, monkeypatch):
+    store, collected = Store(tmpdir.join('store'), limit=1000), []
+    original = store.gc
+    monkeypatch.setattr(store, 'gc', lambda limit: collected.append(limit) or
+                        original(limit))
+    for i in range(4):
+        data = tmpdir.join(str(i))
+        data.write(str(i) * 300)
+        store.put('https://example.com/%d' % i, data)
+    assert collected == [1000]                  # Only once it is over 1000.
+    assert store.stats()['size'] == 900
+    assert store.estimate == 900
+
+
+def test_lock(tmpdir):
+    store = Store(tmpdir.join('store'))
+    held, release, outcomes = threading.Event(), threading.Event(), []
+
+    def hold():
+        with store.lock('https://example.com/a') as waited:
+            outcomes.append(waited)
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    with store.lock('https://example.com/b') as waited:
+        assert not waited                               # Another URL.
+    threading.Timer(0.1, release.set).start()
+    with store.lock('HTTPS://example.com/a') as waited:
+        assert waited
+    holder.join()
+    assert outcomes == [False]
+
+    store.partial_ttl = -1
+    store.gc()
+    assert not list(store.locks.visit('*.lock'))
@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+import os
+import subprocess
+import sys
+
+import pytest
+import six
+
+from ..cache import sha256, Store, store_injector
+from ..proxy import byterange, check, Refused
+from ..sources.http import HTTP, HTTPTar
+from ..sources.test import serving, tarball
+from ..util.httpclient import HTTPError, pool, proxied
+from ..util.pool import concurrently
+
+
+@contextmanager
+def proxying(store, monkeypatch, *allow):
+    """Runs a proxy for the store in another process, with ``ARX_PROXY`` set
+       to it for the duration of the block.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop('ARX_PROXY', None)
+    server = subprocess.Popen([sys.executable, '-c', script, str(store)] +
+                              list(allow), env=env, stdout=subprocess.PIPE)
+    try:
+        url = server.stdout.readline().decode('utf-8').split()[-1]
+        monkeypatch.setenv('ARX_PROXY', url)
+        yield url
+    finally:
+        server.terminate()
+        server.wait()
+        server.stdout.close()
+        pool.clear()
+
+
+script = """
+import sys
+from arx.cache import Store
+from arx.proxy import serve
+
+
+def ready(server):
+    print(server.url)
+    sys.stdout.flush()
+
+
+serve(Store(sys.argv[1]), port=0, ready=ready, allow=sys.argv[2:])
+"""
+
+
+def test_byterange():
+    assert byterange(None, 10) is None
+    assert byterange('bytes=2-4', 10) == (2, 4)
+    assert byterange('bytes=2-', 10) == (2, 9)
+    assert byterange('bytes=-3', 10) == (7, 9)
+    assert byterange('bytes=5-100', 10) == (5, 9)
+    assert byterange('bytes=0-1,4-5', 10) is None
+    assert byterange('bytes=10-', 10) == ()
+
+
+def test_check():
+    for url in ['http://127.0.0.1/a', 'http://localhost:8080/a',
+                'http://169.254.169.254/latest/meta-data/', 'http://[::1]/a',
+                'http://0.0.0.0/a', 'http://[::ffff:127.0.0.1]/a',
+                'http://10.0.0.1/a', 'http://172.16.0.1/a',
+                'https://192.168.1.1/a', 'http://100.64.0.1/a',
+                'http://224.0.0.1/a', 'http://240.0.0.1/a',
+                'http://[fc00::1]/a', 'http://[ff02::1]/a',
+                'http://[::ffff:10.0.0.1]/a', 'http://arx.invalid/a']:
+        with pytest.raises(Refused):
+            check(url)
+    assert check('http://93.184.216.34/a') == '93.184.216.34'
+    assert check('http://[2606:2800:220:1::]/a') == '2606:2800:220:1::'
+    assert check('s3://bucket/key') is None
+    assert check('http://127.0.0.1:8080/a', ['http://127.0.0.1:8080/']) is None
+    with pytest.raises(Refused):
+        check('https://example.com/a', ['https://data.example.com/'])
+
+
+def test_proxy(tmpdir, monkeypatch):
+    data = six.b('a' * 100000)
+    files = {'/a.txt': data, '/b.tgz': tarball({'b/c.txt': six.b('ccc')})}
+    with serving(files) as origin, \
+            proxying(tmpdir.join('proxy'), monkeypatch, origin.url + '/'), \
+            store_injector.using(None):
+        src = HTTP(origin.url + '/a.txt')
+        caches = [tmpdir.join(str(i)).ensure(dir=True) for i in range(8)]
+        found = concurrently(src.cache, caches, jobs=8)
+        assert all(f.resolved.read_binary() == data for f in found)
+        assert [path for path, _ in origin.requests] == ['/a.txt']
+
+        url = proxied(origin.url + '/a.txt')
+        assert pool.read_range(url, 10, 19) == six.b('a' * 10)
+        with pytest.raises(HTTPError) as info:
+            with pool.request('GET', proxied(origin.url + '/none')):
+                pass
+        assert info.value.status == 404
+
+        src = HTTPTar('tar+' + origin.url + '/b.tgz')
+        src.place(tmpdir.join('tar').ensure(dir=True), tmpdir.join('out'))
+        assert tmpdir.join('out', 'b', 'c.txt').read() == 'ccc'
+
+        # Pinned requests are served from the store, whatever the URL.
+        digest = sha256(data)
+        with store_injector.using(Store(tmpdir.join('store'))):
+            again = HTTP(origin.url + '/elsewhere?sha256=' + digest)
+            cached = again.cache(tmpdir.join('pinned'))
+            assert cached.resolved.read_binary() == data
+    assert '/elsewhere' not in [path for path, _ in origin.requests]
+
+
+def test_refused(tmpdir, monkeypatch):
+    files = {'/a.txt': six.b('a')}
+    with serving(files) as origin, \
+            proxying(tmpdir.join('proxy'), monkeypatch), \
+            store_injector.using(None):
+        with pytest.raises(HTTPError) as info:
+            with pool.request('GET', proxied(origin.url + '/a.txt')):
+                pass
+    assert info.value.status == 403
+    assert origin.requests == []
@@ -0,0 +1,158 @@
+import pytest
+import six
+
+from .. import arx
+from ..bundle import Bundle, Unlocked, Unpinnable
+from ..cache import Mismatch, sha256, Store, store_injector
+from ..sources.test import serving, tarball
+from ..sources.test.git import repository
+from ..task import Task
+from ..util.pool import concurrently, Failures
+
+
+def test_concurrently():
+    assert concurrently(lambda x: x * 2, range(5), jobs=3) == [0, 2, 4, 6, 8]
+
+    def odd(x):
+        if x % 2:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(Failures) as info:
+        concurrently(odd, range(5), jobs=3, label=lambda x: 'item %d' % x)
+    assert [item for item, _ in info.value.failures] == [1, 3]
+    assert 'item 3' in str(info.value)
+
+
+def test_place(tmpdir):
+    files = dict(('/%d.txt' % i, six.b(str(i))) for i in range(6))
+    with serving(files) as server, store_injector.using(None):
+        bundle = arx.Bundle(data=[dict(source=server.url + path)
+                                  for path in sorted(files)])
+        bundle.place(tmpdir.join('cache'), tmpdir.join('cwd'), jobs=3)
+        for i in range(6):
+            assert tmpdir.join('cwd', '%d.txt' % i).read() == str(i)
+
+        bundle += arx.Data(server.url + '/missing.txt', 'x/missing.txt')
+        with pytest.raises(Failures) as info:
+            bundle.place(tmpdir.join('again'), tmpdir.join('cwd2'), jobs=3)
+        assert len(info.value.failures) == 1
+        assert 'data[6]' in str(info.value)
+        assert tmpdir.join('cwd2', '5.txt').check(file=True)
+
+
+def test_task(tmpdir):
+    data = tmpdir.join('data.txt')
+    data.write('data')
+    task = Task(dict(cwd=str(tmpdir.join('cwd')),
+                     data=[dict(source='file:///' + str(data),
+                                target='in.txt')],
+                     code=[dict(cmd='cp', args=['in.txt', 'out.txt'])]))
+    task.run()
+    assert tmpdir.join('cwd', 'out.txt').read() == 'data'
+
+
+def test_run_http(tmpdir):
+    script = six.b('#!/bin/sh\necho "$@" > out.txt\n')
+    with serving({'/run.sh': script}) as server, store_injector.using(None):
+        task = Task(dict(cwd=str(tmpdir.join('cwd')),
+                         code=[dict(source=server.url + '/run.sh',
+                                    args=['ran'])]))
+        task.run()
+    assert tmpdir.join('cwd', 'out.txt').read() == 'ran\n'
+
+
+def test_pinned_locally(tmpdir):
+    tmpdir.join('a.txt').write('aaa\n')
+    right, wrong = sha256(six.b('aaa\n')), '0' * 64
+    for source in ['file://%s' % tmpdir.join('a.txt'), dict(text='aaa')]:
+        Bundle(data=[dict(source=source, target='a', digest=right)]).place(
+            tmpdir.join('cache'), tmpdir.join('cwd'))
+        with pytest.raises(Failures) as info:
+            Bundle(data=[dict(source=source, target='b', digest=wrong)]).place(
+                tmpdir.join('cache'), tmpdir.join('cwd'))
+        assert isinstance(info.value.failures[0][1], Mismatch)
+    assert not tmpdir.join('cwd', 'b').check()
+    with pytest.raises(Exception):
+        arx.Bundle(data=[dict(source='file://%s/' % tmpdir, digest=right)])
+    with pytest.raises(Failures) as info:
+        Bundle(data=[dict(source='git+file://%s' % tmpdir,
+                          digest=right)]).place(tmpdir.join('cache'),
+                                                tmpdir.join('cwd'))
+    assert isinstance(info.value.failures[0][1], Unpinnable)
+
+
+def test_link(tmpdir):
+    data = tmpdir.join('data.txt')
+    data.write('data')
+    bundle = arx.Bundle(data=[dict(source='file://' + str(data),
+                                   target='linked.txt', link='symlink')])
+    bundle.place(tmpdir.join('cache'), tmpdir.join('cwd'))
+    assert tmpdir.join('cwd', 'linked.txt').readlink() == str(data)
+
+
+def test_lock(tmpdir):
+    repository(tmpdir.join('repo'))
+    repo = 'git+file://%s?v1#VERSION' % tmpdir.join('repo')
+    with serving({'/a.txt': six.b('aaa')}) as server, \
+            store_injector.using(Store(tmpdir.join('store'))):
+        bundle = arx.Bundle(data=[dict(source=server.url + '/a.txt'),
+                                  dict(source=repo, target='VERSION')])
+        lock = bundle.lock(tmpdir.join('lock'))
+        pin = lock['sources'][server.url + '/a.txt']
+        assert pin['digest'] == 'sha256:' + sha256(six.b('aaa'))
+        assert pin['size'] == 3
+        assert '?v1' not in lock['sources'][repo]['url']
+
+        requests = len(server.requests)
+        locked = bundle.locked(lock)
+        locked.place(tmpdir.join('cache'), tmpdir.join('cwd'))
+        assert tmpdir.join('cwd', 'a.txt').read() == 'aaa'
+        assert tmpdir.join('cwd', 'VERSION').read() == 'v1'
+        assert len(server.requests) == requests          # All from the store.
+
+        bundle += arx.Data(server.url + '/b.txt')
+        with pytest.raises(Unlocked):
+            bundle.locked(lock)
+
+
+def test_prefetch(tmpdir):
+    files = {'/a.txt': six.b('aaa'),
+             '/b.tgz': tarball({'b/c.txt': six.b('ccc')})}
+    store = Store(tmpdir.join('store'))
+    with serving(files) as server, store_injector.using(store):
+        bundle = arx.Bundle(data=[dict(source=server.url + '/a.txt'),
+                                  dict(source='tar+' + server.url + '/b.tgz'),
+                                  dict(source=server.url + '/a.txt',
+                                       target='again.txt')])
+        locked = bundle.locked(bundle.lock(tmpdir.join('lock')))
+        locked.prefetch(tmpdir.join('prefetch'))
+        assert len(store.trees.listdir()) == 1          # Kept unpacked.
+    with store_injector.using(store):                   # No server now.
+        locked.place(tmpdir.join('cache'), tmpdir.join('cwd'))
+    assert tmpdir.join('cwd', 'again.txt').read() == 'aaa'
+    assert tmpdir.join('cwd', 'b', 'c.txt').read() == 'ccc'
+
+
+def test_pack(tmpdir):
+    files = {'/a.txt': six.b('aaa'),
+             '/b.tgz': tarball({'b/c.txt': six.b('ccc'),
+                                'd.txt': six.b('aaa')})}
+    with serving(files) as server, store_injector.using(None):
+        bundle = arx.Bundle(data=[dict(source=server.url + '/a.txt'),
+                                  dict(source='tar+' + server.url + '/b.tgz'),
+                                  dict(source=dict(text='hi'),
+                                       target='hi.txt')],
+                            code=[dict(cmd='true')])
+        packed = bundle.pack(tmpdir.join('tmp'), tmpdir.join('b.pack'))
+    text = packed.to_primitive()
+    assert [d.get('target') for d in text['data']] == ['a.txt', None,
+                                                       'hi.txt']
+    assert all(d['source'].startswith('pack+file://') for d in text['data'])
+    assert text['code'] == [dict(cmd='true')]
+    tmpdir.join('tmp').remove(rec=1)
+    arx.Bundle(text).place(tmpdir.join('cache'), tmpdir.join('cwd'))
+    assert tmpdir.join('cwd', 'a.txt').read() == 'aaa'
+    assert tmpdir.join('cwd', 'b', 'c.txt').read() == 'ccc'
+    assert tmpdir.join('cwd', 'd.txt').read() == 'aaa'
+    assert tmpdir.join('cwd', 'hi.txt').read() == 'hi\n'
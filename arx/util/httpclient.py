@@ -0,0 +1,297 @@
+"""An in-process HTTP/S client, which keeps connections alive between requests.
+
+Sources fetch many files from the same few origins; reusing connections spares
+each file a TCP (and TLS) handshake, and doing it in process spares a fork and
+exec per file.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import socket
+import threading
+
+from magiclog import log
+from six.moves import http_client
+from six.moves.urllib.parse import urlencode, urljoin, urlsplit
+
+from ..err import Err
+from .pool import causes, concurrently
+from .transfer import retrying, split, transient, Transfer, validator
+
+
+class Pool(object):
+    """Keeps idle connections per scheme, host and port, for reuse.
+
+    At most ``per_host`` idle connections are kept for any one origin;
+    connections beyond that are closed when released. Large downloads are
+    split into ``segments`` ranged requests (see :meth:`download`).
+
+    A ``guard`` can be set, to be called with every URL requested --
+    including those redirected to -- and raise for those that must not be.
+    It may return the address to connect to, for the URL's host: connections
+    are then made to that address, rather than to whatever the host resolves
+    to by then (the ``Host`` header and TLS are still for the host's name).
+    """
+
+    def __init__(self, per_host=8, timeout=60, segments=4,
+                 segment_min=64 << 20):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.segments = segments
+        self.segment_min = segment_min
+        self.lock = threading.Lock()
+        self.idle = defaultdict(list)
+        self.guard = None
+
+    def acquire(self, origin, address=None):
+        """Takes an idle connection to the origin, or opens a new one -- to
+           ``address``, if one is given.
+
+        Returns the connection and whether it was reused.
+        """
+        with self.lock:
+            if len(self.idle[(origin, address)]) > 0:
+                return self.idle[(origin, address)].pop(), True
+        scheme, host, port = origin
+        cls = (http_client.HTTPSConnection if scheme == 'https' else
+               http_client.HTTPConnection)
+        conn = cls(host, port, timeout=self.timeout)
+        if address is not None:
+            conn._create_connection = connector(address)
+        return conn, False
+
+    def release(self, origin, conn, address=None):
+        with self.lock:
+            if len(self.idle[(origin, address)]) < self.per_host:
+                self.idle[(origin, address)].append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, defaultdict(list)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    @contextmanager
+    def request(self, method, url, headers={}, redirects=10):
+        """Sends a request, following redirects, and yields the response.
+
+        The URL of the final response is available as ``response.url``.
+        Responses with an error status raise :class:`HTTPError`, much like
+        ``curl -f``. The connection is returned to the pool if the body has
+        been read completely by the end of the ``with`` block.
+        """
+        for _ in range(redirects + 1):
+            address = self.guard(url) if self.guard is not None else None
+            origin, conn, response = self.send(method, url, headers, address)
+            location = response.getheader('location')
+            if response.status in redirect_statuses and location:
+                response.read()
+                self.finish(origin, conn, response, address)
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                self.finish(origin, conn, response, address)
+                raise HTTPError('%s %s: %d %s' % (method, url, response.status,
+                                                  response.reason),
+                                status=response.status)
+            response.url = url
+            try:
+                yield response
+            finally:
+                self.finish(origin, conn, response, address)
+            return
+        raise HTTPError('Too many redirects, ending with: %s' % url)
+
+    def send(self, method, url, headers, address=None):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        origin = (scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        while True:
+            conn, reused = self.acquire(origin, address)
+            try:
+                conn.request(method, target, headers=headers)
+                return origin, conn, conn.getresponse()
+            except (http_client.HTTPException, socket.error) as e:
+                conn.close()
+                # An idle connection may have been closed by the server; in
+                # that case, a fresh connection is tried.
+                if not reused:
+                    raise
+                log.debug('Reopening connection to %s: %s', origin, e)
+
+    def finish(self, origin, conn, response, address=None):
+        if response.isclosed() and not response.will_close:
+            self.release(origin, conn, address)
+        else:
+            conn.close()
+
+    def download(self, url, path, headers={}, part=None, retries=4,
+                 backoff=1.0):
+        """Writes the body of a ``GET`` to ``path``, returning the status and
+           the (lowercased) response headers.
+
+        For ``304 Not Modified`` responses, nothing is written.
+
+        The body is first written to ``part`` (``path`` with ``.part``
+        appended, by default) and moved into place when complete. Network
+        failures are retried, with exponential backoff, resuming from the
+        data already written; a failed download left at ``part`` is resumed
+        by later calls, too, as long as the server's validator (``ETag`` or
+        ``Last-Modified``) is unchanged.
+
+        When the body is at least ``segment_min`` bytes and the server accepts
+        byte ranges -- and has a validator, to ensure that every part is of
+        the same data -- the rest of the body is fetched in ``segments`` parts
+        over parallel connections, while the first part is read from the
+        original response.
+        """
+        transfer = Transfer(part or str(path) + '.part')
+
+        def attempt():
+            try:
+                return self.attempt(url, transfer, headers)
+            except Exception as e:
+                if any(isinstance(c, RangeNotHonored) for c in causes(e)):
+                    log.warning('Restarting download of %s: ranges were not '
+                                'honored.', url)
+                    transfer.discard()
+                raise
+
+        status, found = retrying(attempt, retries, backoff, retriable,
+                                 label=url)
+        if status != 304:
+            transfer.finish(path)
+        return status, found
+
+    def attempt(self, url, transfer, headers):
+        if transfer.resumable(url):
+            log.debug('Resuming %s at: %s', url, transfer.missing())
+            concurrently(lambda span: self.segment(url, transfer, span),
+                         transfer.missing(), jobs=self.segments,
+                         label=lambda span: 'bytes %d-%d' % span)
+            return 200, transfer.headers
+        with self.request('GET', url, headers) as response:
+            found = dict((k.lower(), v) for k, v in response.getheaders())
+            if response.status == 304:
+                response.read()
+                return response.status, found
+            length = int(found.get('content-length') or -1)
+            transfer.reset(url, found, length)
+            if not self.segmentable(response.status, found, length):
+                transfer.write(response, 0, None if length < 0 else length)
+                return response.status, found
+            spans = split(length, self.segments)
+            log.debug('Fetching %s in %d segments.', response.url, len(spans))
+
+            def fetch(span):
+                if span[0] == 0:
+                    transfer.write(response, 0, span[1] + 1)
+                else:
+                    self.segment(response.url, transfer, span)
+
+            concurrently(fetch, spans, jobs=len(spans),
+                         label=lambda span: 'bytes %d-%d' % span)
+            return response.status, found
+
+    def segmentable(self, status, headers, length):
+        return (self.segments > 1 and status == 200 and
+                length >= max(self.segment_min, 1) and
+                headers.get('accept-ranges') == 'bytes' and
+                validator(headers) is not None and
+                headers.get('content-encoding') in (None, 'identity'))
+
+    def read_range(self, url, start, end, validator=None):
+        """The bytes of the inclusive range, of the data that has the given
+           validator (sent as ``If-Range``), if one is given.
+        """
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if validator is not None:
+            headers['If-Range'] = validator
+        with self.request('GET', url, headers) as response:
+            data = response.read()
+            if response.status != 206:
+                raise RangeNotHonored('Server did not honor range %d-%d of: '
+                                      '%s' % (start, end, url),
+                                      status=response.status)
+        return data
+
+    def segment(self, url, transfer, span):
+        """Fetches the inclusive byte range ``span`` of the URL, writing it at
+           the same offset of the transfer's part file.
+        """
+        start, end = span
+        headers = {'Range': 'bytes=%d-%d' % (start, end)}
+        if transfer.validator is not None:
+            headers['If-Range'] = transfer.validator
+        with self.request('GET', url, headers) as response:
+            expected = 'bytes %d-%d/' % (start, end)
+            found = response.getheader('content-range') or ''
+            if response.status != 206 or not found.startswith(expected):
+                raise RangeNotHonored('Server did not honor range %d-%d of: '
+                                      '%s' % (start, end, url),
+                                      status=response.status)
+            transfer.write(response, start, end - start + 1)
+
+
+def connector(address):
+    """A stand-in for ``socket.create_connection``, which connects to the
+       given address whatever host it is asked to.
+    """
+    def create_connection(target, *args, **kwargs):
+        return socket.create_connection((address, target[1]), *args,
+                                        **kwargs)
+    return create_connection
+
+
+def proxy():
+    """The caching proxy to fetch HTTP/S and S3 data through (see
+       :mod:`arx.proxy`), as set by ``ARX_PROXY``; or ``None``.
+    """
+    return os.environ.get('ARX_PROXY') or None
+
+
+def proxied(url, digest=None):
+    """The URL to fetch ``url`` from: by way of the proxy, if there is one,
+       passing on the ``digest`` the data is pinned to; or else ``url``.
+    """
+    if proxy() is None:
+        return url
+    query = [('url', url)] + ([('sha256', digest)] if digest else [])
+    return proxy().rstrip('/') + '/fetch?' + urlencode(query)
+
+
+def retriable(e):
+    for cause in causes(e):
+        if isinstance(cause, RangeNotHonored):
+            continue
+        if isinstance(cause, HTTPError):
+            if cause.status is not None and cause.status < 500:
+                return False
+            continue
+        if not transient(cause):
+            return False
+    return True
+
+
+redirect_statuses = set([301, 302, 303, 307, 308])
+
+
+pool = Pool()
+
+
+class HTTPError(Err):
+    def __init__(self, *args, **kwargs):
+        self.status = kwargs.pop('status', None)
+        super(HTTPError, self).__init__(*args, **kwargs)
+
+
+class RangeNotHonored(HTTPError):
+    pass
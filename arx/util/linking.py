@@ -0,0 +1,398 @@
+"""Placing files by linking them rather than copying their data.
+
+Data kept in the store is placed many times over. A reflink shares the blocks
+of a file with a new, independent file, on filesystems that support it (Btrfs,
+XFS, ZFS and others); elsewhere, a hard link shares the file itself.
+
+How files are placed can be chosen, for each entry of data, with the ``link``
+option (see :class:`~arx.bundle.Data`), which is one of:
+
+``reflink``
+    An independent copy, which shares blocks with the original where the
+    filesystem supports it, and is copied otherwise.
+
+``hardlink``
+    The original file itself, hard linked; copied when that is not possible,
+    as across filesystems. Writing to the placed file writes to the original.
+
+``symlink``
+    A symlink to the original file.
+
+``copy``
+    A copy, made in the kernel (with ``copy_file_range`` or ``sendfile``)
+    where possible.
+"""
+from contextlib import contextmanager
+import errno
+import json
+import os
+import shutil
+import stat
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:                                       # Not on Windows.
+    fcntl = None
+
+from magiclog import log
+import py.path
+
+from ..cache import filedigest
+from ..err import Err
+from .pool import concurrently
+
+
+FICLONE = 0x40049409                         # From <linux/fs.h>.
+
+
+def reflink(src, dest):
+    """Clones the file at ``src`` as ``dest``, sharing its blocks until either
+       is written to. Raises :class:`OSError` where reflinks are not
+       supported.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported.')
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except EnvironmentError as e:
+            os.remove(dest)
+            raise OSError(e.errno, str(e))
+
+
+def copy(src, dest):
+    """Copies the file at ``src`` to ``dest``, with its permissions and times,
+       without passing the data through user space where possible.
+
+    The copy is writable by its owner, even if ``src`` is not (as objects in
+    the store are not), since it is independent of ``src``.
+    """
+    replace(dest)
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        kernel_copy(s.fileno(), d.fileno(), os.fstat(s.fileno()).st_size)
+    copystat(src, dest)
+
+
+def copystat(src, dest):
+    """Like :func:`shutil.copystat`, but leaves ``dest`` writable by its
+       owner.
+    """
+    shutil.copystat(src, dest)
+    os.chmod(dest, stat.S_IMODE(os.stat(dest).st_mode) | stat.S_IWUSR)
+
+
+def kernel_copy(src, dest, size, blocksize=1 << 30):
+    """Copies ``size`` bytes between file descriptors, with
+       ``copy_file_range``, ``sendfile`` or -- failing both -- reads and
+       writes.
+    """
+    done = 0
+    for name in ['copy_file_range', 'sendfile']:
+        fn = getattr(os, name, None)
+        if fn is None:
+            continue
+        try:
+            while done < size:
+                if name == 'sendfile':
+                    n = fn(dest, src, done, min(blocksize, size - done))
+                else:
+                    n = fn(src, dest, min(blocksize, size - done), done, done)
+                if n == 0:
+                    break
+                done += n
+            return
+        except OSError as e:
+            if e.errno not in unsupported or done > 0:
+                raise
+    with os.fdopen(os.dup(src), 'rb') as s, os.fdopen(os.dup(dest), 'wb') as d:
+        shutil.copyfileobj(s, d)
+
+
+def reflink_or_copy(src, dest):
+    replace(dest)
+    try:
+        reflink(src, dest)
+        copystat(src, dest)
+    except OSError:
+        copy(src, dest)
+
+
+def hardlink(src, dest):
+    replace(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        copy(src, dest)
+
+
+def symlink(src, dest):
+    replace(dest)
+    os.symlink(os.path.abspath(src), dest)
+
+
+def clone(src, dest):
+    """Places the file at ``src`` as ``dest`` by reflinking it, hard linking
+       it or -- failing both -- copying it.
+
+    Reflinks and copies are made writable by their owner, since they are
+    independent of ``src``; hard links are not, since they are ``src``.
+    """
+    replace(dest)
+    mode = stat.S_IMODE(os.stat(src).st_mode)
+    try:
+        reflink(src, dest)
+    except OSError:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            copy(src, dest)
+    os.chmod(dest, mode | stat.S_IWUSR)
+
+
+def replace(dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+
+strategies = dict(reflink=reflink_or_copy, hardlink=hardlink, symlink=symlink,
+                  copy=copy)
+
+
+_current = threading.local()
+
+
+@contextmanager
+def using(strategy):
+    """Sets the strategy used by :func:`place`, in this thread, for the
+       duration of the block. With ``None``, each source uses its default.
+    """
+    if strategy is not None and strategy not in strategies:
+        raise UnknownStrategy('No such way to place files: %s' % strategy)
+    old = getattr(_current, 'strategy', None)
+    _current.strategy = strategy
+    try:
+        yield
+    finally:
+        _current.strategy = old
+
+
+def strategy(default=reflink_or_copy):
+    """The function that places files in this thread, which is ``default``
+       unless a strategy has been set with :func:`using`.
+    """
+    chosen = getattr(_current, 'strategy', None)
+    return strategies[chosen] if chosen is not None else default
+
+
+def place(src, dest, manifest=None):
+    """Places a file or -- recursively -- a directory with the strategy set
+       for this thread, creating the parent directory if need be.
+
+    Directories are placed incrementally, with :func:`sync`, using the
+    ``manifest``, if one is given.
+    """
+    src, dest = str(src), str(dest)
+    parent = os.path.dirname(dest)
+    if parent:
+        py.path.local(parent).ensure(dir=True)            # Safe for threads.
+    if os.path.isdir(src):
+        sync(src, dest, strategy(), manifest)
+    else:
+        strategy()(src, dest)
+
+
+def sync(src, dest, place=clone, manifest=None, jobs=8):
+    """Brings the tree at ``dest`` up to date with the tree at ``src``,
+       placing only the files that are missing or differ, ``jobs`` at a time.
+       Returns the number of files placed.
+
+    Files are compared by size and modification time and -- when only their
+    times differ -- by digest. The ``manifest`` file, if given, records the
+    files placed, so that files placed by an earlier sync, that are no longer
+    in ``src``, are removed; files in ``dest`` that were not placed from
+    ``src``, or have been changed since, are left alone.
+    """
+    src, dest = str(src), str(dest)
+    directories, entries = scan(src, jobs)
+    for rel in directories:
+        target = os.path.join(dest, rel)
+        if os.path.lexists(target) and not os.path.isdir(target):
+            os.remove(target)
+        py.path.local(target).ensure(dir=True)
+    placed = concurrently(lambda rel: update(src, dest, rel, place), entries,
+                          jobs=jobs)
+    old = load_manifest(manifest)
+    for rel in sorted(set(old) - set(entries)):
+        prune(dest, rel, old[rel], directories)
+    # Permissions are set last, in case directories are not writable.
+    for rel in reversed(directories):
+        shutil.copystat(os.path.join(src, rel), os.path.join(dest, rel))
+    if manifest is not None:
+        save_manifest(manifest, dict((rel, fingerprint(os.path.join(dest,
+                                                                    rel)))
+                                     for rel in entries))
+    log.debug('Placed %d of %d files from %s in: %s',
+              sum(placed), len(entries), src, dest)
+    return sum(placed)
+
+
+def scan(root, jobs=8):
+    """The directories and the other entries (files and symlinks) under
+       ``root``, as relative paths, with top-level directories walked
+       concurrently.
+    """
+    def isdir(path):
+        return os.path.isdir(path) and not os.path.islink(path)
+
+    def walk(top):
+        directories, entries = [], []
+        for at, dirnames, filenames in os.walk(os.path.join(root, top)):
+            rel = os.path.relpath(at, root)
+            directories += [rel]
+            links = [d for d in dirnames if not isdir(os.path.join(at, d))]
+            entries += [os.path.join(rel, name) for name in filenames + links]
+        return directories, entries
+
+    names = sorted(os.listdir(root))
+    directories = ['.']
+    entries = [name for name in names
+               if not isdir(os.path.join(root, name))]
+    for found, more in concurrently(walk, [name for name in names
+                                           if isdir(os.path.join(root, name))],
+                                    jobs=jobs):
+        directories += found
+        entries += more
+    return directories, entries
+
+
+def update(src, dest, rel, place):
+    """Places the entry ``rel`` unless it is current; returns ``True`` if it
+       was placed.
+    """
+    s, d = os.path.join(src, rel), os.path.join(dest, rel)
+    if os.path.islink(s):
+        target = os.readlink(s)
+        if os.path.islink(d) and os.readlink(d) == target:
+            return False
+        replace(d)
+        os.symlink(target, d)
+        return True
+    if current(s, d, place):
+        return False
+    place(s, d)
+    return True
+
+
+def current(s, d, place):
+    try:
+        found = os.lstat(d)
+    except OSError:
+        return False
+    if place is symlink:
+        return os.path.islink(d) and os.readlink(d) == os.path.abspath(s)
+    if not stat.S_ISREG(found.st_mode):
+        return False
+    wanted = os.stat(s)
+    if (wanted.st_dev, wanted.st_ino) == (found.st_dev, found.st_ino):
+        return True
+    if wanted.st_size != found.st_size:
+        return False
+    if wanted.st_mtime == found.st_mtime:
+        return True
+    if filedigest(s) == filedigest(d):
+        copystat(s, d)
+        return True
+    return False
+
+
+def prune(dest, rel, recorded, directories):
+    """Removes an entry placed earlier, if it is unchanged, along with any
+       directories left empty that are not wanted.
+    """
+    path = os.path.join(dest, rel)
+    if fingerprint(path) != recorded:
+        return
+    os.remove(path)
+    parent = os.path.dirname(rel)
+    while parent and parent not in directories:
+        try:
+            os.rmdir(os.path.join(dest, parent))
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def fingerprint(path):
+    try:
+        found = os.lstat(path)
+    except OSError:
+        return None
+    return [found.st_size, found.st_mtime]
+
+
+def load_manifest(manifest):
+    if manifest is None:
+        return {}
+    try:
+        with open(str(manifest)) as h:
+            return json.load(h)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest, placed):
+    manifest = str(manifest)
+    py.path.local(manifest).dirpath().ensure(dir=True)
+    tmp = '%s.%d.tmp' % (manifest, os.getpid())
+    with open(tmp, 'w') as h:
+        json.dump(placed, h)
+    os.rename(tmp, manifest)
+
+
+def mirror(src, dest, place=clone):
+    """Recreates the tree at ``src`` under ``dest``, placing each file with
+       ``place`` and recreating symlinks and directories.
+    """
+    src, dest = str(src), str(dest)
+    directories = []
+    for root, dirnames, filenames in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(root, src))
+        py.path.local(target).ensure(dir=True)
+        directories += [(root, target)]
+        for name in filenames + [d for d in dirnames
+                                 if os.path.islink(os.path.join(root, d))]:
+            path, to = os.path.join(root, name), os.path.join(target, name)
+            if os.path.islink(path):
+                replace(to)
+                os.symlink(os.readlink(path), to)
+            else:
+                place(path, to)
+    # Permissions are set last, in case directories are not writable.
+    for root, target in reversed(directories):
+        shutil.copystat(root, target)
+
+
+def freeze(path):
+    """Makes the files under ``path`` read-only -- as they are shared by hard
+       links -- while leaving directories writable by their owner, so that
+       the tree can be removed.
+    """
+    for root, dirnames, filenames in os.walk(str(path)):
+        os.chmod(root, stat.S_IMODE(os.stat(root).st_mode) | stat.S_IRWXU)
+        for name in filenames:
+            f = os.path.join(root, name)
+            if not os.path.islink(f):
+                mode = stat.S_IMODE(os.stat(f).st_mode)
+                os.chmod(f, mode & ~(stat.S_IWUSR | stat.S_IWGRP |
+                                     stat.S_IWOTH))
+
+
+unsupported = set([errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP,
+                   errno.EBADF])
+
+
+class UnknownStrategy(Err):
+    pass
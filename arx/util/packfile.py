@@ -0,0 +1,191 @@
+"""Packs: the data of many sources in one file, read with random access.
+
+A pack is an uncompressed tar archive, so it can be inspected with ordinary
+tools. Its first member, ``pack.json``, records the entries of the pack --
+each a file or a tree of files -- and where the data of every file is. The
+data follows, one member per distinct file, named by its digest; files with
+the same contents, in any entry, are stored once.
+
+Offsets in ``pack.json`` are relative to the end of that member, so the
+whole index is written before the data, and a reader needs only the first
+member to find any file, which it then reads from a memory map of the pack.
+"""
+import json
+import mmap
+import os
+import stat
+import tarfile
+import threading
+
+import py.path
+
+from ..cache import filedigest
+from ..err import Err
+from .tarindex import identity
+
+
+class Packer(object):
+    """Collects files and trees into a pack written to ``path``, when it is
+       closed.
+
+    The files are read when the pack is written, so they must stay in place
+    until then.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.entries = {}
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, path, kind=None):
+        """Adds the file or directory at ``path`` as the entry ``name``; the
+           ``kind`` of the entry can be given (as ``jar``) to say how it runs.
+        """
+        path = str(path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            entry = dict(kind='tree', files={}, links={}, dirs=[])
+            for root, dirnames, filenames in os.walk(path):
+                rel = os.path.relpath(root, path)
+                if rel != '.':
+                    entry['dirs'] += [rel]
+                for f in filenames + [d for d in dirnames
+                                      if os.path.islink(os.path.join(root,
+                                                                     d))]:
+                    self.record(entry, os.path.join(root, f),
+                                os.path.normpath(os.path.join(rel, f)))
+        else:
+            entry = dict(kind=kind or 'file', files={}, links={}, dirs=[])
+            self.record(entry, path, '')
+        with self.lock:
+            self.entries[name] = entry
+
+    def record(self, entry, path, rel):
+        if os.path.islink(path):
+            entry['links'][rel] = os.readlink(path)
+            return
+        digest = filedigest(path)
+        entry['files'][rel] = [digest, stat.S_IMODE(os.stat(path).st_mode)]
+        with self.lock:
+            self.objects.setdefault(digest, path)
+
+    def close(self):
+        """Writes the pack."""
+        layout, offset = {}, 0
+        for digest in sorted(self.objects):
+            size = os.path.getsize(self.objects[digest])
+            layout[digest] = [offset + tarfile.BLOCKSIZE, size]
+            offset += tarfile.BLOCKSIZE + blocks(size)
+        index = json.dumps(dict(version=1, entries=self.entries,
+                                objects=layout), sort_keys=True)
+        index = index.encode('utf-8')
+        tmp = self.path + '.tmp'
+        with tarfile.open(tmp, 'w', format=tarfile.USTAR_FORMAT) as archive:
+            archive.addfile(info('pack.json', len(index)),
+                            BytesReader(index))
+            for digest in sorted(self.objects):
+                with open(self.objects[digest], 'rb') as h:
+                    archive.addfile(info('objects/' + digest,
+                                         layout[digest][1]), h)
+        os.rename(tmp, self.path)
+
+
+class PackFile(object):
+    """A pack open for reading, with the data mapped into memory."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, 'rb') as h:
+            try:
+                with tarfile.open(fileobj=h, mode='r:') as archive:
+                    member = archive.next()
+                    if member is None or member.name != 'pack.json':
+                        raise Invalid('Not a pack: %s' % self.path)
+                    index = json.loads(archive.extractfile(member).read()
+                                       .decode('utf-8'))
+            except (tarfile.TarError, ValueError) as e:
+                raise Invalid('Not able to read pack %s: %s' % (self.path, e))
+            self.base = member.offset_data + blocks(member.size)
+            self.entries = index['entries']
+            self.objects = index['objects']
+            self.map = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def entry(self, name):
+        found = self.entries.get(name)
+        if found is None:
+            raise Invalid('No entry %s in pack: %s' % (name, self.path))
+        for rel in found['dirs'] + list(found['files']) + list(found['links']):
+            if os.path.isabs(rel) or os.pardir in rel.split('/'):
+                raise Invalid('Not placing %s, from outside of the entry %s '
+                              'in pack: %s' % (rel, name, self.path))
+        return found
+
+    def place(self, name, path):
+        """Writes the entry ``name`` at ``path``."""
+        entry, path = self.entry(name), str(path)
+        if entry['kind'] == 'tree':
+            for rel in [''] + entry['dirs']:
+                py.path.local(path).join(rel).ensure(dir=True)
+        else:
+            py.path.local(path).dirpath().ensure(dir=True)
+        for rel, (digest, mode) in entry['files'].items():
+            self.write(digest, os.path.join(path, rel) if rel else path, mode)
+        for rel, target in entry['links'].items():
+            dest = os.path.join(path, rel) if rel else path
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.symlink(target, dest)
+
+    def write(self, digest, dest, mode, blocksize=1 << 20):
+        offset, size = self.objects[digest]
+        start = self.base + offset
+        if os.path.lexists(dest):
+            os.remove(dest)
+        with open(dest, 'wb') as h:
+            for at in range(start, start + size, blocksize):
+                h.write(self.map[at:min(at + blocksize, start + size)])
+        os.chmod(dest, mode)
+
+    def close(self):
+        self.map.close()
+
+
+def load(path):
+    """The pack at ``path``, opened once per process (for as long as the file
+       is unchanged) and shared by the sources that read from it.
+    """
+    key = identity(path)
+    with _lock:
+        if key not in _packs:
+            _packs[key] = PackFile(path)
+        return _packs[key]
+
+
+def blocks(size):
+    """The space taken by ``size`` bytes of data in a tar archive."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def info(name, size):
+    member = tarfile.TarInfo(name)
+    member.size = size
+    member.mode = 0o444
+    return member
+
+
+class BytesReader(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self, n=-1):
+        n = len(self.data) if n is None or n < 0 else n
+        block, self.data = self.data[:n], self.data[n:]
+        return block
+
+
+_packs = {}
+_lock = threading.Lock()
+
+
+class Invalid(Err):
+    pass
@@ -0,0 +1,59 @@
+from multiprocessing.pool import ThreadPool
+import traceback
+
+from magiclog import log
+
+from ..err import Err
+
+
+def concurrently(fn, items, jobs=4, label=repr):
+    """Applies ``fn`` to every item, with up to ``jobs`` running at once.
+
+    Results are returned in the order of the items. Every item is attempted
+    even if some of them fail; the failures are then raised together, as
+    :class:`Failures`, with ``label`` used to describe the failing items.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+
+    def attempt(item):
+        try:
+            return True, fn(item)
+        except Exception as e:
+            log.debug('Failed on %s:\n%s', label(item), traceback.format_exc())
+            return False, e
+
+    if jobs is None or jobs <= 1 or len(items) == 1:
+        outcomes = [attempt(item) for item in items]
+    else:
+        pool = ThreadPool(min(jobs, len(items)))
+        try:
+            outcomes = pool.map(attempt, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [(item, result) for item, (ok, result) in zip(items, outcomes)
+              if not ok]
+    for item, e in failed:
+        log.error('Failed on %s: %s', label(item), e)
+    if len(failed) > 0:
+        raise Failures(failed, label)
+    return [result for _, result in outcomes]
+
+
+def causes(e):
+    """The underlying errors of a :class:`Failures`; or else, just ``e``."""
+    return [c for _, c in e.failures] if isinstance(e, Failures) else [e]
+
+
+class Failures(Err):
+    """Raised when some items of a concurrent operation fail. The pairs of
+       items and exceptions are available as ``failures``.
+    """
+    def __init__(self, failures, label=repr):
+        self.failures = failures
+        lines = ['%s: %s' % (label(item), e) for item, e in failures]
+        msg = '%d failed:\n  %s' % (len(failures), '\n  '.join(lines))
+        super(Failures, self).__init__(msg, cause=failures[0][1])
@@ -0,0 +1,67 @@
+"""Remote files read in part, with range requests.
+
+Some formats can be read without reading all of a file: zip archives list
+their members at the end, with the offset of each, so one member can be read
+by fetching the listing and then the member.
+"""
+import io
+
+
+class Ranged(io.RawIOBase):
+    """A read-only, seekable file of ``size`` bytes, which are fetched as they
+       are read.
+
+    ``fetch(start, end)`` returns the bytes of an inclusive range. The last
+    bytes of the file can be passed as ``tail``, as when they were fetched to
+    find out the size; they are not fetched again. The number of fetches is
+    counted in ``fetches``.
+    """
+
+    def __init__(self, fetch, size, tail=b''):
+        self.fetch = fetch
+        self.size = size
+        self.tail = tail
+        self.pos = 0
+        self.fetches = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position: %d' % offset)
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        tail_start = self.size - len(self.tail)
+        if self.pos >= tail_start:
+            start = self.pos - tail_start
+            data = self.tail[start:start + n]
+        else:
+            n = min(n, tail_start - self.pos)
+            data = self.fetch(self.pos, self.pos + n - 1)
+            self.fetches += 1
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def opened(fetch, size, tail=b'', buffer_size=64 << 10):
+    """A buffered :class:`Ranged` file, so that small reads -- of headers,
+       for example -- fetch ``buffer_size`` bytes at a time.
+    """
+    return io.BufferedReader(Ranged(fetch, size, tail), buffer_size)
@@ -0,0 +1,258 @@
+"""Indexes of the files in tar archives, for reading one of them without
+scanning the archive up to it.
+
+Files in uncompressed archives are read at their offset. Gzipped archives can
+only be read from the start of a gzip member; most are a single member, and
+must be decompressed from the beginning (though the tar headers need not be
+parsed), but archives made of many members -- as written by ``bgzip`` or
+``pigz --independent`` -- can be read from the nearest checkpoint, a member
+boundary recorded in the index.
+"""
+import bisect
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import zlib
+
+from magiclog import log
+
+from ..err import Err
+
+
+class Index(object):
+    """The offset and size of every regular file in an archive, by name.
+
+    Offsets are into the uncompressed data. The checkpoints are pairs of
+    compressed and uncompressed offsets from which reading can begin. The
+    ``size`` of the archive, when it is known, allows an index published
+    alongside an archive to be checked against it.
+    """
+
+    def __init__(self, members, compression=None, checkpoints=[[0, 0]],
+                 size=None):
+        self.members = members
+        self.compression = compression
+        self.checkpoints = checkpoints
+        self.size = size
+
+    @classmethod
+    def build(cls, path, spacing=1 << 20):
+        """Scans the archive at ``path``, which may be gzipped; other kinds of
+           compression raise :class:`Unindexable`.
+
+        For gzipped archives of many members, checkpoints are recorded every
+        ``spacing`` bytes of uncompressed data (or as close as the member
+        boundaries allow).
+        """
+        with open(str(path), 'rb') as h:
+            gzipped = h.read(2) == gzip_magic
+            h.seek(0)
+            stream = Gunzip(h, spacing=spacing) if gzipped else h
+            members = {}
+            try:
+                with tarfile.open(fileobj=stream, mode='r|') as archive:
+                    for member in archive:
+                        name = '/'.join(components(member.name))
+                        if member.isfile() and name not in members:
+                            members[name] = [member.offset_data, member.size]
+            except (tarfile.TarError, zlib.error) as e:
+                raise Unindexable('Not able to index %s: %s' % (path, e))
+        size = os.path.getsize(str(path))
+        if not gzipped:
+            return cls(members, size=size)
+        return cls(members, 'gzip', stream.checkpoints, size)
+
+    @classmethod
+    def parse(cls, text):
+        try:
+            data = json.loads(text)
+            return cls(dict((k, list(v)) for k, v in data['members'].items()),
+                       data['compression'], data['checkpoints'],
+                       data.get('size'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise Unindexable('Not able to read index: %s' % e)
+
+    def dumps(self):
+        return json.dumps(dict(members=self.members,
+                               compression=self.compression,
+                               checkpoints=self.checkpoints,
+                               size=self.size), sort_keys=True)
+
+    def extent(self, name):
+        """The inclusive range of bytes of the archive that holds the file
+           ``name``, or ``None`` if there is no such file in the index. The
+           end is ``None`` when the range extends to the end of the archive.
+        """
+        found = self.members.get('/'.join(components(name)))
+        if found is None:
+            return None
+        offset, size = found
+        if self.compression is None:
+            return offset, offset + size - 1
+        start = self.checkpoint(offset)[0]
+        later = [c for c, u in self.checkpoints if u >= offset + size]
+        return start, later[0] - 1 if later else None
+
+    def checkpoint(self, offset):
+        """The last checkpoint before the uncompressed ``offset``."""
+        starts = [u for _, u in self.checkpoints]
+        return self.checkpoints[bisect.bisect_right(starts, offset) - 1]
+
+    def read(self, stream, name):
+        """A stream of the file ``name``, from a stream of the archive that
+           begins at the start of the file's extent.
+        """
+        offset, size = self.members['/'.join(components(name))]
+        if self.compression is None:
+            return Span(stream, size)
+        compressed, uncompressed = self.checkpoint(offset)
+        stream = Gunzip(stream, compressed, uncompressed)
+        skipped = Span(stream, offset - uncompressed)
+        while skipped.read(1 << 20):
+            pass
+        return Span(stream, size)
+
+    def open(self, handle, name):
+        """A stream of the file ``name``, read from the archive open as
+           ``handle``; or ``None`` if there is no such file in the index.
+        """
+        extent = self.extent(name)
+        if extent is None:
+            return None
+        handle.seek(extent[0])
+        return self.read(handle, name)
+
+
+class Gunzip(object):
+    """Decompresses gzip data from ``stream``, including data made of many
+       gzip members, recording the offsets at which members begin.
+
+    A checkpoint is only recorded every ``spacing`` bytes of uncompressed
+    data, to keep indexes of many small members compact.
+    """
+
+    def __init__(self, stream, compressed=0, uncompressed=0, spacing=1 << 20):
+        self.stream = stream
+        self.spacing = spacing
+        self.checkpoints = [[compressed, uncompressed]]
+        self.fed = compressed
+        self.pos = uncompressed
+        self.buffer = b''
+        self.pending = b''
+        self.ended = False
+        self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, n=-1):
+        while n is None or n < 0 or len(self.buffer) < n:
+            if not self.fill():
+                break
+        if n is None or n < 0:
+            n = len(self.buffer)
+        block, self.buffer = self.buffer[:n], self.buffer[n:]
+        self.pos += len(block)
+        return block
+
+    def fill(self, blocksize=1 << 16):
+        if self.ended:
+            return False
+        data = self.pending or self.stream.read(blocksize)
+        self.pending = b''
+        if not data:
+            return False
+        self.fed += len(data)
+        self.buffer += self.inflate.decompress(data)
+        rest = self.inflate.unused_data
+        if rest:
+            # A member has ended; what follows is another one, unless it is
+            # padding.
+            self.fed -= len(rest)
+            if len(rest) < len(gzip_magic):
+                rest += self.stream.read(len(gzip_magic) - len(rest))
+            if not rest.startswith(gzip_magic):
+                self.ended = True
+                return True
+            start = self.pos + len(self.buffer)
+            if start - self.checkpoints[-1][1] >= self.spacing:
+                self.checkpoints += [[self.fed, start]]
+            self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.pending = rest
+        return True
+
+
+class Span(object):
+    """A stream of the next ``size`` bytes of ``stream``."""
+
+    def __init__(self, stream, size):
+        self.stream = stream
+        self.left = size
+
+    def read(self, n=-1):
+        n = self.left if n is None or n < 0 else min(n, self.left)
+        block = self.stream.read(n) if n > 0 else b''
+        self.left -= len(block)
+        return block
+
+
+def components(name):
+    """The components of a member name, without empty and ``.`` components.
+    """
+    return [part for part in name.split('/') if part not in ('', '.')]
+
+
+def load(path, store=None):
+    """The index of the archive at ``path``, built on first use; or ``None``
+       if the archive can not be indexed.
+
+    Indexes are saved in the store, if there is one, and otherwise kept for
+    the life of the process. They are found again by the digest of archives
+    that are objects in the store, and for other files by their identity
+    (see :func:`identity`).
+    """
+    key = identity(path, store)
+    saved = store.index(key) if store is not None else None
+    with _lock:
+        index = _indexes.get(key)
+    if index is None and saved is not None and saved.check(file=True):
+        saved.setmtime()
+        try:
+            index = Index.parse(saved.read())
+        except Unindexable as e:
+            log.warning('Rebuilding index of %s: %s', path, e)
+    if index is None:
+        try:
+            index = Index.build(path)
+        except Unindexable as e:
+            log.debug('%s', e)
+            return None
+        if saved is not None:
+            store.write(saved, index.dumps())
+    with _lock:
+        _indexes[key] = index
+    return index
+
+
+def identity(path, store=None):
+    """A key for the contents of the file at ``path``: its digest, if it is
+       an object in the ``store`` (which are touched whenever they are used,
+       but never change); or else its device, inode, size and modification
+       time.
+    """
+    digest = store.objectdigest(path) if store is not None else None
+    if digest is not None:
+        return digest
+    st = os.stat(str(path))
+    text = '%d:%d:%d:%r' % (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+gzip_magic = b'\x1f\x8b'
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+class Unindexable(Err):
+    pass
@@ -0,0 +1,94 @@
+import pytest
+import six
+
+from ...sources.test import serving
+from ..httpclient import HTTPError, Pool
+
+
+def test_segmented(tmpdir):
+    body = six.b(''.join(chr(ord('a') + i % 26) for i in range(1000)))
+    pool = Pool(segments=4, segment_min=100)
+    with serving({'/big': body, '/small': six.b('x' * 10)}) as server:
+        status, headers = pool.download(server.url + '/big', tmpdir.join('b'))
+        assert status == 200
+        assert tmpdir.join('b').read_binary() == body
+        ranges = [h.get('Range') for _, h in server.requests]
+        assert len(ranges) == 4
+        assert sorted(r for r in ranges if r) == ['bytes=250-499',
+                                                  'bytes=500-749',
+                                                  'bytes=750-999']
+
+        del server.requests[:]
+        pool.download(server.url + '/small', tmpdir.join('s'))
+        assert len(server.requests) == 1
+        assert tmpdir.join('s').read() == 'x' * 10
+
+        with pytest.raises(HTTPError) as info:
+            pool.download(server.url + '/missing', tmpdir.join('m'))
+        assert info.value.status == 404
+    pool.clear()
+
+
+def test_segmentable():
+    pool = Pool(segments=4, segment_min=100)
+    found = {'accept-ranges': 'bytes', 'etag': '"a"'}
+    assert pool.segmentable(200, found, 1000)
+    assert not pool.segmentable(200, dict(found, etag='W/"a"'), 1000)
+    assert pool.segmentable(200, dict(found, etag='W/"a"',
+                                      **{'last-modified': 'today'}), 1000)
+
+
+def test_resume(tmpdir):
+    body = six.b('0123456789' * 100)
+    pool = Pool(segments=1)
+    with serving({'/data': body}) as server:
+        server.cuts['/data'] = 300
+        status, _ = pool.download(server.url + '/data', tmpdir.join('d'),
+                                  backoff=0)
+        assert status == 200
+        assert tmpdir.join('d').read_binary() == body
+        ranges = [h.get('Range') for _, h in server.requests]
+        assert ranges == [None, 'bytes=300-999']
+        assert not tmpdir.join('d.part').check()
+
+        # A failure that outlasts the retries leaves the part file behind,
+        # for a later download to resume.
+        server.cuts['/data'] = 600
+        with pytest.raises(Exception):
+            pool.download(server.url + '/data', tmpdir.join('e'), retries=0)
+        assert tmpdir.join('e.part').check()
+        del server.requests[:]
+        pool.download(server.url + '/data', tmpdir.join('e'))
+        assert [h.get('Range') for _, h in server.requests] == [
+            'bytes=600-999'
+        ]
+        assert tmpdir.join('e').read_binary() == body
+    pool.clear()
+
+
+def test_guard():
+    pool = Pool()
+
+    def guard(url):
+        if url.endswith('/secret'):
+            raise ValueError(url)
+
+    pool.guard = guard
+    with serving({'/secret': six.b('x')}) as server:
+        with pytest.raises(ValueError):
+            with pool.request('GET', server.url + '/secret'):
+                pass
+    assert server.requests == []
+
+
+def test_guard_address():
+    pool = Pool()
+    pool.guard = lambda url: '127.0.0.1'
+    with serving({'/data': six.b('x')}) as server:
+        port = server.url.rsplit(':', 1)[1]
+        url = 'http://arx.invalid:%s/data' % port     # Does not resolve.
+        with pool.request('GET', url) as response:
+            assert response.read() == six.b('x')
+    (path, headers), = server.requests
+    assert headers['Host'] == 'arx.invalid:' + port
+    pool.clear()
@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from .. import linking
+from ..linking import clone, copy, freeze, mirror, sync, UnknownStrategy
+
+
+def test_mirror(tmpdir):
+    src = tmpdir.join('src')
+    src.join('a', 'b').write('b', ensure=True)
+    src.join('run').write('#!/bin/sh\n')
+    src.join('run').chmod(0o755)
+    os.symlink('a/b', str(src.join('link')))
+    freeze(src)
+    assert not os.access(str(src.join('a', 'b')), os.W_OK) or \
+        os.geteuid() == 0
+    assert src.join('a').stat().mode & 0o700 == 0o700
+
+    mirror(src, tmpdir.join('dest'))
+    dest = tmpdir.join('dest')
+    assert dest.join('a', 'b').read() == 'b'
+    assert dest.join('link').readlink() == 'a/b'
+    assert os.access(str(dest.join('run')), os.X_OK)
+    dest.join('a', 'c').write('c')                  # Directories are fresh.
+    assert not src.join('a', 'c').check()
+
+
+def test_clone(tmpdir):
+    tmpdir.join('a').write('a')
+    tmpdir.join('b').write('old')
+    clone(str(tmpdir.join('a')), str(tmpdir.join('b')))
+    assert tmpdir.join('b').read() == 'a'
+
+
+def test_copies_writable(tmpdir):
+    tmpdir.join('a').write('a')
+    tmpdir.join('a').chmod(0o444)                     # Like a stored object.
+    for place in [copy, linking.reflink_or_copy]:
+        dest = tmpdir.join(place.__name__)
+        place(str(tmpdir.join('a')), str(dest))
+        assert dest.read() == 'a'
+        assert dest.stat().mode & 0o777 == 0o644
+
+
+def test_strategies(tmpdir):
+    src = tmpdir.join('src')
+    src.join('a').write('a' * 100000, ensure=True)
+    src.join('a').chmod(0o640)
+    inode = src.join('a').stat().ino
+    for name in sorted(linking.strategies):
+        with linking.using(name):
+            linking.place(src, tmpdir.join(name, 'dir'))
+            linking.place(src.join('a'), tmpdir.join(name, 'file'))
+        placed_dir, placed_file = tmpdir.join(name, 'dir'), tmpdir.join(name)
+        for placed in [placed_dir.join('a'), placed_file.join('file')]:
+            assert placed.read() == 'a' * 100000
+            assert (placed.lstat().ino == inode) == (name == 'hardlink')
+            assert placed.islink() == (name == 'symlink')
+            assert placed.stat().mode & 0o777 == 0o640
+    with pytest.raises(UnknownStrategy):
+        with linking.using('teleport'):
+            pass
+
+
+def test_kernel_copy(tmpdir):
+    tmpdir.join('a').write_binary(os.urandom(1 << 20))
+    with open(str(tmpdir.join('a')), 'rb') as s, \
+            open(str(tmpdir.join('b')), 'wb') as d:
+        linking.kernel_copy(s.fileno(), d.fileno(), 1 << 20, blocksize=4096)
+    assert tmpdir.join('b').read_binary() == tmpdir.join('a').read_binary()
+
+
+def test_sync(tmpdir):
+    src, dest = tmpdir.join('src'), tmpdir.join('dest')
+    manifest = tmpdir.join('manifest.json')
+    for name in ['a', 'b', os.path.join('c', 'd'), os.path.join('e', 'f')]:
+        src.join(name).write(name, ensure=True)
+    os.symlink('a', str(src.join('link')))
+    assert sync(src, dest, copy, manifest) == 5
+    assert dest.join('c', 'd').read() == os.path.join('c', 'd')
+    assert dest.join('link').readlink() == 'a'
+    assert sync(src, dest, copy, manifest) == 0     # Nothing has changed.
+
+    dest.join('mine').write('mine')
+    src.join('a').write('changed')
+    src.join('b').remove()
+    src.join('e').remove(rec=1)
+    assert sync(src, dest, copy, manifest) == 1
+    assert dest.join('a').read() == 'changed'
+    assert not dest.join('b').check()
+    assert not dest.join('e').check()
+    assert dest.join('mine').read() == 'mine'       # Not placed by sync.
@@ -0,0 +1,94 @@
+import gzip
+import io
+
+import six
+
+from ...cache import Store
+from ...sources.test import tarball
+from .. import tarindex
+from ..tarindex import Gunzip, Index
+
+
+files = dict(('d/%d' % i, six.b(str(i)) * (i * 1000)) for i in range(1, 20))
+
+
+def members(data, size):
+    """Gzips the data in members of ``size`` bytes, like ``bgzip``."""
+    out = io.BytesIO()
+    for start in range(0, len(data), size):
+        out.write(gzip_bytes(data[start:start + size]))
+    return out.getvalue()
+
+
+def gzip_bytes(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as h:
+        h.write(data)
+    return out.getvalue()
+
+
+def check(path):
+    index = Index.build(path)
+    assert sorted(index.members) == sorted(files)
+    with open(str(path), 'rb') as h:
+        for name in ['d/19', 'd/3', './d/7']:
+            expected = files[name.lstrip('./')]
+            assert index.open(h, name).read() == expected
+        assert index.open(h, 'd/missing') is None
+    return index
+
+
+def test_plain(tmpdir):
+    path = tmpdir.join('a.tar')
+    path.write_binary(tarball(files, mode='w'))
+    assert check(path).compression is None
+
+
+def test_gzip(tmpdir):
+    path = tmpdir.join('a.tgz')
+    path.write_binary(tarball(files))
+    index = check(path)
+    assert index.checkpoints == [[0, 0]]
+
+
+def test_gzip_members(tmpdir):
+    data = tarball(files, mode='w')
+    path = tmpdir.join('a.tgz')
+    path.write_binary(members(data, 4096))
+    with open(str(path), 'rb') as h:
+        stream = Gunzip(h, spacing=16384)
+        assert stream.read() == data
+    assert len(stream.checkpoints) > 4
+    index = Index.build(path)
+    index.checkpoints = stream.checkpoints
+    check(path)
+    again = Index.parse(index.dumps())
+    with open(str(path), 'rb') as h:
+        assert again.open(h, 'd/18').read() == files['d/18']
+
+
+def test_load(tmpdir):
+    path = tmpdir.join('a.tar')
+    path.write_binary(tarball(files, mode='w'))
+    store = Store(tmpdir.join('store'))
+    index = tarindex.load(path, store)
+    assert store.index(tarindex.identity(path, store)).check(file=True)
+    tarindex._indexes.clear()
+    assert tarindex.load(path, store).members == index.members
+    tmpdir.join('a.tbz').write_binary(six.b('BZh91AY&SY'))
+    assert tarindex.load(tmpdir.join('a.tbz')) is None
+
+
+def test_load_stored(tmpdir):
+    path = tmpdir.join('a.tar')
+    path.write_binary(tarball(files, mode='w'))
+    store = Store(tmpdir.join('store'))
+    entry = store.put('http://example.com/a.tar', path)
+    obj = store.obj(entry['digest'])
+    assert tarindex.identity(obj, store) == entry['digest']
+    tarindex.load(obj, store)
+    assert store.index(entry['digest']).check(file=True)
+    obj.setmtime(0)                   # Only the object is over the limit,
+    store.gc(store.index(entry['digest']).size())  # but its index goes too.
+    assert not obj.check()
+    assert list(store.indexes.visit('*.json')) == []
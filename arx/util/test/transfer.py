@@ -0,0 +1,65 @@
+import io
+
+import pytest
+import six
+
+from ..transfer import Incomplete, merge, retrying, split, Transfer
+from ..transfer import validator
+
+
+def test_split():
+    assert split(10, 3) == [(0, 3), (4, 7), (8, 9)]
+    assert split(2, 4) == [(0, 0), (1, 1)]
+
+
+def test_merge():
+    assert merge([[5, 9], [0, 3], [4, 4], [12, 20]]) == [[0, 9], [12, 20]]
+
+
+def test_validator():
+    date = 'Tue, 01 Mar 2016 00:00:00 GMT'
+    assert validator({'etag': '"a"', 'last-modified': date}) == '"a"'
+    assert validator({'etag': 'W/"a"', 'last-modified': date}) == date
+    assert validator({'etag': 'W/"a"'}) is None
+    assert validator({}) is None
+
+
+def test_transfer(tmpdir):
+    part = tmpdir.join('data.part')
+    transfer = Transfer(part)
+    transfer.reset('https://example.com/data', dict(etag='"a"'), 10)
+    transfer.write(io.BytesIO(six.b('cdef')), 2, 4)
+    with pytest.raises(Incomplete):
+        transfer.write(io.BytesIO(six.b('ghi')), 6, 4)
+    assert transfer.missing() == [(0, 1), (9, 9)]
+
+    # Progress is picked up from disk, by a later transfer.
+    again = Transfer(part)
+    assert again.resumable('https://example.com/data')
+    assert not again.resumable('https://example.com/other')
+    assert again.missing() == [(0, 1), (9, 9)]
+    again.write(io.BytesIO(six.b('ab')), 0, 2)
+    again.write(io.BytesIO(six.b('j')), 9, 1)
+    assert again.missing() == []
+    again.finish(tmpdir.join('data'))
+    assert tmpdir.join('data').read() == 'abcdefghij'
+    assert not tmpdir.join('data.part.json').check()
+
+
+def test_retrying():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise IOError('flaky')
+        return 'ok'
+
+    assert retrying(flaky, retries=2, backoff=0) == 'ok'
+    del attempts[:]
+    with pytest.raises(IOError):
+        retrying(flaky, retries=1, backoff=0)
+    del attempts[:]
+    with pytest.raises(IOError):
+        retrying(flaky, retries=5, backoff=0, retriable=lambda e: False)
+    assert len(attempts) == 1
@@ -0,0 +1,278 @@
+"""Resumable downloads.
+
+Data is downloaded into a ``.part`` file, with the byte ranges written so far
+recorded in a JSON file next to it. When a download fails, both files are
+left in place, so that a retry -- in this run or a later one -- fetches only
+the missing ranges.
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+
+from magiclog import log
+import py.path
+from six.moves import http_client, queue
+
+from ..err import Err
+
+
+class Transfer(object):
+    """Progress of a download into the file ``part``.
+
+    The state records the source of the data, the headers that describe it
+    (which hold the validator used to ensure a resumed download continues the
+    same data), its length and the inclusive byte ranges already written.
+    """
+
+    def __init__(self, part):
+        self.part = str(part)
+        self.statefile = self.part + '.json'
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(self.part):
+            try:
+                with open(self.statefile) as h:
+                    self.state = json.load(h)
+            except (IOError, OSError, ValueError):
+                pass
+
+    @property
+    def headers(self):
+        return self.state.get('headers', {})
+
+    @property
+    def length(self):
+        return self.state.get('length', -1)
+
+    @property
+    def validator(self):
+        return validator(self.headers)
+
+    def resumable(self, source):
+        """True if a download of ``source`` was started and can be continued.
+        """
+        return (self.state.get('source') == source and self.length >= 0 and
+                self.validator is not None and
+                os.path.exists(self.part) and
+                os.path.getsize(self.part) == self.length)
+
+    def reset(self, source, headers, length):
+        """Starts the download afresh, truncating the part file."""
+        preallocate(self.part, length)
+        with self.lock:
+            self.state = dict(source=source, headers=headers, length=length,
+                              done=[])
+            self.save()
+
+    def discard(self):
+        with self.lock:
+            self.state = {}
+            for path in [self.part, self.statefile]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def record(self, start, end):
+        """Marks the inclusive byte range as written."""
+        if end < start or self.length < 0:
+            return
+        with self.lock:
+            self.state['done'] = merge(self.state['done'] + [[start, end]])
+            self.save()
+
+    def missing(self):
+        """The inclusive byte ranges that remain to be written."""
+        spans, offset = [], 0
+        for start, end in self.state.get('done', []):
+            if start > offset:
+                spans += [(offset, start - 1)]
+            offset = max(offset, end + 1)
+        if offset < self.length:
+            spans += [(offset, self.length - 1)]
+        return spans
+
+    def save(self):
+        tmp = self.statefile + '.tmp'
+        with open(tmp, 'w') as h:
+            json.dump(self.state, h)
+        os.rename(tmp, self.statefile)
+
+    def finish(self, dest):
+        """Moves the completed data to ``dest``."""
+        dest_dir = os.path.dirname(str(dest))
+        if dest_dir:
+            py.path.local(dest_dir).ensure(dir=True)      # Safe for threads.
+        shutil.move(self.part, str(dest))       # Renames when it's possible.
+        if os.path.exists(self.statefile):
+            os.remove(self.statefile)
+
+    def write(self, stream, start, n=None, blocksize=1 << 20, every=16):
+        """Copies ``n`` bytes (or everything) from a readable stream into the
+           part file at ``start``, recording progress as it goes -- even if
+           the copy fails part way.
+        """
+        written, recorded = 0, 0
+        try:
+            with open(self.part, 'r+b') as h:
+                h.seek(start)
+                while n is None or written < n:
+                    wanted = blocksize if n is None else min(blocksize,
+                                                             n - written)
+                    block = stream.read(wanted)
+                    if not block:
+                        break
+                    h.write(block)
+                    written += len(block)
+                    if written - recorded >= every * blocksize:
+                        h.flush()
+                        self.record(start, start + written - 1)
+                        recorded = written
+        finally:
+            self.record(start, start + written - 1)
+        if n is not None and written < n:
+            raise Incomplete('Data ended %d bytes early.' % (n - written))
+        return written
+
+
+class Tee(object):
+    """A readable stream that copies the data read from ``stream`` to
+       ``sink``, if there is one.
+
+    When the ``length`` of the data is known, a stream that ends early raises
+    :class:`Incomplete`.
+    """
+
+    def __init__(self, stream, sink=None, length=-1):
+        self.stream = stream
+        self.sink = sink
+        self.length = length
+        self.count = 0
+
+    def read(self, n=-1):
+        block = self.stream.read() if n is None or n < 0 else \
+            self.stream.read(n)
+        if not block and n != 0 and 0 <= self.count < self.length:
+            raise Incomplete('Data ended %d bytes early.' %
+                             (self.length - self.count))
+        self.count += len(block)
+        if self.sink is not None:
+            self.sink.write(block)
+        return block
+
+    def drain(self, blocksize=1 << 20):
+        """Reads the rest of the stream, so it all reaches the sink."""
+        while self.read(blocksize):
+            pass
+
+
+class Hashing(object):
+    """A sink that computes the SHA-256 digest of the data written to it --
+       on a worker thread, so that hashing overlaps I/O -- and passes the
+       data on to ``sink``, if there is one.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.hash = hashlib.sha256()
+        self.blocks = queue.Queue(maxsize=16)
+        self.worker = threading.Thread(target=self.consume)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def consume(self):
+        for block in iter(self.blocks.get, None):
+            self.hash.update(block)
+
+    def write(self, block):
+        if self.sink is not None:
+            self.sink.write(block)
+        self.blocks.put(block)
+
+    def close(self):
+        if self.worker.is_alive():
+            self.blocks.put(None)
+            self.worker.join()
+
+    def hexdigest(self):
+        self.close()
+        return self.hash.hexdigest()
+
+
+def validator(headers):
+    """The validator for ranges of the data described by the (lowercased)
+       headers, as sent in ``If-Range``: its ETag -- unless that is weak,
+       which ``If-Range`` does not accept -- or else its modification date; or
+       ``None``, if it has neither.
+    """
+    etag = headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('last-modified')
+
+
+def retrying(fn, retries=4, backoff=1.0, retriable=lambda e: True,
+             label='download'):
+    """Calls ``fn`` until it succeeds, up to ``retries`` more times, waiting
+       ``backoff`` seconds before the first retry and doubling the wait each
+       time after.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not retriable(e):
+                raise
+            delay = backoff * 2 ** attempt
+            log.warning('Retrying %s in %.1fs, after: %s', label, delay, e)
+            time.sleep(delay)
+
+
+def transient(e):
+    """True for errors that are worth retrying: network failures and
+       truncated transfers.
+    """
+    return isinstance(e, (socket.error, http_client.HTTPException,
+                          Incomplete))
+
+
+def merge(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def split(length, n):
+    """Splits ``length`` bytes into at most ``n`` inclusive spans."""
+    size = max(1, -(-length // n))
+    return [(start, min(start + size, length) - 1)
+            for start in range(0, length, size)]
+
+
+def chunks(spans, size):
+    """Breaks inclusive spans into spans of at most ``size`` bytes."""
+    for start, end in spans:
+        for offset in range(start, end + 1, size):
+            yield (offset, min(offset + size, end + 1) - 1)
+
+
+def preallocate(path, length):
+    with open(str(path), 'wb') as h:
+        if length <= 0:
+            return
+        h.truncate(length)
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(h.fileno(), 0, length)
+            except OSError:                  # Not all filesystems support it.
+                pass
+
+
+class Incomplete(Err):
+    pass
@@ -9,10 +9,10 @@ conf = dict(name='arx',
             author_email='jason.dusek@gmail.com',
             url='https://github.com/drcloud/arx',
             version=v2.from_git().from_file().from_default().imprint().version,
-            install_requires=['awscli',
-                              'boto3',
+            install_requires=['boto3',
                               'click',
                               'enum34',
+                              'ipaddress; python_version < "3"',
                               'magiclog',
                               'ptpython',
                               'py',
@@ -25,7 +25,7 @@ conf = dict(name='arx',
                               'uritools',
                               'v2'],
             setup_requires=['pytest-runner', 'setuptools', 'v2'],
-            tests_require=['flake8', 'pytest', 'tox'],
+            tests_require=['flake8', 'moto', 'pytest', 'tox'],
             description='Arx, a task manifest format.',
             packages=find_packages(),
             package_data={'arx.test': ['*.yaml']},